@@ -135,6 +135,9 @@ def syntax_proc():
     print('To run in image simulation mode: ')
     print('    python simulate.py <yaml settings file> <filter> <dither id> [verify string]')
     print('')
+    print('To run in image simulation mode on a batch of batch_size (dither, sca) rows of dither_from_file: ')
+    print('    python simulate.py <yaml settings file> <filter> <batch id> batch [verify string]')
+    print('')
     print('To set up index information for meds making mode (must be run before attempting meds making): ')
     print('    python simulate.py <yaml settings file> <filter> meds setup')
     print('')
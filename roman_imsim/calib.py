@@ -0,0 +1,123 @@
+import numpy as np
+import sys, os, io
+import threading
+import fitsio as fio
+
+# Calibration products of the current SCA file
+calib_cache = {}
+
+
+class sca_calib(object):
+    """
+    Calibration products of one SCA file (RELQE1, SATURATE, BADPIX, BIAS, GAIN, DARK, READ, CNL, IPC, VTPE, PERSIST, BFE), each read whole as a numpy array the first time it is used and kept in memory. With cache_dir, each product is also saved there as a .npy file and memory mapped, so that all processes on a node share one copy through the page cache (use /dev/shm or a node-local disk). The arrays are shared by all users of the SCA and must not be modified in place. Products are loaded under a lock, so threads using the same SCA read each product once.
+    """
+
+    def __init__(self, filename, cache_dir=None):
+        """
+        Input
+        filename  : SCA file
+        cache_dir : Directory for memory mapped products (None to keep them in process memory only)
+        """
+
+        self.filename  = filename
+        self.cache_dir = cache_dir
+        self.mtime     = os.path.getmtime(filename)
+        self.fits      = None
+        self.arrays    = {}
+        self.headers   = {}
+        self.lock      = threading.RLock()
+
+    def open(self):
+
+        if self.fits is None:
+            self.fits = fio.FITS(self.filename)
+        return self.fits
+
+    def load(self, name, func):
+        """
+        Return a product, calling func() to make it if it is neither in memory nor in cache_dir. Products in cache_dir older than the SCA file are remade.
+
+        Input
+        name : Product name
+        func : Function returning the product array
+        """
+
+        with self.lock:
+            if name not in self.arrays:
+                self.arrays[name] = self.make(name, func)
+        return self.arrays[name]
+
+    def make(self, name, func):
+        """
+        Load a product from cache_dir or make it with func(). Called by load() with the lock held.
+        """
+
+        if self.cache_dir is not None:
+            cache_file = os.path.join(self.cache_dir, os.path.basename(self.filename)+'.'+name+'.npy')
+            if os.path.exists(cache_file) and (os.path.getmtime(cache_file)>=self.mtime):
+                return np.load(cache_file, mmap_mode='r')
+
+        array = func()
+        if self.cache_dir is not None:
+            try:
+                tmp = cache_file+'.'+str(os.getpid())+'_'+str(threading.get_ident())+'.tmp'
+                with open(tmp,'wb') as f:
+                    np.save(f, array)
+                os.replace(tmp, cache_file)
+                array = np.load(cache_file, mmap_mode='r')
+            except OSError:
+                print('Could not cache '+name+' in '+self.cache_dir)
+
+        return array
+
+    def close(self):
+
+        with self.lock:
+            if self.fits is not None:
+                self.fits.close()
+                self.fits = None
+            self.arrays  = {}
+            self.headers = {}
+
+    def __getitem__(self, name):
+        """
+        Return the full array of an image HDU of the SCA file, e.g. calib['CNL'][0] for the first CNL coefficient map.
+        """
+
+        return self.load(name, lambda : self.open()[name].read())
+
+    def header(self, name):
+        """
+        Return the header of an HDU of the SCA file.
+        """
+
+        with self.lock:
+            if name not in self.headers:
+                self.headers[name] = self.open()[name].read_header()
+        return self.headers[name]
+
+    def expand(self, name, block):
+        """
+        Return the (float) map of a product binned in block x block pixels, expanded to one value per pixel, e.g. expand('GAIN',128) for the 4096x4096 gain image.
+
+        Input
+        name  : Product name
+        block : Number of pixels per bin along each axis
+        """
+
+        return self.load(name+'_'+str(block), lambda : np.repeat(np.repeat(self[name].astype(float), block, axis=-2), block, axis=-1))
+
+def get_sca_calib(filename, cache_dir=None):
+    """
+    Return the calibration products of an SCA file, shared by all users in the process. Only the last SCA file is kept, so a process simulating many SCAs (e.g., in batch mode) doesn't accumulate their products.
+
+    Input
+    filename  : SCA file
+    cache_dir : Directory for memory mapped products
+    """
+
+    if filename not in calib_cache:
+        for name in list(calib_cache):
+            calib_cache.pop(name).close()
+        calib_cache[filename] = sca_calib(filename, cache_dir=cache_dir)
+    return calib_cache[filename]
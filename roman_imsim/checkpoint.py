@@ -0,0 +1,49 @@
+import sys, os, io
+import time
+
+from .misc import save_obj
+from .misc import load_obj
+
+
+class sca_checkpoint(object):
+    """
+    Checkpoint file of a partially drawn (dither, SCA) on one process. It holds whatever state roman_sim.iterate_image() needs to resume (partial SCA image, index tables, stamp file offsets and the loop position) as a pickled dictionary. Saving is atomic, so a job killed while saving still has the previous checkpoint.
+    """
+
+    def __init__(self, filename, interval):
+        """
+        Input
+        filename : Checkpoint filename
+        interval : Time in seconds between checkpoints
+        """
+
+        self.filename = filename
+        self.interval = interval
+
+    def load(self):
+        """
+        Return the saved state, or None if there is no checkpoint.
+        """
+
+        if not os.path.exists(self.filename):
+            return None
+        print('Loading checkpoint '+self.filename)
+        return load_obj(self.filename)
+
+    def save(self, state):
+        """
+        Save the state.
+
+        Input
+        state : Dictionary of state to save
+        """
+
+        t0 = time.time()
+        save_obj(state, self.filename+'.tmp')
+        os.replace(self.filename+'.tmp', self.filename)
+        print('Saved checkpoint '+self.filename, time.time()-t0)
+
+    def remove(self):
+
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
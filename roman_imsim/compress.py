@@ -0,0 +1,114 @@
+import sys, os, io
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from .misc import ParamError
+
+
+# Threads used to run compression jobs in the background (see gzip_file(wait=False))
+background_pool = ThreadPoolExecutor(max_workers=2)
+
+
+def gzip_file(filename, out=None, remove=True, threads=4, level=6, block_size=4*1024**2, wait=True):
+    """
+    In-process replacement for os.system('gzip '+filename). The input is streamed in blocks that are deflated in parallel by a thread pool (zlib releases the GIL), each block primed with the last 32 kB of the previous one and ended with a sync flush, so the concatenated blocks form a single gzip member that any gzip/gunzip or Python gzip reader can read. With wait=False the compression runs in the background and a Future is returned, so it can be overlapped with computation; call .result() before the output is needed.
+
+    Input
+    filename   : File to compress
+    out        : Output filename (default filename+'.gz')
+    remove     : Remove the input file afterwards, like gzip
+    threads    : Number of compression threads
+    level      : zlib compression level
+    block_size : Number of bytes per independently compressed block
+    wait       : Block until done, or return a Future
+    """
+
+    if not wait:
+        return background_pool.submit(gzip_file, filename, out=out, remove=remove, threads=threads, level=level, block_size=block_size)
+
+    if out is None:
+        out = filename+'.gz'
+
+    def deflate(block, zdict, last):
+        if zdict is None:
+            c = zlib.compressobj(level, zlib.DEFLATED, -15)
+        else:
+            c = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+        if last:
+            return c.compress(block)+c.flush(zlib.Z_FINISH)
+        return c.compress(block)+c.flush(zlib.Z_SYNC_FLUSH)
+
+    crc  = 0
+    size = 0
+    with io.open(filename,'rb') as fin, io.open(out+'.tmp','wb') as fout, ThreadPoolExecutor(max_workers=threads) as pool:
+        # gzip member header (no name, mtime or flags)
+        fout.write(b'\x1f\x8b\x08\x00'+struct.pack('<I',int(time.time()))+b'\x00\xff')
+        pending = []
+        prev    = None
+        block   = fin.read(block_size)
+        while True:
+            nxt  = fin.read(block_size)
+            last = len(nxt)==0
+            pending.append(pool.submit(deflate, block, None if prev is None else prev[-32768:], last))
+            crc   = zlib.crc32(block, crc)
+            size += len(block)
+            prev  = block
+            # Keep a bounded number of blocks in flight
+            while len(pending)>2*threads:
+                fout.write(pending.pop(0).result())
+            if last:
+                break
+            block = nxt
+        for p in pending:
+            fout.write(p.result())
+        fout.write(struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+    os.replace(out+'.tmp',out)
+
+    if remove:
+        os.remove(filename)
+
+    return out
+
+def gunzip_file(filename, out=None, remove=True, block_size=4*1024**2, wait=True):
+    """
+    In-process replacement for os.system('gunzip '+filename). The file is decompressed as a stream, so memory use is bounded, and multi-member files are handled. With wait=False a Future is returned (see gzip_file()).
+
+    Input
+    filename   : File to decompress (ending in .gz unless out is given)
+    out        : Output filename (default filename without .gz)
+    remove     : Remove the input file afterwards, like gunzip
+    block_size : Number of compressed bytes read at a time
+    wait       : Block until done, or return a Future
+    """
+
+    if not wait:
+        return background_pool.submit(gunzip_file, filename, out=out, remove=remove, block_size=block_size)
+
+    if out is None:
+        if not filename.endswith('.gz'):
+            raise ParamError('Can not infer output filename for '+filename)
+        out = filename[:-3]
+
+    with io.open(filename,'rb') as fin, io.open(out+'.tmp','wb') as fout:
+        d = zlib.decompressobj(31)
+        while True:
+            data = fin.read(block_size)
+            if len(data)==0:
+                break
+            while len(data)>0:
+                fout.write(d.decompress(data))
+                if not d.eof:
+                    break
+                # Start of the next gzip member
+                data = d.unused_data
+                d    = zlib.decompressobj(31)
+        fout.write(d.flush())
+    os.replace(out+'.tmp',out)
+
+    if remove:
+        os.remove(filename)
+
+    return out
@@ -47,6 +47,15 @@ from .misc import get_filename
 from .misc import get_filenames
 from .misc import write_fits
 from .telescope import pointing as Pointing
+from .calib import get_sca_calib
+from .noise import poisson_tiles
+from .noise import gaussian_tiles
+from .stencil import row_bands
+from .stencil import run_bands
+from .stencil import block_expand
+from .stencil import block_index
+from .stencil import block_stencil
+from .stencil import symmetric_index
 
 sca_number_to_file = {
                         1  : 'SCA_22066_211227_v001.fits',
@@ -69,6 +78,13 @@ sca_number_to_file = {
                         18 : 'SCA_20833_211116_v001.fits',
                         }
 
+# BFE boundary shift kernels derived from each SCA file, shared by all modify_image instances of a process
+bfe_cache = {}
+
+# Exposure lists read from dither_from_file, and stimulus maps of the previous exposures of the current SCA, for persistence
+dither_sca_cache  = {}
+persistence_cache = {}
+
 class modify_image(object):
     """
     Class to simulate non-idealities and noise of roman detector images.
@@ -86,6 +102,10 @@ class modify_image(object):
         roman.exptime  = 139.8
         self.params    = params
 
+        # Block-varying detector effects (BFE, IPC, VTPE) are applied in bands of detector_band rows, spread over detector_threads threads.
+        self.threads   = self.params.get('detector_threads',1)
+        self.band      = self.params.get('detector_band',256)
+
         # Option to change exposure time (in seconds)
         if 'exposure_time' in self.params:
             if self.params['exposure_time'] == 'deep':
@@ -102,10 +122,12 @@ class modify_image(object):
         # Load sca file if applicable
         if 'sca_file_path' in self.params:
             if self.params['sca_file_path'] is not None:
-                self.df = fio.FITS(self.params['sca_file_path']+'/'+sca_number_to_file[pointing.sca])
+                self.sca_filename = self.params['sca_file_path']+'/'+sca_number_to_file[pointing.sca]
+                self.df = get_sca_calib(self.sca_filename, cache_dir=self.params.get('calib_cache_dir',None))
                 if 'tmpdir' not in self.params:
                     if self.params['tmpdir'] is not None:
-                        self.df = fio.FITS(self.params['tmpdir']+sca_number_to_file[pointing.sca])
+                        self.sca_filename = self.params['tmpdir']+sca_number_to_file[pointing.sca]
+                        self.df = get_sca_calib(self.sca_filename, cache_dir=self.params.get('calib_cache_dir',None))
                 print('------- Using SCA files --------')
             else:
                 self.df = None
@@ -169,6 +191,47 @@ class modify_image(object):
         im = self.add_background(im) # Add background to image and save background
 
 
+        # With fused_detector, all stages run band by band (diagnostic diff images need the staged chain)
+        if self.params.get('fused_detector',False) and not self.params['save_diff']:
+            im_pad = self.add_effects_fused(im, pointing)
+        else:
+            im_pad = self.add_effects_staged(im, pointing)
+
+        # output 4088x4088 img in uint16
+        im.array[:,:] = im_pad.array[4:-4, 4:-4]
+        im = galsim.Image(im, dtype=np.uint16)
+
+        # data quality image
+        # 0x1 -> non-responsive
+        # 0x2 -> hot pixel
+        # 0x4 -> very hot pixel
+        # 0x8 -> adjacent to pixel with strange response
+        # 0x10 -> low CDS, high total noise pixel (may have strange settling behaviors, not recommended for precision applications)
+        # 0x20 -> CNL fit went down to the minimum number of points (remaining degrees of freedom = 0)
+        # 0x40 -> no solid-waffle solution for this region (set gain value to array median). normally occurs in a few small regions of some SCAs with lots of bad pixels. [recommend not to use these regions for WL analysis]
+        # 0x80 -> wt==0
+        dq = self.df['BADPIX'][4:4092, 4:4092].copy()
+        # get weight map
+        if not self.params['use_background']:
+            return im,None
+
+        if wt is not None:
+           dq[wt==0] += 128
+
+        sky_noise = self.sky.copy()
+        sky_noise = self.finalize_sky_im(sky_noise, pointing)
+
+        return im, self.sky[self.sky.bounds&im.bounds]-self.sky_mean, dq, self.sky_mean, sky_noise
+
+    def add_effects_staged(self,im,pointing):
+        """
+        Apply the SCA file detector effects of add_effects_scafile() one stage at a time to the whole image.
+
+        Input
+        im       : 4088x4088 image (with background)
+        pointing : Pointing object
+        """
+
         ## create padded image
         bound_pad = galsim.BoundsI( xmin=1, ymin=1,
                                     xmax=4096, ymax=4096)
@@ -219,31 +282,119 @@ class modify_image(object):
         im_pad.quantize()
         self.diff('quantize2', im_pad)
 
-        # output 4088x4088 img in uint16
-        im.array[:,:] = im_pad.array[4:-4, 4:-4]
-        im = galsim.Image(im, dtype=np.uint16)
+        return im_pad
 
-        # data quality image
-        # 0x1 -> non-responsive
-        # 0x2 -> hot pixel
-        # 0x4 -> very hot pixel
-        # 0x8 -> adjacent to pixel with strange response
-        # 0x10 -> low CDS, high total noise pixel (may have strange settling behaviors, not recommended for precision applications)
-        # 0x20 -> CNL fit went down to the minimum number of points (remaining degrees of freedom = 0)
-        # 0x40 -> no solid-waffle solution for this region (set gain value to array median). normally occurs in a few small regions of some SCAs with lots of bad pixels. [recommend not to use these regions for WL analysis]
-        # 0x80 -> wt==0
-        dq = self.df['BADPIX'][4:4092, 4:4092]
-        # get weight map
-        if not self.params['use_background']:
-            return im,None
+    def add_effects_fused(self,im,pointing):
+        """
+        Apply the SCA file detector effects of add_effects_scafile() in bands of detector_band rows, spread over detector_threads threads. Each band goes through all stages while it is in cache, together with the halo rows that the BFE, IPC and VTPE stencils need (recomputed by the neighbouring bands). Rows in the padding of BFE and IPC are found through the same symmetric padding, and the noise is drawn first in the order of the staged chain, so the result is bit-identical to add_effects_staged().
 
-        if wt is not None:
-           dq[wt==0] += 128
+        Input
+        im       : 4088x4088 image (with background)
+        pointing : Pointing object
+        """
 
-        sky_noise = self.sky.copy()
-        sky_noise = self.finalize_sky_im(sky_noise, pointing)
+        n = 4096
+        bound_pad = galsim.BoundsI( xmin=1, ymin=1,
+                                    xmax=4096, ymax=4096)
+        im_pad = galsim.Image(bound_pad)
 
-        return im, self.sky[self.sky.bounds&im.bounds]-self.sky_mean, dq, self.sky_mean, sky_noise
+        # Noise realisations self.im_dark and self.im_read
+        noise = galsim.Image(bound_pad)
+        self.dark_current(noise)
+        noise.setZero()
+        self.add_read_noise(noise)
+        noise = None
+
+        self.im_pers = None
+        history = []
+        if self.params['use_persistence']:
+            history = self.persistence_history(pointing)
+            if self.params.get('sky_response','full')=='single':
+                self.im_pers = np.zeros((n,n), dtype=im_pad.dtype)
+
+        bfe = self.bfe_kernel() if self.params['use_bfe'] else None
+        ipc = self.ipc_kernel() if self.params['use_interpix_cap'] else None
+        vtpe = self.vtpe_kernel() if self.params['use_vtpe'] else None
+
+        # Load the calibration products used by the bands before the band threads start
+        for name,use in [('RELQE1','use_qe'), ('SATURATE','use_saturate'), ('CNL','use_nonlinearity'), ('BADPIX','use_dead_pixel'), ('BIAS','use_bias')]:
+            if self.params[use]:
+                self.df[name]
+        if self.params['use_gain']:
+            self.df.expand('GAIN',128)
+        if len(history)>0:
+            self.df['PERSIST']
+            self.df.header('PERSIST')
+
+        def padded_rows(p0, p1, pad):
+            # Image rows in rows p0 to p1 of the 4088x4088 interior padded by pad, as in bfe() and interpix_cap()
+            return 4+symmetric_index(np.arange(p0,p1)-pad, n-8)
+
+        def front(d0, d1, y0, y1):
+            # Rows d0 to d1 after deadpix (keeping the persistence of rows y0 to y1 for the sky)
+            if ipc is not None:
+                ipc_rows = padded_rows(d0, d1+2, 5)
+                c0, c1 = ipc_rows.min(), ipc_rows.max()+1
+            else:
+                c0, c1 = d0, d1
+            if bfe is not None:
+                z0, z1 = max(c0-1,0), min(c1+1,n)
+                bfe_rows = padded_rows(z0, z1+4, 6)
+                q0, q1 = min(c0, bfe_rows.min()), max(c1, bfe_rows.max()+1)
+            else:
+                q0, q1 = c0, c1
+
+            q = np.zeros((q1-q0, n), dtype=im_pad.dtype)
+            r0, r1 = max(q0,4), min(q1,n-4)
+            if r1>r0:
+                q[r0-q0:r1-q0, 4:-4] = im.array[r0-4:r1-4]
+            self.qe(galsim.Image(q), rows=slice(q0,q1))
+
+            if bfe is not None:
+                array_pad = self.saturate(galsim.Image(q.copy()), rows=slice(q0,q1)).array
+                array_pad = np.pad(array_pad[bfe_rows-q0, 4:-4], [(0,0),(6,6)], mode='symmetric')
+                bfe(array_pad, z0, q[c0-q0:c1-q0], c0, c1)
+
+            c = q[c0-q0:c1-q0]
+            if len(history)>0:
+                pre = c.copy()
+                self.persistence_rows(c, history, rows=slice(c0,c1))
+                if (self.im_pers is not None) and (max(c0,y0)<min(c1,y1)):
+                    self.im_pers[max(c0,y0):min(c1,y1)] = (c - pre)[max(c0,y0)-c0:min(c1,y1)-c0]
+            c_im = galsim.Image(c)
+            c_im.quantize()
+            if self.params['use_dark_current']:
+                c += self.im_dark[c0:c1]
+            self.saturate(c_im, rows=slice(c0,c1))
+            self.nonlinearity(c_im, rows=slice(c0,c1))
+
+            if ipc is not None:
+                array_pad = np.pad(c[ipc_rows-c0, 4:-4], [(0,0),(5,5)], mode='symmetric')
+                d = np.empty((d1-d0, n), dtype=c.dtype)
+                ipc(array_pad, d0, d, d0, d1)
+            else:
+                d = c.copy()
+            self.deadpix(galsim.Image(d), rows=slice(d0,d1))
+
+            return d
+
+        def band(y0, y1):
+            d = front(max(y0-1,0), y1, y0, y1)
+            rows = d[y0-max(y0-1,0):]
+            if vtpe is not None:
+                # VTPE differences with the row above (the last row for the first band, as in vtpe())
+                vtpe(rows, d[0] if y0>0 else front(n-1, n, n, n)[0], y0)
+            if self.params['use_read_noise']:
+                rows += self.im_read[y0:y1]
+            rows_im = galsim.Image(rows)
+            self.add_gain(rows_im, rows=slice(y0,y1))
+            self.add_bias(rows_im, rows=slice(y0,y1))
+            rows_im.quantize()
+            im_pad.array[y0:y1] = rows
+
+        run_bands(band, row_bands(n, self.band), self.threads)
+
+        return im_pad
 
     def add_effects_galsim(self,im,wt,pointing):
         """
@@ -391,19 +542,20 @@ class modify_image(object):
         return dt
 
 
-    def qe(self, im):
+    def qe(self, im, rows=slice(None)):
         """
         Apply the wavelength-independent relative QE to the image.
         Input
         im                  : Image
         RELQE1[4096,4096]   : relative QE map
+        rows                : Rows of the 4096x4096 image held by im (see add_effects_fused())
         """
 
         # If effect is turned off, return image unchanged
         if not self.params['use_qe']:
             return im
 
-        im.array[:,:] *= self.df['RELQE1'][:,:] #4096x4096 array
+        im.array[:,:] *= self.df['RELQE1'][rows] #4096x4096 array
         return im
 
 
@@ -432,127 +584,177 @@ class modify_image(object):
             return im
 
         nbfe = 2 ## kernel of bfe in shape (2 x nbfe+1)*(2 x nbfe+1)
-        bin_size = 128
-        n_max = 32
-        m_max = 32
-        num_grids = 4
-        n_sub = n_max//num_grids
-        m_sub = m_max//num_grids
-
-        ##=======================================================================
-        ##     solve boundary shfit kernel aX components
-        ##=======================================================================
-        a_area = self.df['BFE'][:,:,:,:] #5x5x32x32
-        a_components = np.zeros( (4, 2*nbfe+1, 2*nbfe+1, n_max, m_max) ) #4x5x5x32x32
-
-        ##solve aR aT aL aB for each a
-        for n in range(n_max): #m_max and n_max = 32 (binned in 128x128)
-            for m in range(m_max):
-                a = a_area[:,:, n, m] ## a in (2 x nbfe+1)*(2 x nbfe+1)
-
-                ## assume two parity symmetries
-                a = ( a + np.fliplr(a) + np.flipud(a) + np.flip(a)  )/4.
-
-                r = 0.5* ( 3.25/4.25  )**(1.5) / 1.5   ## source-boundary projection
-                B = (a[2,2], a[3,2], a[2,3], a[3,3],
-                     a[4,2], a[2,4], a[3,4], a[4,4] )
-
-                A = np.array( [ [ -2 , -2 ,  0 ,  0 ,  0 ,  0 ,  0 ],
-                                [  0 ,  1 ,  0 , -1 , -2 ,  0 ,  0 ],
-                                [  1 ,  0 , -1 ,  0 , -2 ,  0 ,  0 ],
-                                [  0 ,  0 ,  0 ,  0 ,  2 , -2 ,  0 ],
-                                [  0 ,  0 ,  0 ,  1 ,  0 ,-2*r,  0 ],
-                                [  0 ,  0 ,  1 ,  0 ,  0 ,-2*r,  0 ],
-                                [  0 ,  0 ,  0 ,  0 ,  0 , 1+r, -1 ],
-                                [  0 ,  0 ,  0 ,  0 ,  0 ,  0 ,  2 ]  ])
-
-
-                s1,s2,s3,s4,s5,s6,s7 = np.linalg.lstsq(A, B, rcond=None)[0]
-
-                aR = np.array( [[ 0.   , -s7  ,-r*s6 , r*s6 ,  s7  ],
-                                [ 0.   , -s6  , -s5  ,  s5  ,  s6  ],
-                                [ 0.   , -s3  , -s1  ,  s1  ,  s3  ],
-                                [ 0.   , -s6  , -s5  ,  s5  ,  s6  ],
-                                [ 0.   , -s7  ,-r*s6 , r*s6 ,  s7  ],])
-
-
-                aT = np.array( [[   0.  ,  0. ,  0.  ,   0. ,   0.   ],
-                                [  -s7  , -s6 , -s4  , -s6  ,  -s7   ],
-                                [ -r*s6 , -s5 , -s2  , -s5  , -r*s6  ],
-                                [  r*s6 ,  s5 ,  s2  ,  s5  ,  r*s6  ],
-                                [   s7  ,  s6 ,  s4  ,  s6  ,   s7   ],])
-
-
-                aL = aR[::-1, ::-1]
-                aB = aT[::-1, ::-1]
-
-
-
-
-                a_components[0, :,:, n, m] = aR[:,:]
-                a_components[1, :,:, n, m] = aT[:,:]
-                a_components[2, :,:, n, m] = aL[:,:]
-                a_components[3, :,:, n, m] = aB[:,:]
 
         ##=============================
         ## Apply bfe to image
         ##=============================
 
-        ## pad and expand kernels
         ## The img is clipped by the saturation level here to cap the brighter fatter effect and avoid unphysical behavior
 
         array_pad = self.saturate(im.copy()).array[4:-4,4:-4] # img of interest 4088x4088
         array_pad = np.pad(array_pad, [(4+nbfe,4+nbfe),(4+nbfe,4+nbfe)], mode='symmetric') #4100x4100 array
 
+        apply = self.bfe_kernel(nbfe=nbfe)
+        run_bands(lambda y0,y1: apply(array_pad, 0, im.array[y0:y1], y0, y1), row_bands(im.array.shape[0], self.band), self.threads)
 
-        dQ_components = np.zeros( (4, bin_size*n_max, bin_size*m_max) )   #(4, 4096, 4096) in order of [aR, aT, aL, aB]
+        return im
 
+    def bfe_sky(self, im):
+        """
+        Apply the brighter-fatter effect of a smooth (sky) image. BFE is quadratic in the charge, so for a locally uniform charge Q it changes each pixel by Q^2 times the response of the SCA to a unit illumination, which is nonzero where the binned kernel changes and at the edges. That response is made once per SCA file with bfe() and kept with the calibration products. The BFE of the fluctuations of the image about its local mean is left out.
 
-        ### run in sub grids to reduce memory
+        Input
+        im : Image
+        """
 
-        ## pad and expand kernels
-        t = np.zeros((bin_size*n_sub, n_sub))
-        for row in range(t.shape[0]):
-            t[row, row//(bin_size) ] =1
+        if not self.params['use_bfe']:
+            return im
 
+        array = self.saturate(im.copy()).array
+        array = np.pad(array[4:-4,4:-4], 4, mode='symmetric')
+        im.array[:,:] += array**2 * self.df.load('BFE_SKY', self.bfe_unit_response)
 
+        return im
 
-        for gj in range(num_grids):
-            for gi in range(num_grids):
+    def bfe_unit_response(self):
+        """
+        Return the change of each pixel of the 4096x4096 image made by bfe() for a unit illumination of the 4088x4088 science pixels (float32).
+        """
 
-                a_components_pad = np.zeros( (4, 2*nbfe+1, 2*nbfe+1, bin_size*n_sub+2*nbfe, bin_size*m_sub+2*nbfe)  ) #(4,5,5,sub_grid,sub_grid)
+        bound_pad = galsim.BoundsI( xmin=1, ymin=1,
+                                    xmax=4096, ymax=4096)
+        unit = galsim.Image(bound_pad)
+        unit.array[4:-4, 4:-4] = 1.
 
+        return (self.bfe(unit.copy()).array - unit.array).astype(np.float32)
 
-                for comp in range(4):
-                    for j in range(2*nbfe+1):
-                        for i in range(2*nbfe+1):
-                            tmp = (t.dot(  a_components[comp,j,i,gj*n_sub:(gj+1)*n_sub,gi*m_sub:(gi+1)*m_sub]  ) ).dot(t.T) #sub_grid*sub_grid
-                            a_components_pad[comp, j, i, :, :] = np.pad(tmp, [(nbfe,nbfe),(nbfe,nbfe)], mode='symmetric')
+    def bfe_kernel(self, nbfe=2):
+        """
+        Return a function apply(array_pad, p0, out, y0, y1) that applies BFE to rows y0 to y1 of the 4096x4096 image, held in out. array_pad holds rows of the saturated image padded as in bfe(), starting at padded row p0; rows max(y0-1,0) to min(y1+1,4096)+2*nbfe are used.
+
+        Input
+        nbfe : Half-width of the kernel
+        """
 
+        bin_size = 128
+        n_max = 32
+        m_max = 32
+        num_grids = 4
+        n_sub = n_max//num_grids
+        m_sub = m_max//num_grids
+
+        a_components = self.bfe_components(nbfe=nbfe) #4x5x5x32x32
+
+        ## The coefficients stay binned in bin_size blocks. Each term uses the coefficient of the source pixel, clipped to the sub grid of the output pixel.
+        n = bin_size*n_max
+        offsets = [(dy,dx) for dy in range(-nbfe, nbfe+1) for dx in range(-nbfe, nbfe+1)]
+        row_index = [block_index(n, bin_size, dy, bin_size*n_sub) for dy,dx in offsets]
+        col_index = [block_index(n, bin_size, dx, bin_size*m_sub) for dy,dx in offsets]
+        src_offsets = [(nbfe-dy, nbfe-dx) for dy,dx in offsets]
+
+        def apply(array_pad, p0, out, y0, y1):
+            # dQ in order of [aR, aT, aL, aB], with one extra row each side for the aT and aB boundary shifts
+            z0 = max(y0-1, 0)
+            z1 = min(y1+1, n)
+            dQ_components = np.zeros( (4, z1-z0, n) )
+            for comp in range(4):
                 #convolve aX_ij with Q_ij
-                for comp in range(4):
-                    for dy in range(-nbfe, nbfe+1):
-                        for dx in range(-nbfe, nbfe+1):
-                            dQ_components[comp, gj*bin_size*n_sub : (gj+1)*bin_size*n_sub , gi*bin_size*m_sub : (gi+1)*bin_size*m_sub]\
-                         += a_components_pad[comp, nbfe+dy, nbfe+dx,  nbfe-dy:nbfe-dy+bin_size*n_sub, nbfe-dx:nbfe-dx+bin_size*m_sub ]\
-                            *array_pad[  -dy + nbfe + gj*bin_size*n_sub :  -dy + nbfe+ (gj+1)*bin_size*n_sub  ,  -dx + nbfe + gi*bin_size*m_sub : -dx + nbfe + (gi+1)*bin_size*m_sub ]
+                coeffs = [a_components[comp, nbfe+dy, nbfe+dx] for dy,dx in offsets]
+                block_stencil(array_pad, coeffs, row_index, col_index, src_offsets, z0, z1, dQ_components[comp], src0=p0)
 
-                    dj = int(np.sin(comp*np.pi/2))
-                    di = int(np.cos(comp*np.pi/2))
+                dj = int(np.sin(comp*np.pi/2))
+                di = int(np.cos(comp*np.pi/2))
 
-                    dQ_components[comp, gj*bin_size*n_sub : (gj+1)*bin_size*n_sub , gi*bin_size*m_sub : (gi+1)*bin_size*m_sub]\
-                    *= 0.5*(array_pad[   nbfe + gj*bin_size*n_sub :    nbfe+ (gj+1)*bin_size*n_sub  ,    nbfe + gi*bin_size*m_sub :    nbfe + (gi+1)*bin_size*m_sub ] +\
-                            array_pad[dj+nbfe + gj*bin_size*n_sub : dj+nbfe+ (gj+1)*bin_size*n_sub  , di+nbfe + gi*bin_size*m_sub : di+nbfe + (gi+1)*bin_size*m_sub]  )
+                dQ_components[comp] *= 0.5*(array_pad[   nbfe+z0-p0:   nbfe+z1-p0,    nbfe:   nbfe+n] +\
+                                            array_pad[dj+nbfe+z0-p0:dj+nbfe+z1-p0, di+nbfe:di+nbfe+n])
 
-        im.array[:,:]  -= dQ_components.sum(axis=0)
-        im.array[:,1:] += dQ_components[0][:,:-1]
-        im.array[1:,:] += dQ_components[1][:-1,:]
-        im.array[:,:-1] += dQ_components[2][:,1:]
-        im.array[:-1,:] += dQ_components[3][1:,:]
+            r0 = y0-z0
+            r1 = y1-z0
+            ys = max(y0, 1)
+            ye = min(y1, n-1)
+            out[:,:]          -= dQ_components[:,r0:r1].sum(axis=0)
+            out[:,1:]         += dQ_components[0,r0:r1,:-1]
+            out[ys-y0:,:]     += dQ_components[1,ys-1-z0:r1-1]
+            out[:,:-1]        += dQ_components[2,r0:r1,1:]
+            out[:ye-y0,:]     += dQ_components[3,r0+1:ye+1-z0]
 
+        return apply
 
-        return im
+    def bfe_components(self, nbfe=2):
+        """
+        Return the boundary shift kernels aR, aT, aL, aB (4 x 2*nbfe+1 x 2*nbfe+1 x 32 x 32) solved from the BFE kernel of total pixel area change in the SCA file (see bfe()). The constrained least-squares problem has the same matrix for all 32x32 kernels, so its pseudo-inverse is computed once and applied to all of them together. The result is kept in memory and cached on disk next to the SCA file (or in tmpdir if that directory is not writable), and recomputed if the SCA file is newer than the cache.
 
+        Input
+        nbfe : Half-width of the kernel
+        """
+
+        if self.sca_filename in bfe_cache:
+            return bfe_cache[self.sca_filename]
+
+        mtime = os.path.getmtime(self.sca_filename)
+        cache_files = [self.sca_filename+'.bfe.npz']
+        if self.params.get('tmpdir',None) is not None:
+            cache_files.append(os.path.join(self.params['tmpdir'],os.path.basename(self.sca_filename)+'.bfe.npz'))
+        for cache_file in cache_files:
+            if os.path.exists(cache_file):
+                # A cache that can't be read is recomputed
+                try:
+                    with np.load(cache_file) as cache:
+                        if cache['mtime']==mtime:
+                            bfe_cache[self.sca_filename] = cache['a_components']
+                            return bfe_cache[self.sca_filename]
+                except Exception:
+                    print('Could not read BFE cache '+cache_file)
+
+        a = self.df['BFE'][:,:,:,:] #5x5x32x32
+
+        ## assume two parity symmetries
+        a = ( a + a[:,::-1] + a[::-1,:] + a[::-1,::-1] )/4.
+
+        r = 0.5* ( 3.25/4.25  )**(1.5) / 1.5   ## source-boundary projection
+        B = np.array([a[2,2], a[3,2], a[2,3], a[3,3],
+                      a[4,2], a[2,4], a[3,4], a[4,4]]) #8x32x32
+
+        A = np.array( [ [ -2 , -2 ,  0 ,  0 ,  0 ,  0 ,  0 ],
+                        [  0 ,  1 ,  0 , -1 , -2 ,  0 ,  0 ],
+                        [  1 ,  0 , -1 ,  0 , -2 ,  0 ,  0 ],
+                        [  0 ,  0 ,  0 ,  0 ,  2 , -2 ,  0 ],
+                        [  0 ,  0 ,  0 ,  1 ,  0 ,-2*r,  0 ],
+                        [  0 ,  0 ,  1 ,  0 ,  0 ,-2*r,  0 ],
+                        [  0 ,  0 ,  0 ,  0 ,  0 , 1+r, -1 ],
+                        [  0 ,  0 ,  0 ,  0 ,  0 ,  0 ,  2 ]  ])
+
+        ## Same (minimum norm) least-squares solution as np.linalg.lstsq for each kernel
+        s1,s2,s3,s4,s5,s6,s7 = np.einsum('ij,jnm->inm', np.linalg.pinv(A), B)
+        z = np.zeros_like(s1)
+
+        aR = np.array( [[   z   , -s7  ,-r*s6 , r*s6 ,  s7  ],
+                        [   z   , -s6  , -s5  ,  s5  ,  s6  ],
+                        [   z   , -s3  , -s1  ,  s1  ,  s3  ],
+                        [   z   , -s6  , -s5  ,  s5  ,  s6  ],
+                        [   z   , -s7  ,-r*s6 , r*s6 ,  s7  ],])
+
+        aT = np.array( [[   z   ,   z  ,   z  ,   z  ,   z   ],
+                        [  -s7  , -s6  , -s4  , -s6  ,  -s7  ],
+                        [ -r*s6 , -s5  , -s2  , -s5  , -r*s6 ],
+                        [  r*s6 ,  s5  ,  s2  ,  s5  ,  r*s6 ],
+                        [   s7  ,  s6  ,  s4  ,  s6  ,   s7  ],])
+
+        a_components = np.array([aR, aT, aR[::-1,::-1], aT[::-1,::-1]]) #4x5x5x32x32
+
+        for cache_file in cache_files:
+            try:
+                # Other procs may be writing the same cache, so each writes its own file and moves it into place
+                tmp = cache_file+'.'+str(os.getpid())+'.tmp'
+                with open(tmp,'wb') as f:
+                    np.savez(f, a_components=a_components, mtime=mtime)
+                os.replace(tmp,cache_file)
+                break
+            except OSError:
+                continue
+
+        bfe_cache[self.sca_filename] = a_components
+        return a_components
 
     def get_eff_sky_bg(self,pointing,radec):
         """
@@ -589,6 +791,10 @@ class modify_image(object):
         self.rng       = rng
         self.noise     = galsim.PoissonNoise(self.rng)
         self.rng_np    = np.random.default_rng(self.params['random_seed'])
+        # With tiled_noise, dark current and read noise are drawn in tiles of noise_tile rows from independent streams, so the realisation does not depend on detector_threads
+        self.tiled_noise = self.params.get('tiled_noise',False)
+        self.noise_tile  = self.params.get('noise_tile',256)
+        self.dark_seed, self.read_seed = np.random.SeedSequence(self.params['random_seed']).spawn(2)
         if self.df is None:
             self.dark_current_ = roman.dark_current*roman.exptime
         else:
@@ -704,7 +910,13 @@ class modify_image(object):
         if not self.params['use_dark_current']:
             return im
 
-        if self.df is None:
+        if self.tiled_noise:
+            # drawn tile by tile, without a full size copy of the mean or image
+            lam = self.dark_current_ if np.ndim(self.dark_current_)==0 else self.dark_current_.reshape(im.array.shape)
+            self.im_dark = np.empty(im.array.shape, dtype=im.dtype)
+            poisson_tiles(lam, self.im_dark, self.dark_seed, add_to=im.array, tile=self.noise_tile, threads=self.threads)
+
+        elif self.df is None:
             self.im_dark = im.copy()
             dark_current_ = self.dark_current_
             dark_noise = galsim.DeviateNoise(galsim.PoissonDeviate(self.rng, dark_current_))
@@ -726,12 +938,13 @@ class modify_image(object):
 
         return im
 
-    def saturate(self, im, saturation=100000):
+    def saturate(self, im, saturation=100000, rows=slice(None)):
         """
         Clip the saturation level
         Input
         im                     : image
         SATURATE[4096,4096]    : saturation map
+        rows                   : Rows of the 4096x4096 image held by im (see add_effects_fused())
         """
 
         if not self.params['use_saturate']:
@@ -740,25 +953,26 @@ class modify_image(object):
         if self.df is None:
             saturation_array = np.ones_like(im.array)*saturation
         else:
-            saturation_array = self.df['SATURATE'][:,:] #4096x4096 array
+            saturation_array = self.df['SATURATE'][rows] #4096x4096 array
         where_sat = np.where(im.array > saturation_array)
         im.array[ where_sat ] = saturation_array[ where_sat ]
 
         return im
 
 
-    def deadpix(self, im):
+    def deadpix(self, im, rows=slice(None)):
         """
         Apply dead pixel mask
         Input
         im                   : image
         BADPIX[4096,4096]    : bit mask with the first bit flags dead pixels
+        rows                 : Rows of the 4096x4096 image held by im (see add_effects_fused())
         """
 
         if not self.params['use_dead_pixel']:
             return im
 
-        dead_mask = self.df['BADPIX'][:,:]&1 #4096x4096 array
+        dead_mask = self.df['BADPIX'][rows]&1 #4096x4096 array
         im.array[ dead_mask>0 ]=0
 
         return im
@@ -780,24 +994,43 @@ class modify_image(object):
         if not self.params['use_vtpe']:
             return im
 
-        # expand 512x512 arrays to 4096x4096
+        apply = self.vtpe_kernel()
+        if apply is None:
+            return im
+
+        # The differences need the unmodified row above each band
+        bands = row_bands(im.array.shape[0], self.band)
+        above = [im.array[y0-1].copy() for y0,y1 in bands]
+
+        run_bands(lambda y0,y1: apply(im.array[y0:y1], above[y0//self.band], y0), bands, self.threads)
+        return im
+
+    def vtpe_kernel(self):
+        """
+        Return a function apply(rows, above, y0) that applies VTPE to the rows of the image starting at row y0, given the row above them (the last row for y0=0, as np.roll() wraps around), or None if the VTPE coefficients are not usable.
+        """
 
-        t = np.zeros((4096, 512))
-        for row in range(t.shape[0]):
-            t[row, row//8] =1
-        a_vtpe = t.dot(self.df['VTPE'][0,:,:][0]).dot(t.T)
+        # 512x512 arrays binned in 8x8 blocks of the 4096x4096 image
+        a_vtpe = self.df['VTPE'][0].astype(float)
         ## NaN check
         if np.isnan(a_vtpe).any():
             print("vtpe skipped due to NaN in file")
-            return im
-        b_vtpe = t.dot(self.df['VTPE'][1,:,:][0]).dot(t.T)
-        dQ0 = t.dot(self.df['VTPE'][2,:,:][0]).dot(t.T)
+            return None
+        b_vtpe = self.df['VTPE'][1].astype(float)
+        dQ0 = self.df['VTPE'][2].astype(float)
+        index = block_index(4096, 8)
 
-        dQ = im.array - np.roll(im.array, 1, axis=0)
-        dQ[0,:] *= 0
+        def apply(rows, above, y0):
+            y1 = y0+len(rows)
+            dQ = np.empty_like(rows)
+            dQ[1:] = rows[1:] - rows[:-1]
+            dQ[0] = rows[0] - above
+            if y0==0:
+                dQ[0,:] *= 0
 
-        im.array[:,:] += dQ * ( a_vtpe + b_vtpe * np.log( 1. + np.abs(dQ)/dQ0 ))
-        return im
+            rows += dQ * ( block_expand(a_vtpe, index[y0:y1], index) + block_expand(b_vtpe, index[y0:y1], index) * np.log( 1. + np.abs(dQ)/block_expand(dQ0, index[y0:y1], index) ))
+
+        return apply
 
 
     def add_persistence(self, im, pointing):
@@ -813,113 +1046,143 @@ class modify_image(object):
         im                    : image
         pointing              : pointing object
         """
+        self.im_pers = None
         if not self.params['use_persistence']:
             return im
 
-        # load the dithers of sky images that were simulated
-        dither_sca_array=np.loadtxt(self.params['dither_from_file']).astype(int)
+        # Persistence does not depend on the current exposure, so it is kept for the sky image (see finalize_sky_im())
+        if self.params.get('sky_response','full')=='single':
+            self.im_pers = im.array.copy()
 
-        # select adjacent exposures for the same sca (within 10*roman.exptime)
-        dither_list_selected = dither_sca_array[dither_sca_array[:,1]==pointing.sca, 0]
-        dither_list_selected = dither_list_selected[ np.abs(dither_list_selected-pointing.dither)<10  ]
-        p_list = np.array([Pointing(self.params,None,filter_=None,sca=pointing.sca,dither=i) for i in dither_list_selected])
-        dt_list = np.array([(pointing.date-p.date).total_seconds() for p in p_list])
-        p_pers = p_list[ np.where((dt_list>0) & (dt_list < roman.exptime*10))]
+        history = self.persistence_history(pointing)
 
         if self.df is None:
             #iterate over previous exposures
-            for p in p_pers:
-                dt = (pointing.date-p.date).total_seconds() - roman.exptime/2 ##avg time since end of exposures
-                fn = get_filename(self.params['out_path'],
-                                'images',
-                                self.params['output_meds'],
-                                var=p.filter+'_'+str(p.dither),
-                                name2=str(p.sca),
-                                ftype='fits.gz',
-                                overwrite=False)
-
-                ## apply all the effects that occured before persistence on the previouse exposures
-                ## since max of the sky background is of order 100, it is thus negligible for persistence
-                bound_pad = galsim.BoundsI( xmin=1, ymin=1,
-                                            xmax=4088, ymax=4088)
-                x = galsim.Image(bound_pad)
-                x.array[:,:] = galsim.Image(fio.FITS(fn)['SCI'].read()).array[:,:]
-                x = self.recip_failure(x)
-
-                x = x.clip(0) ##remove negative stimulus
-
-                im.array[:,:] += galsim.roman.roman_detectors.fermi_linear(x.array, dt)*roman.exptime
+            for dt,x in history:
+                im.array[:,:] += galsim.roman.roman_detectors.fermi_linear(x, dt)*roman.exptime
 
         else:
+            self.persistence_rows(im.array, history)
 
-            #setup parameters for persistence
-            Q01 = self.df['PERSIST'].read_header()['Q01']
-            Q02 = self.df['PERSIST'].read_header()['Q02']
-            Q03 = self.df['PERSIST'].read_header()['Q03']
-            Q04 = self.df['PERSIST'].read_header()['Q04']
-            Q05 = self.df['PERSIST'].read_header()['Q05']
-            Q06 = self.df['PERSIST'].read_header()['Q06']
-            alpha = self.df['PERSIST'].read_header()['ALPHA']
+        if self.im_pers is not None:
+            self.im_pers = im.array - self.im_pers
 
-            #iterate over previous exposures
-            for p in p_pers:
-                dt = (pointing.date-p.date).total_seconds() - roman.exptime/2 ##avg time since end of exposures
-                fac_dt = (roman.exptime/2.)/dt  ##linear time dependence (approximate until we get t1 and Delat t of the data)
-                fn = get_filename(self.params['out_path'],
-                                'images',
-                                self.params['output_meds'],
-                                var=p.filter+'_'+str(p.dither),
-                                name2=str(p.sca),
-                                ftype='fits.gz',
-                                overwrite=False)
-
-                ## apply all the effects that occured before persistence on the previouse exposures
-                ## since max of the sky background is of order 100, it is thus negligible for persistence
-                ## same for brighter fatter effect
-                bound_pad = galsim.BoundsI( xmin=1, ymin=1,
-                                            xmax=4096, ymax=4096)
-                x = galsim.Image(bound_pad)
-                x.array[4:-4, 4:-4] = galsim.Image(fio.FITS(fn)['SCI'].read()).array[:,:]
-                x = self.qe(x).array[:,:]
-
-                x = x.clip(0.1) ##remove negative and zero stimulus
-
-                ## Do linear interpolation
-                a = np.zeros(x.shape)
-                a += ((x < Q01)) * x/Q01
-                a += ((x >= Q01) & (x < Q02)) * (Q02-x)/(Q02-Q01)
-                im.array[:,:] += a*self.df['PERSIST'][0,:,:][0]*fac_dt
-
-
-                a = np.zeros(x.shape)
-                a += ((x >= Q01) & (x < Q02)) * (x-Q01)/(Q02-Q01)
-                a += ((x >= Q02) & (x < Q03)) * (Q03-x)/(Q03-Q02)
-                im.array[:,:] += a*self.df['PERSIST'][1,:,:][0]*fac_dt
-
-                a = np.zeros(x.shape)
-                a += ((x >= Q02) & (x < Q03)) * (x-Q02)/(Q03-Q02)
-                a += ((x >= Q03) & (x < Q04)) * (Q04-x)/(Q04-Q03)
-                im.array[:,:] += a*self.df['PERSIST'][2,:,:][0]*fac_dt
-
-                a = np.zeros(x.shape)
-                a += ((x >= Q03) & (x < Q04)) * (x-Q03)/(Q04-Q03)
-                a += ((x >= Q04) & (x < Q05)) * (Q05-x)/(Q05-Q04)
-                im.array[:,:] += a*self.df['PERSIST'][3,:,:][0]*fac_dt
-
-                a = np.zeros(x.shape)
-                a += ((x >= Q04) & (x < Q05)) * (x-Q04)/(Q05-Q04)
-                a += ((x >= Q05) & (x < Q06)) * (Q06-x)/(Q06-Q05)
-                im.array[:,:] += a*self.df['PERSIST'][4,:,:][0]*fac_dt
-
-                a = np.zeros(x.shape)
-                a += ((x >= Q05) & (x < Q06)) * (x-Q05)/(Q06-Q05)
-                a += ((x >= Q06)) * (x/Q06)**alpha       ##avoid fractional power of negative values
-                im.array[:,:] += a*self.df['PERSIST'][5,:,:][0]*fac_dt
+        return im
 
+    def persistence_rows(self, array, history, rows=slice(None)):
+        """
+        Add the persistence of the SCA file model to rows of the 4096x4096 image.
 
-        return im
+        Input
+        array   : Image array
+        history : Previous exposures, see persistence_history()
+        rows    : Rows of the 4096x4096 image held by array (see add_effects_fused())
+        """
+
+        #setup parameters for persistence
+        header = self.df.header('PERSIST')
+        Q = [0.]+[header[q] for q in ['Q01','Q02','Q03','Q04','Q05','Q06']]
+        alpha = header['ALPHA']
+        persist = self.df['PERSIST'][:,rows] #6x4096x4096
+
+        #iterate over previous exposures
+        for dt,x in history:
+            x = x[rows]
+            fac_dt = (roman.exptime/2.)/dt  ##linear time dependence (approximate until we get t1 and Delat t of the data)
+
+            ## Linear interpolation between the PERSIST planes at stimulus Q01...Q06 (and 0), with a power law above Q06.
+            ## Each pixel lies in one segment [Q0k, Q0k+1), so it only gets the falling part of plane k-1 and the rising part of plane k.
+            nodes = np.array(Q, dtype=x.dtype)
+            width = np.array([Q[k+1]-Q[k] for k in range(6)], dtype=x.dtype)
+            seg = np.searchsorted(nodes[1:], x, side='right') # 0 below Q01, 6 above Q06
+            k = np.minimum(seg, 5)
+
+            fall = np.where((seg>0)&(seg<6), (nodes[k+1]-x)/width[k], 0).astype(float)
+            array[:,:] += fall*np.take_along_axis(persist, np.maximum(seg-1,0)[None], axis=0)[0]*fac_dt
+
+            rise = np.where(seg<6, (x-nodes[k])/width[k], (x/Q[6])**alpha).astype(float)
+            array[:,:] += rise*np.take_along_axis(persist, k[None], axis=0)[0]*fac_dt
+
+    def persistence_history(self, pointing):
+        """
+        Return (dt, stimulus) for the previous exposures of this SCA within 10 exposure times, where dt is the average time since the end of the exposure. The exposure list is read once per process, and the stimulus map of each previous exposure is kept in persistence_cache for the following exposures of the SCA, until it is too old to persist or another SCA is simulated.
+
+        Input
+        pointing : Pointing object
+        """
+
+        # load the dithers of sky images that were simulated
+        if self.params['dither_from_file'] not in dither_sca_cache:
+            dither_sca_cache[self.params['dither_from_file']] = np.loadtxt(self.params['dither_from_file']).astype(int)
+        dither_sca_array = dither_sca_cache[self.params['dither_from_file']]
+
+        # select adjacent exposures for the same sca (within 10*roman.exptime). Only their dates and filters are needed, so no SCA (WCS, PSF) is set up.
+        dither_list_selected = dither_sca_array[dither_sca_array[:,1]==pointing.sca, 0]
+        dither_list_selected = dither_list_selected[ np.abs(dither_list_selected-pointing.dither)<10  ]
+        p_list = [Pointing(self.params,None,filter_=None,dither=i) for i in dither_list_selected]
+        p_pers = [p for p in p_list if 0 < (pointing.date-p.date).total_seconds() < roman.exptime*10]
+
+        # Only the maps of the current SCA are kept, so a process simulating many SCAs doesn't accumulate them
+        key = (self.get_path_name(), pointing.sca)
+        for k in list(persistence_cache):
+            if k != key:
+                del persistence_cache[k]
+        cache = persistence_cache.setdefault(key, {})
+        for dither in list(cache):
+            if dither not in [p.dither for p in p_pers]:
+                del cache[dither]
+
+        history = []
+        for p in p_pers:
+            if p.dither not in cache:
+                cache[p.dither] = self.persistence_stimulus(p, pointing.sca)
+            dt = (pointing.date-p.date).total_seconds() - roman.exptime/2 ##avg time since end of exposures
+            history.append((dt, cache[p.dither]))
+
+        return history
+
+    def persistence_stimulus(self, p, sca):
+        """
+        Return the stimulus map of a previous exposure for persistence, from its output image.
 
-    def nonlinearity(self,im,NLfunc=roman.NLfunc):
+        Input
+        p   : Pointing object of the previous exposure
+        sca : SCA number
+        """
+
+        fn = get_filename(self.params['out_path'],
+                        'images',
+                        self.params['output_meds'],
+                        var=p.filter+'_'+str(p.dither),
+                        name2=str(sca),
+                        ftype='fits.gz',
+                        overwrite=False)
+
+        if self.df is None:
+            ## apply all the effects that occured before persistence on the previouse exposures
+            ## since max of the sky background is of order 100, it is thus negligible for persistence
+            bound_pad = galsim.BoundsI( xmin=1, ymin=1,
+                                        xmax=4088, ymax=4088)
+            x = galsim.Image(bound_pad)
+            x.array[:,:] = galsim.Image(fio.FITS(fn)['SCI'].read()).array[:,:]
+            x = self.recip_failure(x)
+
+            x = x.clip(0) ##remove negative stimulus
+
+            return x.array
+
+        ## apply all the effects that occured before persistence on the previouse exposures
+        ## since max of the sky background is of order 100, it is thus negligible for persistence
+        ## same for brighter fatter effect
+        bound_pad = galsim.BoundsI( xmin=1, ymin=1,
+                                    xmax=4096, ymax=4096)
+        x = galsim.Image(bound_pad)
+        x.array[4:-4, 4:-4] = galsim.Image(fio.FITS(fn)['SCI'].read()).array[:,:]
+        x = self.qe(x).array[:,:]
+
+        return x.clip(0.1) ##remove negative and zero stimulus
+
+    def nonlinearity(self,im,NLfunc=roman.NLfunc,rows=slice(None)):
         """
         Applying a quadratic non-linearity.
 
@@ -933,6 +1196,7 @@ class modify_image(object):
         Input
         im     : Image
         NLfunc : Nonlinearity function
+        rows   : Rows of the 4096x4096 image held by im (see add_effects_fused())
         """
 
         # If effect is turned off, return image unchanged
@@ -945,9 +1209,9 @@ class modify_image(object):
         if self.df is None:
             im.applyNonlinearity(NLfunc=NLfunc)
         else:
-            im.array[:,:] -= self.df['CNL'][0,:,:][0] * im.array**2 +\
-                             self.df['CNL'][1,:,:][0] * im.array**3 +\
-                             self.df['CNL'][2,:,:][0] * im.array**4
+            im.array[:,:] -= self.df['CNL'][0][rows] * im.array**2 +\
+                             self.df['CNL'][1][rows] * im.array**3 +\
+                             self.df['CNL'][2][rows] * im.array**4
 
         return im
 
@@ -975,38 +1239,36 @@ class modify_image(object):
             im.applyIPC(kernel, edge_treatment='extend', fill_value=None)
         else:
             # pad the array by one pixel at the four edges
-            num_grids = 4  ### num_grids <= 8
-            grid_size = 4096//num_grids
-
             array_pad = im.array[4:-4,4:-4] #it's an array instead of img
             array_pad = np.pad(array_pad, [(5,5),(5,5)], mode='symmetric') #4098x4098 array
 
-            K = self.df['IPC'][:,:,:,:]  ##3,3,512, 512
+            apply = self.ipc_kernel()
+            run_bands(lambda y0,y1: apply(array_pad, 0, im.array[y0:y1], y0, y1), row_bands(4096, self.band), self.threads)
+        return im
 
-            t = np.zeros((grid_size, 512))
-            for row in range(t.shape[0]):
-                t[row, row//( grid_size//512) ] =1
+    def ipc_kernel(self):
+        """
+        Return a function apply(array_pad, p0, out, y0, y1) that sets out to rows y0 to y1 of the image with the SCA file IPC applied. array_pad holds rows of the image padded as in interpix_cap(), starting at padded row p0; rows y0 to y1+2 are used.
+        """
 
-            array_out = np.zeros( (4096, 4096))
-            ##split job in sub_grids to reduce memory
-            for gj in range(num_grids):
-                for gi in range(num_grids):
-                    K_pad = np.zeros( (3,3, grid_size+2, grid_size+2) )
+        num_grids = 4  ### num_grids <= 8
+        grid_size = 4096//num_grids
 
-                    for j in range(3):
-                        for i in range(3):
-                            tmp = (t.dot(K[j,i,:,:])).dot(t.T) #grid_sizexgrid_size
-                            K_pad[j,i,:,:] = np.pad(tmp, [(1,1),(1,1)], mode='symmetric')
+        K = self.df['IPC'][:,:,:,:].astype(float)  ##3,3,512, 512
 
-                    for dy in range(-1, 2):
-                        for dx in range(-1,2):
+        ## Each sub grid maps onto the whole 512x512 kernel map, in blocks of grid_size//512. Each term uses the kernel of the source pixel, clipped to the sub grid of the output pixel.
+        offsets = [(dy,dx) for dy in range(-1, 2) for dx in range(-1, 2)]
+        coeffs = [K[1+dy, 1+dx] for dy,dx in offsets]
+        row_index = [block_index(4096, grid_size//512, dy, grid_size)%512 for dy,dx in offsets]
+        col_index = [block_index(4096, grid_size//512, dx, grid_size)%512 for dy,dx in offsets]
+        src_offsets = [(1-dy, 1-dx) for dy,dx in offsets]
 
-                            array_out[ gj*grid_size: (gj+1)*grid_size, gi*grid_size:(gi+1)*grid_size]\
-                          +=K_pad[ 1+dy, 1+dx, 1-dy: 1-dy+grid_size, 1-dx:1-dx+grid_size ] \
-                            *array_pad[1-dy+gj*grid_size: 1-dy+(gj+1)*grid_size, 1-dx+gi*grid_size:1-dx+(gi+1)*grid_size]
+        def apply(array_pad, p0, out, y0, y1):
+            array_out = np.zeros( (y1-y0, 4096))
+            block_stencil(array_pad, coeffs, row_index, col_index, src_offsets, y0, y1, array_out, src0=p0)
+            out[:,:] = array_out
 
-            im.array[:,:] = array_out
-        return im
+        return apply
 
     def add_read_noise(self,im):
         """
@@ -1024,7 +1286,11 @@ class modify_image(object):
             return im
 
         # Create noise realisation and apply it to image
-        if self.df is None:
+        if self.tiled_noise:
+            read_noise = roman.read_noise if self.df is None else self.df['READ'][2,:,:] #4096x4096 array
+            self.im_read = np.empty(im.array.shape, dtype=im.dtype)
+            gaussian_tiles(read_noise, self.im_read, self.read_seed, add_to=im.array, tile=self.noise_tile, threads=self.threads)
+        elif self.df is None:
             self.im_read = im.copy()
             im.addNoise(self.read_noise)
             self.im_read = im - self.im_read
@@ -1056,46 +1322,40 @@ class modify_image(object):
             return im/roman.gain
         else:
             bias = self.df['BIAS'][:,:] #4096x4096 img
-            t = np.zeros((4096, 32))
-            for row in range(t.shape[0]):
-                t[row, row//128] =1
-            gain_expand = (t.dot(self.gain)).dot(t.T) #4096x4096 gain img
+            gain_expand = self.df.expand('GAIN',128) #4096x4096 gain img
             im.array[:,:] = im.array/gain_expand + bias
             return im
 
 
-    def add_gain(self,im):
+    def add_gain(self,im,rows=slice(None)):
         """
         We divide by the gain to convert from e- to ADU.
         Input
         im : image
         GAIN : 32x32 float img in unit of e-/adu, mean(GAIN)~ 1.6
+        rows : Rows of the 4096x4096 image held by im (see add_effects_fused())
         """
 
         if not self.params['use_gain']:
             return im
 
-        gain = self.df['GAIN'][:,:] #32x32 img
-
-        t = np.zeros((4096, 32))
-        for row in range(t.shape[0]):
-            t[row, row//128] =1
-        gain_expand = (t.dot(gain)).dot(t.T) #4096x4096 gain img
-        im.array[:,:] /= gain_expand
+        gain_expand = self.df.expand('GAIN',128) #4096x4096 img of the 32x32 GAIN map
+        im.array[:,:] /= gain_expand[rows]
         return im
 
-    def add_bias(self,im):
+    def add_bias(self,im,rows=slice(None)):
         """
         Add the voltage bias.
         Input
         im : image
         BIAS : 4096x4096 uint16 bias img (in unit of DN), mean(bias) ~ 6.7k
+        rows : Rows of the 4096x4096 image held by im (see add_effects_fused())
         """
 
         if not self.params['use_bias']:
             return im
 
-        bias = self.df['BIAS'][:,:] #4096x4096 img
+        bias = self.df['BIAS'][rows] #4096x4096 img
 
         im.array[:,:] +=  bias
         return im
@@ -1117,28 +1377,57 @@ class modify_image(object):
             im = self.e_to_ADU(im)
             im.quantize()
         else:
+            single = self.params.get('sky_response','full')=='single'
+            sky_im = self.sky_response(im.copy(), pointing, single=single)
+            if single and self.params.get('validate_sky_response',False):
+                # The full chain recomputes self.im_pers, which is kept as it was for the science image
+                im_pers = self.im_pers
+                diff = sky_im.array.astype(float) - self.sky_response(im.copy(), pointing, single=False).array
+                self.im_pers = im_pers
+                print('Sky response single - two pass (ADU): mean, std, max |diff|, fraction of pixels changed',
+                      np.mean(diff), np.std(diff), np.max(np.abs(diff)), np.mean(diff!=0))
+            im = sky_im
 
-            bound_pad = galsim.BoundsI( xmin=1, ymin=1,
-                                        xmax=4096, ymax=4096)
-            im_pad = galsim.Image(bound_pad)
-            im_pad.array[4:-4, 4:-4] = im.array[:,:]
+        return im
 
-            im_pad = self.qe(im_pad)
+    def sky_response(self, im, pointing, single=False):
+        """
+        Apply the SCA file detector model to the sky image, with the dark current and read noise realisations of the science image.
+
+        With single, the sky image does not go through the expensive nonlinear stages a second time. BFE is replaced by its response to a uniform illumination (see bfe_sky()), which leaves out only the BFE of the sky noise, and persistence, which does not depend on the current exposure, is taken from the science image. The remaining stages are applied exactly. Set validate_sky_response to compare with the full chain.
+
+        Input
+        im       : 4088x4088 sky image
+        pointing : Pointing object
+        single   : Reuse the science image pass for BFE and persistence
+        """
+
+        bound_pad = galsim.BoundsI( xmin=1, ymin=1,
+                                    xmax=4096, ymax=4096)
+        im_pad = galsim.Image(bound_pad)
+        im_pad.array[4:-4, 4:-4] = im.array[:,:]
+
+        im_pad = self.qe(im_pad)
+        if not single:
             im_pad = self.bfe(im_pad)
             im_pad = self.add_persistence(im_pad, pointing)
-            im_pad.quantize()
-            im_pad += self.im_dark
-            im_pad = self.saturate(im_pad)
-            im_pad = self.nonlinearity(im_pad)
-            im_pad = self.interpix_cap(im_pad)
-            im_pad = self.deadpix(im_pad)
-            im_pad = self.vtpe(im_pad)
-            im_pad += self.im_read
-            im_pad = self.add_gain(im_pad)
-            im_pad = self.add_bias(im_pad)
-            im_pad.quantize()
-            # output 4088x4088 img in uint16
-            im.array[:,:] = im_pad.array[4:-4, 4:-4]
-            im = galsim.Image(im, dtype=np.uint16)
+        else:
+            im_pad = self.bfe_sky(im_pad)
+            if self.im_pers is not None:
+                im_pad += self.im_pers
+        im_pad.quantize()
+        im_pad += self.im_dark
+        im_pad = self.saturate(im_pad)
+        im_pad = self.nonlinearity(im_pad)
+        im_pad = self.interpix_cap(im_pad)
+        im_pad = self.deadpix(im_pad)
+        im_pad = self.vtpe(im_pad)
+        im_pad += self.im_read
+        im_pad = self.add_gain(im_pad)
+        im_pad = self.add_bias(im_pad)
+        im_pad.quantize()
+        # output 4088x4088 img in uint16
+        im.array[:,:] = im_pad.array[4:-4, 4:-4]
+        im = galsim.Image(im, dtype=np.uint16)
 
         return im
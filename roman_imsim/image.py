@@ -33,6 +33,8 @@ import cProfile, pstats, psutil
 import glob
 import shutil
 import h5py
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 from .universe import setupCCM_ab
 from .universe import addDust
@@ -48,6 +50,12 @@ from .misc import hsm
 from .misc import get_filename
 from .misc import get_filenames
 from .misc import write_fits
+from .psf_bank import bright_star_psf
+from .psf_bank import point_source_bank
+from .psf_bank import true_psf_cache
+from .stamps import stamp_record
+from .stamps import max_stamp_size
+from .parallel import shared_image
 
 path, filename = os.path.split(__file__)
 sedpath_Star   = os.path.join(galsim.meta_data.share_dir, 'SEDs', 'vega.txt')
@@ -96,6 +104,31 @@ class draw_image(object):
         self.t0 = time.time()
         roman.exptime  = 139.8
 
+        # Number of threads per rank used to draw independent stamps concurrently. GalSim does the heavy lifting in C++, so several stamps can be in flight at once. The SCA image is still only ever touched by the calling thread.
+        self.draw_threads = self.params.get('draw_threads',1)
+        self.pool         = None
+        self.pending      = None
+        self.sca_buffer   = None
+
+        # Optional engine to render bright stars from a cached PSF image instead of per-star FFT stamps
+        self.bright_star  = None
+        if self.params.get('bright_star_engine',False):
+            self.bright_star = bright_star_psf(self.params, self.pointing)
+
+        # Optional bank of precomputed PSF images used to draw faint stars
+        self.star_bank    = None
+        if self.params.get('psf_bank',False):
+            self.star_bank = point_source_bank(self.params, self.pointing, rank=self.rank)
+
+        # Optional cache of true PSF stamps, shared by all galaxies on the SCA with the same local WCS
+        self.true_psf     = None
+        self.psf_id       = -1
+        if self.params.get('true_psf_cache',False) and (not self.params.get('random_aberration_gradient',False)):
+            self.true_psf = true_psf_cache(self.params)
+
+        # Optional vectorized pre-filter of objects that cannot reach the SCA
+        self.keep     = {}
+
         # Option to change exposure time (in seconds)
         if 'exposure_time' in self.params:
             if self.params['exposure_time'] == 'deep':
@@ -129,9 +162,24 @@ class draw_image(object):
                                     xmax=roman.n_pix,
                                     ymax=roman.n_pix)
 
-        # SCA image (empty right now)
+        # Tiles of the SCA image drawn into by this proc, so that only those are combined across procs
+        self.sca_tile = self.params.get('sca_tile',256)
+        self.touched  = np.zeros(((roman.n_pix-1)//self.sca_tile+1,(roman.n_pix-1)//self.sca_tile+1),dtype=bool)
+
+        # SCA image (empty right now). With shared_sca, all procs of a node draw into one shared image. With a domain decomposition, each proc only holds its domain of the SCA plus a halo, and keeps parts of stamps beyond the halo in self.spill.
+        self.shared_sca = None
+        self.domains    = getattr(self.cats,'domains',None)
+        self.spill      = []
         if self.params['draw_sca']:
-            self.im = galsim.Image(self.b, wcs=self.pointing.WCS)
+            if self.params.get('shared_sca',False) and (comm is not None):
+                if self.domains is not None:
+                    raise ParamError('shared_sca and domain_decomposition can not be used together.')
+                self.shared_sca = shared_image(comm, (roman.n_pix,roman.n_pix), tile=self.sca_tile)
+                self.im = galsim.Image(self.shared_sca.array, xmin=1, ymin=1, wcs=self.pointing.WCS)
+            elif self.domains is not None:
+                self.im = galsim.Image(galsim.BoundsI(*self.domains.halo_bounds), wcs=self.pointing.WCS)
+            else:
+                self.im = galsim.Image(self.b, wcs=self.pointing.WCS)
         else:
             self.im = None
 
@@ -161,6 +209,8 @@ class draw_image(object):
 
         if self.gal_iter==0:
             self.t0 = time.time()
+            if self.params.get('prefilter',False) and ('gal' not in self.keep):
+                self.prefilter('gal')
 
 
         # Check if the end of the galaxy list has been reached; return exit flag (gal_done) True
@@ -172,10 +222,16 @@ class draw_image(object):
             print('Proc '+str(self.rank)+' done with galaxies.',time.time()-self.t0)
             return
 
+        # Hand the drawing off to the thread pool, then pick up the next finished object in catalog order
+        if self.draw_threads>1:
+            self.iterate_threaded('gal')
+            return
+
         # Reset galaxy information
         self.gal_model = None
         self.gal_stamp = None
         self.weight    = None
+        self.psf_id    = -1
 
         # if self.gal_iter>0:
         #     self.gal_done = True
@@ -185,9 +241,15 @@ class draw_image(object):
         #     print('Progress '+str(self.rank)+': Attempting to simulate galaxy '+str(self.gal_iter)+' in SCA '+str(self.pointing.sca)+' and dither '+str(self.pointing.dither)+'.')
 
         # Galaxy truth index and array for this galaxy
+        k = self.gal_iter
         self.ind,self.gal = self.cats.get_gal(self.gal_iter)
         self.gal_iter    += 1
 
+        # Objects the pre-filter showed can't reach the SCA
+        if 'gal' in self.keep:
+            if not self.keep['gal'][k]:
+                return
+
         # if self.ind != 157733:
         #     return
 
@@ -211,6 +273,10 @@ class draw_image(object):
 
         if self.star_iter==0:
             self.t0 = time.time()
+            if (self.star_bank is not None) and (not self.star_bank.prepared):
+                self.prepare_star_bank()
+            if self.params.get('prefilter',False) and ('star' not in self.keep):
+                self.prefilter('star')
 
         # self.star_done = True
         # return
@@ -235,6 +301,10 @@ class draw_image(object):
             self.star_done = True
             return
 
+        if self.draw_threads>1:
+            self.iterate_threaded('star')
+            return
+
         # self.star_done = True
         # print('Proc '+str(self.rank)+' not doing stars.')
         # return
@@ -248,15 +318,21 @@ class draw_image(object):
         #     print('Progress '+str(self.rank)+': Attempting to simulate star '+str(self.star_iter)+' in SCA '+str(self.pointing.sca)+' and dither '+str(self.pointing.dither)+'.')
 
         # Star truth index for this galaxy
+        k = self.star_iter
         self.ind,self.star = self.cats.get_star(self.star_iter)
         self.star_iter    += 1
+        if ('star' in self.keep) and (not self.keep['star'][k]):
+            return
         self.rng        = galsim.BaseDeviate(self.params['random_seed']+self.ind+self.pointing.dither)
 
         # If star image position (from wcs) doesn't fall within simulate-able bounds, skip (slower)
         # If it does, draw it
         #print(self.ind, self.star, self.star_iter)
         if self.check_position(self.star['ra'],self.star['dec']):
-            self.draw_star()
+            if (self.star_bank is not None) and self.star_bank.enabled and self.star_bank.use[k]:
+                self.draw_star_bank(k)
+            else:
+                self.draw_star()
 
     def iterate_supernova(self):
         if not self.params['draw_sca']:
@@ -277,6 +353,10 @@ class draw_image(object):
         if self.rank == -1:
             self.supernova_done = True
             return 
+
+        if self.draw_threads>1:
+            self.iterate_threaded('supernova')
+            return
             
         self.supernova_stamp = None
         # if self.star_iter%10==0:
@@ -296,6 +376,192 @@ class draw_image(object):
             print('Exposure time is ' + str(roman.exptime))
             self.draw_supernova()
 
+    def prefilter(self, obj_type):
+        """
+        Vectorized pre-filter for all objects of a type assigned to this rank, run before any GalSim object is built. Objects whose image position is outside the simulate-able bounds (self.b0), or (for galaxies) too far from the SCA for their size, are skipped entirely. Counts per rejection reason are reported.
+
+        Input
+        obj_type : One of 'gal', 'star'
+        """
+
+        if obj_type=='gal':
+            ind,objs = self.cats.get_gal_list()
+        elif obj_type=='star':
+            ind,objs = self.cats.get_star_list()
+        else:
+            raise ParamError('Supplied invalid obj type: '+obj_type)
+
+        if len(ind)==0:
+            self.keep[obj_type] = np.zeros(0,dtype=bool)
+            return
+
+        x,y = self.pointing.WCS.toImage(objs['ra'][:], objs['dec'][:], units=galsim.radians)
+        counts = {}
+
+        # Same bounds test as check_position()
+        off_sca = (x<self.b0.xmin)|(x>self.b0.xmax)|(y<self.b0.ymin)|(y>self.b0.ymax)
+        counts['off_sca'] = np.sum(off_sca)
+        keep = ~off_sca
+
+        if obj_type=='gal':
+            # Distance from SCA compared to object size, as in check_position()
+            size = objs['size'][:]
+            if size.ndim>1:
+                size = np.max(size,axis=1)
+            dboundsx = np.where(x<1, 1-x, x-roman.n_pix)
+            dboundsy = np.where(y<1, 1-y, y-roman.n_pix)
+            too_far  = keep & ((dboundsx>10*size/.11)|(dboundsy>10*size/.11))
+            counts['too_far'] = np.sum(too_far)
+            keep &= ~too_far
+
+        self.keep[obj_type] = keep
+        print('Proc '+str(self.rank)+' pre-filter '+obj_type+': '+str(len(ind))+' objects, '+', '.join([key+' '+str(counts[key]) for key in counts]))
+
+    def resume(self, obj_type, i):
+        """
+        Continue drawing objects of this type from catalog position i, e.g., after restarting from a checkpoint. Runs the setup otherwise done at the first object. The objects before i are assumed to be in self.im already.
+
+        Input
+        obj_type : One of 'gal', 'star', 'supernova'
+        i        : Catalog position of the next object to draw
+        """
+
+        self.t0 = time.time()
+        if obj_type=='gal':
+            if self.params.get('prefilter',False) and ('gal' not in self.keep):
+                self.prefilter('gal')
+        elif obj_type=='star':
+            if (self.star_bank is not None) and (not self.star_bank.prepared):
+                self.prepare_star_bank()
+            if self.params.get('prefilter',False) and ('star' not in self.keep):
+                self.prefilter('star')
+        elif obj_type!='supernova':
+            raise ParamError('Supplied invalid obj type: '+obj_type)
+        setattr(self, obj_type+'_iter', i)
+
+    def get_length(self, obj_type):
+        """
+        Number of objects of a given type assigned to this rank.
+
+        Input
+        obj_type : One of 'gal', 'star', 'supernova'
+        """
+
+        if obj_type=='gal':
+            return self.cats.get_gal_length()
+        elif obj_type=='star':
+            return self.cats.get_star_length()
+        elif obj_type=='supernova':
+            return self.cats.get_supernova_length()
+        else:
+            raise ParamError('Supplied invalid obj type: '+obj_type)
+
+    def draw_worker(self, obj_type, i):
+        """
+        Draw object i of obj_type on a shallow copy of this draw_image object. Runs in a pool thread. Each object seeds its own rng from its truth index, so the result does not depend on which thread draws it. Stamps destined for the SCA image are buffered on the copy rather than added to self.im.
+
+        Input
+        obj_type : One of 'gal', 'star', 'supernova'
+        i        : Position of the object in this rank's object list
+        """
+
+        worker = copy.copy(self)
+        worker.draw_threads = 1
+        worker.pool         = None
+        worker.pending      = None
+        worker.sca_buffer   = []
+        setattr(worker, obj_type+'_iter', i)
+        getattr(worker, 'iterate_'+obj_type)()
+
+        return worker
+
+    def iterate_threaded(self, obj_type):
+        """
+        Threaded version of the iterate_*() functions. Keeps a bounded window of objects in flight in the thread pool and consumes the oldest one. Finished stamps are accumulated into self.im in catalog order by the calling thread only, so the SCA image is identical to a serial run. The per-object state of the worker is then copied back so retrieve_*() work unchanged.
+
+        Input
+        obj_type : One of 'gal', 'star', 'supernova'
+        """
+
+        n = self.get_length(obj_type)
+        if self.pool is None:
+            self.pool        = ThreadPoolExecutor(max_workers=self.draw_threads)
+            self.pending     = collections.deque()
+            self.submit_iter = getattr(self, obj_type+'_iter')
+
+        # Keep the pool busy without holding more than a couple of stamps per thread in memory
+        while (len(self.pending)<2*self.draw_threads) and (self.submit_iter<n):
+            self.pending.append(self.pool.submit(self.draw_worker, obj_type, self.submit_iter))
+            self.submit_iter += 1
+
+        worker = self.pending.popleft().result()
+
+        # Single accumulator for the SCA image
+        for stamp,b in worker.sca_buffer:
+            self.accumulate(stamp, b)
+
+        # Adopt the per-object state of the worker
+        for attr in ['ind', 'gal', 'star', 'supernova', 'hostid', 'rng', 'radec', 'xy', 'xyI', 'offset', 'local_wcs', 'mag',
+                     'stamp_size', 'gal_model', 'gal_stamp', 'gal_stamp_too_large', 'gal_b', 'weight', 'psf_stamp2', 'psf_id',
+                     'st_model', 'star_stamp', 'star_b', 'save_star_stamp', 'supernova_stamp']:
+            if attr in worker.__dict__:
+                setattr(self, attr, worker.__dict__[attr])
+        setattr(self, obj_type+'_iter', getattr(self, obj_type+'_iter')+1)
+
+        if getattr(self, obj_type+'_iter')==n:
+            self.pool.shutdown()
+            self.pool    = None
+            self.pending = None
+
+    def add_to_sca(self, stamp, b):
+        """
+        Add the part of a stamp within bounds b to the SCA image. When drawing in a pool thread the stamp is buffered instead, and added by iterate_threaded().
+
+        Input
+        stamp : Galsim image of the object
+        b     : Overlap of stamp and SCA bounds
+        """
+
+        if self.sca_buffer is not None:
+            self.sca_buffer.append((stamp,b))
+            return
+
+        self.accumulate(stamp, b)
+
+    def accumulate(self, stamp, b):
+        """
+        Add the part of a stamp within bounds b to the SCA image (under the tile locks if the image is shared by the node).
+
+        Input
+        stamp : Galsim image of the object
+        b     : Overlap of stamp and SCA bounds
+        """
+
+        if self.shared_sca is not None:
+            self.shared_sca.add(self.im, stamp, b)
+        elif (self.domains is not None) and (not self.im.bounds.includes(b)):
+            # The part of the stamp beyond the halo is sent to its owner at the end
+            spill = stamp[b].array.copy()
+            bi    = b & self.im.bounds
+            if bi.isDefined():
+                self.im[bi] += stamp[bi]
+                spill[bi.ymin-b.ymin:bi.ymax-b.ymin+1,bi.xmin-b.xmin:bi.xmax-b.xmin+1] = 0.
+            self.spill.append((b.xmin,b.ymin,spill))
+        else:
+            self.im[b] += stamp[b]
+        self.mark_touched(b)
+
+    def mark_touched(self, b):
+        """
+        Flag the SCA image tiles overlapping bounds b as drawn into.
+
+        Input
+        b : Galsim bounds within the SCA
+        """
+
+        t = self.sca_tile
+        self.touched[(b.ymin-1)//t:(b.ymax-1)//t+1,(b.xmin-1)//t:(b.xmax-1)//t+1] = True
+
     def check_position(self, ra, dec, gal=False):
         """
         Create the world and image position galsim objects for obj, as well as the local WCS. Return whether object is in SCA (+half-stamp-width border).
@@ -646,10 +912,10 @@ class draw_image(object):
 
         # Add galaxy stamp to SCA image
         if self.params['draw_sca']:
-            self.im[b&self.b] = self.im[b&self.b] + gal_stamp[b&self.b]
+            self.add_to_sca(gal_stamp, b&self.b)
 
         # If object too big for stamp sizes, or not saving stamps, skip saving a stamp
-        if stamp_size>256:
+        if stamp_size>max_stamp_size:
             self.gal_stamp_too_large = True
             self.gal_stamp = -1
             # print('too big stamp',self.ind,stamp_size)
@@ -694,37 +960,50 @@ class draw_image(object):
 
             # If we're saving the true PSF model, simulate an appropriate unit-flux star and draw it (oversampled) at the position of the galaxy
             if (self.params['draw_true_psf']) and (not self.params['skip_stamps']):
-                self.star_model(sed=galsim.SED(lambda x:1, 'nm', 'flambda').withFlux(1.,self.pointing.bpass),mag=99.) #Star model for PSF (unit flux)
-                # Create modified WCS jacobian for super-sampled pixelisation
-                wcs = galsim.JacobianWCS(dudx=self.local_wcs.dudx/self.params['oversample'],
-                                         dudy=self.local_wcs.dudy/self.params['oversample'],
-                                         dvdx=self.local_wcs.dvdx/self.params['oversample'],
-                                         dvdy=self.local_wcs.dvdy/self.params['oversample'])
-                # Create postage stamp bounds at position of object
-                # b_psf = galsim.BoundsI( xmin=self.xyI.x-int(self.params['psf_stampsize'])/2+1,
-                #                     ymin=self.xyI.y-int(self.params['psf_stampsize'])/2+1,
-                #                     xmax=self.xyI.x+int(self.params['psf_stampsize'])/2,
-                #                     ymax=self.xyI.y+int(self.params['psf_stampsize'])/2)
-                # Create postage stamp bounds at position of object
-                b_psf2 = galsim.BoundsI( xmin=self.xyI.x-int(self.params['psf_stampsize']*self.params['oversample'])/2+1,
-                                    ymin=self.xyI.y-int(self.params['psf_stampsize']*self.params['oversample'])/2+1,
-                                    xmax=self.xyI.x+int(self.params['psf_stampsize']*self.params['oversample'])/2,
-                                    ymax=self.xyI.y+int(self.params['psf_stampsize']*self.params['oversample'])/2)
-                # Create psf stamp with oversampled pixelisation
-                # self.psf_stamp = galsim.Image(b_psf, wcs=self.pointing.WCS)
-                # print('draw_galaxy5',time.time()-t0)
-                # print(process.memory_info().rss/2**30)
-                # print(process.memory_info().vms/2**30)
-                self.psf_stamp2 = galsim.Image(b_psf2, wcs=wcs)
-                # Draw PSF into postage stamp
-                # self.st_model.drawImage(self.pointing.bpass,image=self.psf_stamp,wcs=self.pointing.WCS)
-                # self.st_model.drawImage(self.pointing.bpass,image=self.psf_stamp2,wcs=wcs,method='no_pixel')
-                # self.st_model.drawImage(image=self.psf_stamp,wcs=self.pointing.WCS)
-                self.st_model.drawImage(image=self.psf_stamp2,wcs=wcs,method='no_pixel')
+                if self.true_psf is None:
+                    self.psf_stamp2 = self.make_true_psf()
+                else:
+                    # The PSF is constant across the SCA, so reuse the stamp of any galaxy with the same (quantized) local WCS
+                    self.psf_id,self.psf_stamp2 = self.true_psf.get(self.local_wcs,self.xyI,self.make_true_psf)
             # print('draw_galaxy6',time.time()-t0)
             # print(process.memory_info().rss/2**30)
             # print(process.memory_info().vms/2**30)
 
+    def make_true_psf(self):
+        """
+        Draw the true PSF model (unit-flux star, oversampled pixelisation) at the position of the current object.
+        """
+
+        self.star_model(sed=galsim.SED(lambda x:1, 'nm', 'flambda').withFlux(1.,self.pointing.bpass),mag=99.) #Star model for PSF (unit flux)
+        # Create modified WCS jacobian for super-sampled pixelisation
+        wcs = galsim.JacobianWCS(dudx=self.local_wcs.dudx/self.params['oversample'],
+                                 dudy=self.local_wcs.dudy/self.params['oversample'],
+                                 dvdx=self.local_wcs.dvdx/self.params['oversample'],
+                                 dvdy=self.local_wcs.dvdy/self.params['oversample'])
+        # Create postage stamp bounds at position of object
+        # b_psf = galsim.BoundsI( xmin=self.xyI.x-int(self.params['psf_stampsize'])/2+1,
+        #                     ymin=self.xyI.y-int(self.params['psf_stampsize'])/2+1,
+        #                     xmax=self.xyI.x+int(self.params['psf_stampsize'])/2,
+        #                     ymax=self.xyI.y+int(self.params['psf_stampsize'])/2)
+        # Create postage stamp bounds at position of object
+        b_psf2 = galsim.BoundsI( xmin=self.xyI.x-int(self.params['psf_stampsize']*self.params['oversample'])/2+1,
+                            ymin=self.xyI.y-int(self.params['psf_stampsize']*self.params['oversample'])/2+1,
+                            xmax=self.xyI.x+int(self.params['psf_stampsize']*self.params['oversample'])/2,
+                            ymax=self.xyI.y+int(self.params['psf_stampsize']*self.params['oversample'])/2)
+        # Create psf stamp with oversampled pixelisation
+        # self.psf_stamp = galsim.Image(b_psf, wcs=self.pointing.WCS)
+        # print('draw_galaxy5',time.time()-t0)
+        # print(process.memory_info().rss/2**30)
+        # print(process.memory_info().vms/2**30)
+        psf_stamp2 = galsim.Image(b_psf2, wcs=wcs)
+        # Draw PSF into postage stamp
+        # self.st_model.drawImage(self.pointing.bpass,image=self.psf_stamp,wcs=self.pointing.WCS)
+        # self.st_model.drawImage(self.pointing.bpass,image=psf_stamp2,wcs=wcs,method='no_pixel')
+        # self.st_model.drawImage(image=self.psf_stamp,wcs=self.pointing.WCS)
+        self.st_model.drawImage(image=psf_stamp2,wcs=wcs,method='no_pixel')
+
+        return psf_stamp2
+
     def star_model(self, sed = None, mag = 0.):
         """
         Create star model for PSF or for drawing stars into SCA
@@ -860,7 +1139,12 @@ class draw_image(object):
         # Draw star model into postage stamp
         # t0 = time.time()
         # print('--------',self.mag,stamp_size,time.time()-t0)
-        if self.mag<15:
+        bright_stamp = None
+        if (self.bright_star is not None) and (self.mag<self.bright_star.mag_limit):
+            bright_stamp = self.bright_star.draw(self.st_model,self.mag,self.xy,b,self.rng,self.pointing.bpass)
+        if bright_stamp is not None:
+            star_stamp = bright_stamp
+        elif self.mag<15:
             self.st_model.drawImage(self.pointing.bpass,image=star_stamp,offset=self.xy-b.true_center)
             star_stamp.addNoise(galsim.PoissonNoise(self.rng))
 
@@ -870,27 +1154,105 @@ class draw_image(object):
         # star_stamp.write('/fs/scratch/cond0083/roman_sim_out/images/'+str(self.ind)+'.fits.gz')
 
         # Add star stamp to SCA image
-        self.im[b&self.b] += star_stamp[b&self.b]
+        self.add_to_sca(star_stamp, b&self.b)
         # self.st_model.drawImage(image=self.im,add_to_image=True,offset=self.xy-self.im.true_center,method='phot',rng=self.rng,maxN=1000000)
 
         if self.b.includes(self.xyI):
-            star_stamp = star_stamp[b&b_psf]
-            star_stamp = star_stamp[b_psf&self.b]
-            self.star_stamp = galsim.Image(b_psf, wcs=self.pointing.WCS)
-            self.star_stamp[b_psf&self.b] = star_stamp
-            self.weight            = galsim.Image(b_psf, wcs=self.pointing.WCS,init_value=0,dtype=np.int16)
-            self.weight[b_psf&self.b].array[:,:] = 1
-            self.weight            = self.weight.array
-            self.supernova_stamp = self.star_stamp
-            self.star_b = b_psf
-            snr = 0.015*np.sum(star_stamp.array)
-            saturated = star_stamp.array.max()/100000.>1.
-            # print('star-----',self.star_iter,snr,star_stamp.array.max())
-            self.save_star_stamp = True
-            if snr<50.:
-                self.save_star_stamp = False
-            if saturated:
-                self.save_star_stamp = False
+            self.save_star(star_stamp, b)
+
+    def save_star(self, star_stamp, b):
+        """
+        Cut the postage stamp that is saved for a star out of its drawn image, and decide whether it is worth saving.
+
+        Input
+        star_stamp : Galsim image the star was drawn into
+        b          : Bounds of star_stamp
+        """
+
+        # Create postage stamp bounds at position of object
+        b_psf = galsim.BoundsI( xmin=self.xyI.x-self.stamp_size/2+1,
+                            ymin=self.xyI.y-self.stamp_size/2+1,
+                            xmax=self.xyI.x+self.stamp_size/2,
+                            ymax=self.xyI.y+self.stamp_size/2)
+        star_stamp = star_stamp[b&b_psf&self.b]
+        self.star_stamp = galsim.Image(b_psf, wcs=self.pointing.WCS)
+        self.star_stamp[b&b_psf&self.b] = star_stamp
+        self.weight            = galsim.Image(b_psf, wcs=self.pointing.WCS,init_value=0,dtype=np.int16)
+        self.weight[b_psf&self.b].array[:,:] = 1
+        self.weight            = self.weight.array
+        self.supernova_stamp = self.star_stamp
+        self.star_b = b_psf
+        snr = 0.015*np.sum(star_stamp.array)
+        saturated = star_stamp.array.max()/100000.>1.
+        # print('star-----',self.star_iter,snr,star_stamp.array.max())
+        self.save_star_stamp = True
+        if snr<50.:
+            self.save_star_stamp = False
+        if saturated:
+            self.save_star_stamp = False
+
+    def prepare_star_bank(self):
+        """
+        Vectorized setup of the point-source PSF bank (positions, fluxes, sub-pixel phases and SED color bins) for all stars assigned to this rank.
+        """
+
+        star_ind,stars = self.cats.get_star_list()
+        if len(star_ind)==0:
+            self.star_bank.prepare([],[],[],[],{})
+            return
+
+        if self.params['dc2']:
+            # Magnitudes depend on the per-star SED, mag_norm and dust
+            mags = np.zeros(len(stars))
+            keys = []
+            for k in range(len(stars)):
+                model   = self.make_sed_model_dc2(galsim.DeltaFunction(), stars[k], -1)
+                mags[k] = model.calculateMagnitude(self.pointing.bpass)
+                keys.append(stars[k]['sed'].strip())
+            seds = self.seds
+        else:
+            mags = stars[self.pointing.filter][:]
+            keys = np.zeros(len(stars),dtype=int)
+            seds = {0 : self.star_sed}
+
+        self.star_bank.prepare(stars['ra'][:],stars['dec'][:],mags,keys,seds)
+
+    def draw_star_bank(self, k):
+        """
+        Draw a faint star into the SCA from the point-source PSF bank.
+
+        Input
+        k : Index of the star in this rank's star list
+        """
+
+        self.mag        = self.star_bank.mag[k]
+        self.stamp_size = 256
+
+        star_stamp = self.star_bank.draw(k)
+        b = star_stamp.bounds
+        self.star_b = b
+
+        # If postage stamp doesn't overlap with SCA, don't draw anything
+        if not (b&self.b).isDefined():
+            return
+
+        # Compare the first stars against the exact drawing of the same stamp, falling back to it if the bank fails the check
+        if self.star_bank.needs_check():
+            if self.params['dc2']:
+                self.star_model(sed=self.star['sed'].lstrip().rstrip())
+            else:
+                self.star_model(sed=self.star_sed,mag=self.star[self.pointing.filter])
+            exact = galsim.Image(b, wcs=self.pointing.WCS)
+            self.st_model.drawImage(self.pointing.bpass,image=exact,offset=self.xy-b.true_center)
+            if not self.star_bank.check(k, exact.array):
+                self.draw_star()
+                return
+
+        # Add star stamp to SCA image
+        self.add_to_sca(star_stamp, b&self.b)
+
+        if self.b.includes(self.xyI):
+            self.save_star(star_stamp, b)
 
     def draw_supernova(self):
         
@@ -959,7 +1321,7 @@ class draw_image(object):
         # star_stamp.write('/fs/scratch/cond0083/roman_sim_out/images/'+str(self.ind)+'.fits.gz')
 
         # Add star stamp to SCA image
-        self.im[b&self.b] = self.im[b&self.b] + star_stamp[b&self.b]
+        self.add_to_sca(star_stamp, b&self.b)
         # self.st_model.drawImage(image=self.im,add_to_image=True,offset=self.xy-self.im.true_center,method='phot',rng=self.rng,maxN=1000000)
 
         if self.b.includes(self.xyI):
@@ -988,6 +1350,7 @@ class draw_image(object):
                     'mag'    : self.mag, #Calculated magnitude
                     'stamp'  : self.stamp_size, # Get stamp size in pixels
                     'gal'    : None, # Galaxy image object (includes metadata like WCS)
+                    'psf_id' : -1, # ID of the cached true PSF stamp
                     # 'psf'    : None, # Flattened array of PSF image
                     # 'psf2'    : None, # Flattened array of PSF image
                     'weight' : None } # Flattened array of weight map
@@ -1002,6 +1365,7 @@ class draw_image(object):
                 'stamp'  : self.stamp_size, # Get stamp size in pixels
                 'b'      : self.gal_b, # Galaxy bounds object
                 'gal'    : self.gal_stamp, # Galaxy image object (includes metadata like WCS)
+                'psf_id' : self.psf_id, # ID of the cached true PSF stamp (-1 if not cached)
                 # 'psf'    : self.psf_stamp.array.flatten(), # Flattened array of PSF image
                 # 'psf'   : self.psf_stamp2.array.flatten(), # Flattened array of PSF image
                 'weight' : self.weight } # Flattened array of weight map
@@ -1052,6 +1416,78 @@ class draw_image(object):
                 'hostid' : self.hostid, #Host galaxy id number
                 'supernova'    : self.supernova_stamp } # Supernova image object (includes metadata like WCS)
 
+    def get_record(self, obj, stamp, weight, psf_id=-1, hostid=-1, stamp_size=None):
+        """
+        Build the compact stamp_record for the current object.
+
+        Input
+        obj        : Truth catalog entry of object
+        stamp      : Galsim image of saved postage stamp (None if not saved)
+        weight     : Weight map of saved postage stamp
+        psf_id     : ID of the cached true PSF stamp
+        hostid     : Host galaxy id number
+        stamp_size : Stamp size in pixels (default self.stamp_size)
+        """
+
+        if stamp_size is None:
+            stamp_size = self.stamp_size
+
+        if stamp is None:
+            return stamp_record(self.ind, obj['ra'], obj['dec'], self.xy.x, self.xy.y, self.mag, stamp_size, None, None, psf_id, hostid, None, None)
+
+        return stamp_record(self.ind, obj['ra'], obj['dec'], self.xy.x, self.xy.y, self.mag, stamp_size,
+                            stamp.bounds, stamp.wcs.jacobian(galsim.PositionD(self.xy.x,self.xy.y)),
+                            psf_id, hostid, stamp.array, weight)
+
+    def draw_galaxies(self):
+        """
+        Generator over all galaxies assigned to this process. Draws each galaxy into the SCA image and yields a stamp_record for each galaxy that was drawn.
+        """
+
+        while True:
+            self.iterate_gal()
+            if self.gal_done:
+                return
+            if self.gal_stamp is None:
+                continue
+            if self.gal_stamp_too_large:
+                yield self.get_record(self.gal, None, None)
+            else:
+                yield self.get_record(self.gal, self.gal_stamp, self.weight, psf_id=self.psf_id)
+
+    def draw_stars(self):
+        """
+        Generator over all stars assigned to this process. Draws each star into the SCA image and yields a stamp_record for each star that was drawn.
+        """
+
+        while True:
+            self.iterate_star()
+            if self.star_done:
+                return
+            if self.star_stamp is None:
+                continue
+            if self.save_star_stamp:
+                yield self.get_record(self.star, self.star_stamp, self.weight)
+            else:
+                yield self.get_record(self.star, None, None)
+
+    def draw_supernovae(self):
+        """
+        Generator over all supernovae assigned to this process. Draws each supernova into the SCA image and yields a stamp_record for each supernova that was drawn.
+        """
+
+        while True:
+            self.iterate_supernova()
+            if self.supernova_done:
+                return
+            if self.supernova_stamp is None:
+                continue
+            # Supernova stamps are saved in full, with weight marking the pixels on the SCA
+            b      = self.supernova_stamp.bounds
+            weight = galsim.Image(b, wcs=self.pointing.WCS, init_value=0, dtype=np.int16)
+            weight[b&self.b].array[:,:] = 1
+            yield self.get_record(self.supernova, self.supernova_stamp, weight.array, hostid=self.hostid, stamp_size=b.xmax-b.xmin+1)
+
     def finalize_sca(self):
         """
         # Apply background, noise, and Roman detector effects to SCA image
@@ -0,0 +1,70 @@
+import numpy as np
+import sys, os, io
+
+from .stencil import row_bands
+from .stencil import run_bands
+
+
+def tile_rng(seed, i):
+    """
+    Return the random generator of tile i, seeded from child i of the SeedSequence seed (as seed.spawn() would, but without changing seed, so the same tiles are drawn however often this is called).
+
+    Input
+    seed : SeedSequence
+    i    : Tile number
+    """
+
+    return np.random.default_rng(np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key+(i,)))
+
+def fill_tiles(draw, out, seed, tile=256, threads=1):
+    """
+    Fill out in tiles of tile rows, each drawn from its own random stream, by calling draw(rng, y0, y1) for rows y0 to y1. The streams only depend on seed and the tile size, so the result does not depend on the number of threads.
+
+    Input
+    draw    : Function of (rng, y0, y1) filling out[y0:y1]
+    out     : Output array
+    seed    : SeedSequence
+    tile    : Number of rows per tile
+    threads : Number of threads
+    """
+
+    run_bands(lambda y0,y1: draw(tile_rng(seed, y0//tile), y0, y1), row_bands(out.shape[0], tile), threads)
+    return out
+
+def poisson_tiles(lam, out, seed, add_to=None, tile=256, threads=1):
+    """
+    Fill out with Poisson deviates of mean lam (clipped at 0) in independent tiles (see fill_tiles()), optionally adding them to another array as each tile is drawn.
+
+    Input
+    lam    : Mean, a number or an array of the shape of out
+    out    : Output array
+    seed   : SeedSequence
+    add_to : Array to add the deviates to
+    """
+
+    def draw(rng, y0, y1):
+        lam_ = lam if np.ndim(lam)==0 else lam[y0:y1]
+        out[y0:y1] = rng.poisson(np.clip(lam_, 0, None), size=out[y0:y1].shape)
+        if add_to is not None:
+            add_to[y0:y1] += out[y0:y1]
+
+    return fill_tiles(draw, out, seed, tile=tile, threads=threads)
+
+def gaussian_tiles(sigma, out, seed, add_to=None, tile=256, threads=1):
+    """
+    Fill out (float32 or float64) with zero mean Gaussian deviates of standard deviation sigma in independent tiles (see fill_tiles()), drawn in place, optionally adding them to another array as each tile is drawn.
+
+    Input
+    sigma  : Standard deviation, a number or an array of the shape of out
+    out    : Output array
+    seed   : SeedSequence
+    add_to : Array to add the deviates to
+    """
+
+    def draw(rng, y0, y1):
+        rng.standard_normal(out=out[y0:y1], dtype=out.dtype)
+        out[y0:y1] *= sigma if np.ndim(sigma)==0 else sigma[y0:y1]
+        if add_to is not None:
+            add_to[y0:y1] += out[y0:y1]
+
+    return fill_tiles(draw, out, seed, tile=tile, threads=threads)
@@ -56,14 +56,15 @@ from .misc import hsm
 from .misc import get_filename
 from .misc import get_filenames
 from .misc import write_fits
+from .compress import gzip_file
+from .compress import gunzip_file
+from .parallel import gather_rows
 
 import roman_imsim
 
 class accumulate_output_disk(object):
 
     def __init__(self, param_file, filter_, pix, comm, ignore_missing_files = False, setup = False, condor_build=False, shape=False, shape_iter = None, shape_cnt = None):
-        from mpi4py import MPI
-
         self.params     = yaml.load(open(param_file))
         self.param_file = param_file
         # Do some parsing
@@ -85,7 +86,6 @@ class accumulate_output_disk(object):
         self.skip = False
 
         self.comm = comm
-        status = MPI.Status()
         if self.comm is None:
             self.rank = 0
             self.size = 1
@@ -180,22 +180,17 @@ class accumulate_output_disk(object):
                     ftype='fits',
                     overwrite=False)
             if self.rank==0:
-                shutil.copy(self.meds_filename,self.local_meds+'.gz')
-
-                os.system( 'gunzip '+self.local_meds+'.gz')
+                gunzip_file(self.meds_filename,out=self.local_meds,remove=False)
                 if self.params['multiband']:
-                    shutil.copy(self.meds_Jfilename,self.local_Jmeds+'.gz')
-                    os.system( 'gunzip '+self.local_Jmeds+'.gz')
+                    gunzip_file(self.meds_Jfilename,out=self.local_Jmeds,remove=False)
                     if self.params['multiband_filter'] == 3:
-                        shutil.copy(self.meds_Ffilename,self.local_Fmeds+'.gz')
-                        os.system( 'gunzip '+self.local_Fmeds+'.gz')
+                        gunzip_file(self.meds_Ffilename,out=self.local_Fmeds,remove=False)
                 
 
                 if self.local_meds != self.local_meds_psf:
-                    shutil.copy(self.meds_psf,self.local_meds_psf+'.gz')
                     if os.path.exists(self.local_meds_psf):
                         os.remove(self.local_meds_psf)
-                    os.system( 'gunzip '+self.local_meds_psf+'.gz')
+                    gunzip_file(self.meds_psf,out=self.local_meds_psf,remove=False)
 
             self.comm.Barrier()
 
@@ -242,8 +237,7 @@ class accumulate_output_disk(object):
                                     overwrite=False)
                     if not condor:
                         if self.meds_psf!=self.meds_filename:
-                            shutil.copy(self.meds_psf,self.local_meds_psf+'.gz')
-                            os.system( 'gunzip '+self.local_meds_psf+'.gz')
+                            gunzip_file(self.meds_psf,out=self.local_meds_psf,remove=False)
 
         if self.rank>0:
             return
@@ -264,8 +258,7 @@ class accumulate_output_disk(object):
             self.skip = True
             return
         if tmp:
-            shutil.copy(self.meds_filename,self.local_meds+'.gz')
-            os.system( 'gunzip '+self.local_meds+'.gz')
+            gunzip_file(self.meds_filename,out=self.local_meds,remove=False)
             self.file_exists = True
             return
         self.accumulate_dithers(condor=False)
@@ -808,10 +801,9 @@ Queue ITER from seq 0 1 4 |
 
             for f in filename1:
                 filename=f.replace(self.params['out_path']+'stamps/', self.params['tmpdir'])
-                shutil.copy(f, filename)
-                os.system('gunzip '+filename)
-                
                 filename=filename.replace('.gz', '')
+                gunzip_file(f,out=filename,remove=False)
+
                 #print(filename)
                 with io.open(filename, 'rb') as p :
                     unpickler = pickle.Unpickler(p)
@@ -939,7 +931,7 @@ Queue ITER from seq 0 1 4 |
 
         print('start meds finish')
         if not self.file_exists:
-            os.system('gzip '+self.local_meds)
+            gzip_file(self.local_meds,threads=self.params.get('compress_threads',4))
         if not condor and not self.file_exists:
             shutil.move(self.local_meds+'.gz',self.meds_filename)
 
@@ -1821,13 +1813,10 @@ Queue ITER from seq 0 1 4 |
         self.comm.Barrier()
         print('after first barrier')
 
+        # Merge the rows measured on each proc into res on rank 0
+        gather_rows(self.comm,res,res['size']!=0)
+
         if self.rank==0:
-            for i in range(1,self.size):
-                print('getting',i)
-                tmp_res   = self.comm.recv(source=i)
-                mask      = tmp_res['size']!=0
-                res[mask] = tmp_res[mask]
-                # coadd.update(self.comm.recv(source=i))
 
             print('before barrier',self.rank)
             self.comm.Barrier()
@@ -1886,7 +1875,6 @@ Queue ITER from seq 0 1 4 |
 
         else:
 
-            self.comm.send(res, dest=0)
             res = None
             # self.comm.send(coadd, dest=0)
             # coadd = None
@@ -2076,13 +2064,9 @@ Queue ITER from seq 0 1 4 |
         print('after first barrier')
 
         for j in range(5):
+            # Merge the rows measured on each proc into res_tot[j] on rank 0
+            gather_rows(self.comm,res_tot[j],res_tot[j]['size']!=0)
             if self.rank==0:
-                for i in range(1,self.size):
-                    print('getting',i)
-                    tmp_res   = self.comm.recv(source=i)
-                    mask      = tmp_res['size']!=0
-                    res_tot[j][mask] = tmp_res[mask]
-                    # coadd.update(self.comm.recv(source=i))
 
                 print('before barrier',self.rank)
                 self.comm.Barrier()
@@ -2104,7 +2088,6 @@ Queue ITER from seq 0 1 4 |
 
             else:
 
-                self.comm.send(res_tot[j], dest=0)
                 #self.comm.send(coadd, dest=0)
                 #coadd = None
                 print('before barrier',self.rank)
@@ -2345,13 +2328,9 @@ Queue ITER from seq 0 1 4 |
         print('after first barrier')
 
         for j in range(5):
+            # Merge the rows measured on each proc into res_tot[j] on rank 0
+            gather_rows(self.comm,res_tot[j],res_tot[j]['size']!=0)
             if self.rank==0:
-                for i in range(1,self.size):
-                    print('getting',i)
-                    tmp_res   = self.comm.recv(source=i)
-                    mask      = tmp_res['size']!=0
-                    res_tot[j][mask] = tmp_res[mask]
-                    # coadd.update(self.comm.recv(source=i))
 
                 print('before barrier',self.rank)
                 self.comm.Barrier()
@@ -2373,7 +2352,6 @@ Queue ITER from seq 0 1 4 |
 
             else:
 
-                self.comm.send(res_tot[j], dest=0)
                 #self.comm.send(coadd, dest=0)
                 #coadd = None
                 print('before barrier',self.rank)
@@ -2592,13 +2570,9 @@ Queue ITER from seq 0 1 4 |
         print('after first barrier')
 
         for j in range(5):
+            # Merge the rows measured on each proc into res_tot[j] on rank 0
+            gather_rows(self.comm,res_tot[j],res_tot[j]['size']!=0)
             if self.rank==0:
-                for i in range(1,self.size):
-                    print('getting',i)
-                    tmp_res   = self.comm.recv(source=i)
-                    mask      = tmp_res['size']!=0
-                    res_tot[j][mask] = tmp_res[mask]
-                    # coadd.update(self.comm.recv(source=i))
 
                 print('before barrier',self.rank)
                 self.comm.Barrier()
@@ -2620,7 +2594,6 @@ Queue ITER from seq 0 1 4 |
 
             else:
 
-                self.comm.send(res_tot[j], dest=0)
                 #self.comm.send(coadd, dest=0)
                 #coadd = None
                 print('before barrier',self.rank)
@@ -0,0 +1,721 @@
+import numpy as np
+import sys, os, io
+import time
+import atexit
+import signal
+import glob
+import mmap
+import fcntl
+import tempfile
+import itertools
+import pickle as pickle
+import multiprocessing
+
+from .misc import ParamError
+
+# Directory for the shared memory segments of the local backend
+shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# Message buffers larger than this are passed through shared memory instead of the pipes
+shm_threshold = 1024**2
+
+class local_comm(object):
+    """
+    Communicator of the single-node backend, used in place of MPI.COMM_WORLD when mpi is False and local_procs>1. It implements the part of the mpi4py interface used by the simulation (Get_rank, Get_size, send, recv, Send, Recv, bcast, gather, allgather, alltoall, Barrier) between processes forked by fork_local_comm(), so the MPI code paths run unchanged and give the same outputs. Messages are pickled (protocol 5) and sent through a pipe per destination; large numpy buffers in them are written once to a shared memory segment and mapped copy-on-write by the receivers, so a catalog broadcast by rank 0 is held in memory once per node.
+    """
+
+    ANY_SOURCE = -1
+    ANY_TAG    = -1
+    # Internal tags
+    BARRIER_TAG = -10
+    RELEASE_TAG = -11
+    BCAST_TAG   = -12
+    GATHER_TAG  = -13
+    ALLTOALL_TAG = -14
+
+    def __init__(self, rank, size, inboxes, locks, parent=None, children=None):
+        """
+        Input
+        rank     : Rank of this process
+        size     : Number of processes
+        inboxes  : List of (reader, writer) pipe connections for each rank
+        locks    : List of write locks for each rank's pipe
+        parent   : pid of the rank 0 process (on other ranks)
+        children : pids of the other ranks (on rank 0)
+        """
+
+        self.rank     = rank
+        self.size     = size
+        self.inboxes  = inboxes
+        self.locks    = locks
+        self.parent   = parent
+        self.children = children
+        if children is not None:
+            self.pids = [os.getpid()]+children
+        self.pending  = []
+        self.counter  = itertools.count()
+
+    def Get_rank(self):
+
+        return self.rank
+
+    def Get_size(self):
+
+        return self.size
+
+    def dumps(self, obj, threshold=None):
+        """
+        Pickle obj, writing buffers larger than threshold (default shm_threshold) to a shared memory segment. Returns the pickle and the segment path and buffer (offset, size) list, or None if there were no large buffers.
+        """
+
+        if threshold is None:
+            threshold = shm_threshold
+        buffers = []
+        def callback(buf):
+            # Empty buffers stay in the pickle, as an empty segment can't be mapped
+            nbytes = buf.raw().nbytes
+            if (nbytes==0) or (nbytes < threshold):
+                return True
+            buffers.append(buf)
+            return False
+        payload = pickle.dumps(obj, protocol=5, buffer_callback=callback)
+        if len(buffers)==0:
+            return payload,None,None
+
+        path = os.path.join(shm_dir,'roman_imsim_'+str(os.getpid())+'_'+str(next(self.counter)))
+        meta = []
+        offset = 0
+        with io.open(path,'wb') as f:
+            for buf in buffers:
+                raw = buf.raw()
+                f.seek(offset)
+                f.write(raw)
+                meta.append((offset,raw.nbytes))
+                # Keep buffers page aligned
+                offset += (raw.nbytes//mmap.PAGESIZE+1)*mmap.PAGESIZE
+        return payload,path,meta
+
+    def loads(self, payload, path, meta, unlink):
+        """
+        Unpickle a message, mapping its shared memory segment copy-on-write.
+        """
+
+        if path is None:
+            return pickle.loads(payload)
+        with io.open(path,'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if unlink:
+            os.remove(path)
+        view = memoryview(mm)
+        return pickle.loads(payload, buffers=[view[o:o+n] for o,n in meta])
+
+    def post(self, dest, tag, payload, path, meta, unlink):
+
+        msg = pickle.dumps((self.rank,tag,payload,path,meta,unlink), protocol=5)
+        with self.locks[dest]:
+            self.inboxes[dest][1].send_bytes(msg)
+
+    def check_alive(self):
+        """
+        Raise an error instead of waiting forever if another process died.
+        """
+
+        if self.rank == 0:
+            for pid in self.children:
+                try:
+                    p,status = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    continue
+                if p!=0:
+                    self.children = [c for c in self.children if c!=pid]
+                    if status!=0:
+                        raise RuntimeError('Local process '+str(pid)+' exited with status '+str(status))
+        elif os.getppid()!=self.parent:
+            raise RuntimeError('Local rank 0 process exited')
+
+    def send(self, obj, dest, tag=0):
+        """
+        Send obj to rank dest.
+
+        Input
+        obj  : Object to send
+        dest : Destination rank
+        tag  : Message tag
+        """
+
+        payload,path,meta = self.dumps(obj)
+        self.post(dest, tag, payload, path, meta, True)
+
+    def recv(self, buf=None, source=-1, tag=-1):
+        """
+        Receive an object from rank source.
+
+        Input
+        buf    : Ignored (mpi4py compatibility)
+        source : Source rank or ANY_SOURCE
+        tag    : Message tag or ANY_TAG
+        """
+
+        def match(s, t):
+            if (source!=self.ANY_SOURCE) and (s!=source):
+                return False
+            if tag==self.ANY_TAG:
+                return t>=0
+            return t==tag
+
+        for i,(s,t,obj) in enumerate(self.pending):
+            if match(s,t):
+                del self.pending[i]
+                return obj
+
+        reader = self.inboxes[self.rank][0]
+        while True:
+            while not reader.poll(1.):
+                self.check_alive()
+            s,t,payload,path,meta,unlink = pickle.loads(reader.recv_bytes())
+            obj = self.loads(payload, path, meta, unlink)
+            if match(s,t):
+                return obj
+            self.pending.append((s,t,obj))
+
+    def Send(self, buf, dest, tag=0):
+        """
+        Send a numpy array to rank dest (buffer version of send()).
+
+        Input
+        buf  : Numpy array
+        dest : Destination rank
+        tag  : Message tag
+        """
+
+        self.send(np.ascontiguousarray(buf), dest, tag=tag)
+
+    def Recv(self, buf, source=-1, tag=-1):
+        """
+        Receive a numpy array from rank source into buf (buffer version of recv()).
+
+        Input
+        buf    : Numpy array of the size of the message
+        source : Source rank or ANY_SOURCE
+        tag    : Message tag or ANY_TAG
+        """
+
+        buf[...] = self.recv(source=source, tag=tag).reshape(buf.shape)
+
+    def Barrier(self):
+
+        if self.rank == 0:
+            for i in range(1,self.size):
+                self.recv(source=i, tag=self.BARRIER_TAG)
+            for i in range(1,self.size):
+                self.post(i, self.RELEASE_TAG, pickle.dumps(None), None, None, False)
+        else:
+            self.post(0, self.BARRIER_TAG, pickle.dumps(None), None, None, False)
+            self.recv(source=0, tag=self.RELEASE_TAG)
+
+    def bcast(self, obj, root=0):
+        """
+        Broadcast obj from rank root. Large buffers are written to shared memory once and mapped by all ranks.
+
+        Input
+        obj  : Object to send (on root)
+        root : Sending rank
+        """
+
+        if self.rank == root:
+            payload,path,meta = self.dumps(obj)
+            for i in range(self.size):
+                if i!=root:
+                    self.post(i, self.BCAST_TAG, payload, path, meta, False)
+        else:
+            obj = self.recv(source=root, tag=self.BCAST_TAG)
+        if self.size>1:
+            # All ranks have mapped the segment, so it can be unlinked
+            self.Barrier()
+        if (self.rank == root) and (path is not None):
+            os.remove(path)
+        return obj
+
+    def gather(self, obj, root=0):
+        """
+        Gather obj from all ranks on rank root (list ordered by rank, None on other ranks).
+
+        Input
+        obj  : Object to send
+        root : Receiving rank
+        """
+
+        if self.rank == root:
+            out = []
+            for i in range(self.size):
+                if i==root:
+                    out.append(obj)
+                else:
+                    out.append(self.recv(source=i, tag=self.GATHER_TAG))
+            return out
+        payload,path,meta = self.dumps(obj)
+        self.post(root, self.GATHER_TAG, payload, path, meta, True)
+        return None
+
+    def allgather(self, obj):
+        """
+        Gather obj from all ranks on every rank (list ordered by rank).
+
+        Input
+        obj : Object to send
+        """
+
+        return self.bcast(self.gather(obj, root=0), root=0)
+
+    def alltoall(self, objs):
+        """
+        Send objs[i] to rank i and return the list of objects received from each rank. All array buffers go through shared memory, so the messages in the pipes stay small and the sends don't block.
+
+        Input
+        objs : List of size objects
+        """
+
+        for i in range(self.size):
+            if i!=self.rank:
+                payload,path,meta = self.dumps(objs[i], threshold=0)
+                self.post(i, self.ALLTOALL_TAG, payload, path, meta, True)
+        out = []
+        for i in range(self.size):
+            if i==self.rank:
+                out.append(objs[i])
+            else:
+                out.append(self.recv(source=i, tag=self.ALLTOALL_TAG))
+        return out
+
+    def cleanup(self):
+        """
+        On rank 0, wait for the other processes to finish and remove shared memory segments that were never received.
+        """
+
+        if self.rank != 0:
+            return
+        for pid in self.children:
+            try:
+                p,status = os.waitpid(pid, 0)
+            except ChildProcessError:
+                continue
+            if status!=0:
+                print('Local process '+str(pid)+' exited with status '+str(status))
+        self.children = []
+        for pid in self.pids:
+            for path in glob.glob(os.path.join(shm_dir,'roman_imsim_'+str(pid)+'_*')):
+                os.remove(path)
+
+def fork_local_comm(size):
+    """
+    Fork this process into size processes on this node, which then all continue running the calling program like MPI ranks. Returns the local_comm of each process (rank 0 is the original process, which waits for the others on exit).
+
+    Input
+    size : Number of processes
+    """
+
+    if size<1:
+        raise ParamError('local_procs must be at least 1.')
+    if not hasattr(os,'fork'):
+        raise ParamError('The local backend needs os.fork().')
+
+    ctx     = multiprocessing.get_context('fork')
+    inboxes = [ctx.Pipe(duplex=False) for i in range(size)]
+    locks   = [ctx.Lock() for i in range(size)]
+    parent  = os.getpid()
+    # Don't duplicate buffered output in the children
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    children = []
+    for rank in range(1,size):
+        pid = os.fork()
+        if pid == 0:
+            comm = local_comm(rank, size, inboxes, locks, parent=parent)
+            atexit.register(comm.cleanup)
+            return comm
+        children.append(pid)
+
+    comm = local_comm(0, size, inboxes, locks, children=children)
+    atexit.register(comm.cleanup)
+
+    # Like an MPI abort, an uncaught error on rank 0 stops the other processes instead of leaving them waiting for it. Errors on other ranks are raised on rank 0 by check_alive().
+    hook = sys.excepthook
+    def excepthook(*args):
+        hook(*args)
+        for pid in comm.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    sys.excepthook = excepthook
+
+    return comm
+
+def reduce_image(comm, array, root=0, touched=None, tile=256):
+    """
+    Sum a 2d image array (e.g., the SCA image drawn by each proc) over all procs into array on rank root. Replaces the loop in which root received and added the pickled image of every other proc in turn. The raw buffers are combined along a binomial tree, so the reduction takes log2(size) steps. If touched is given, it is a boolean mask of the tiles (of tile x tile pixels) each proc drew into, and only those tiles are exchanged, so communication scales with the drawn area rather than with the number of procs. Otherwise a dense MPI Reduce is used. The array on other ranks is modified.
+
+    Input
+    comm    : MPI or local_comm communicator
+    array   : Contiguous float image array
+    root    : Rank receiving the sum
+    touched : Boolean (ny/tile, nx/tile) mask of the tiles with data on this proc
+    tile    : Tile size in pixels
+    """
+
+    size = comm.Get_size()
+    rank = comm.Get_rank()
+    if size==1:
+        return array
+
+    if (touched is None) and (not isinstance(comm,local_comm)):
+        from mpi4py import MPI
+        if rank == root:
+            comm.Reduce(MPI.IN_PLACE, array, op=MPI.SUM, root=root)
+        else:
+            comm.Reduce(array, None, op=MPI.SUM, root=root)
+        return array
+
+    if touched is None:
+        touched = np.ones(((array.shape[0]-1)//tile+1,(array.shape[1]-1)//tile+1),dtype=bool)
+    mask = touched.astype(np.uint8)
+
+    def tiles(mask):
+        for i,j in zip(*np.nonzero(mask)):
+            yield array[i*tile:(i+1)*tile,j*tile:(j+1)*tile]
+
+    # Ranks relative to root
+    r    = (rank-root)%size
+    step = 1
+    while step<size:
+        if r%(2*step) == step:
+            # Send the touched tiles (mask, then the packed tile pixels) to the partner and stop
+            partner = (r-step+root)%size
+            comm.Send(mask, dest=partner, tag=1)
+            if mask.any():
+                comm.Send(np.concatenate([t.ravel() for t in tiles(mask)]), dest=partner, tag=2)
+            break
+        if r+step<size:
+            # Add the partner's tiles
+            partner  = (r+step+root)%size
+            mask_    = np.empty_like(mask)
+            comm.Recv(mask_, source=partner, tag=1)
+            if mask_.any():
+                n      = sum(t.size for t in tiles(mask_))
+                packed = np.empty(n, dtype=array.dtype)
+                comm.Recv(packed, source=partner, tag=2)
+                k = 0
+                for t in tiles(mask_):
+                    t += packed[k:k+t.size].reshape(t.shape)
+                    k += t.size
+            mask |= mask_
+        step *= 2
+
+    return array
+
+def gather_table(comm, table, root=0):
+    """
+    Concatenate the structured arrays (e.g., index tables) of all procs on rank root, in rank order. The number of rows and dtype of each proc are exchanged first, the output is preallocated once, and the rows are collected with a Gatherv of the raw buffers instead of pickled sends appended one at a time. Procs without a table pass None. Must be called by all procs.
+
+    Input
+    comm  : MPI or local_comm communicator
+    table : Numpy (structured) array or None
+    root  : Rank receiving the table
+
+    Returns the concatenated table on root (None if all procs passed None), and None on other ranks.
+    """
+
+    rank = comm.Get_rank()
+    if table is None:
+        info = comm.allgather((0,None))
+    else:
+        table = np.ascontiguousarray(table)
+        info = comm.allgather((len(table),table.dtype))
+    dtype = None
+    for n,d in info:
+        if d is not None:
+            dtype = d
+            break
+    if dtype is None:
+        return None
+    if table is None:
+        table = np.empty(0,dtype=dtype)
+    elif table.dtype!=dtype:
+        raise ParamError('Tables gathered from procs have different dtypes.')
+
+    counts = np.array([n for n,d in info],dtype=int)
+    displs = np.append(0,np.cumsum(counts)[:-1])
+    if rank == root:
+        out = np.empty(np.sum(counts),dtype=dtype)
+    else:
+        out = None
+    if np.sum(counts)==0:
+        return out
+
+    if isinstance(comm,local_comm):
+        if rank == root:
+            for i in range(comm.Get_size()):
+                if i==root:
+                    out[displs[i]:displs[i]+counts[i]] = table
+                elif counts[i]>0:
+                    comm.Recv(out[displs[i]:displs[i]+counts[i]], source=i, tag=3)
+        elif len(table)>0:
+            comm.Send(table, dest=root, tag=3)
+        return out
+
+    from mpi4py import MPI
+    itemsize = dtype.itemsize
+    if rank == root:
+        recvbuf = [out.view(np.uint8), counts*itemsize, displs*itemsize, MPI.BYTE]
+    else:
+        recvbuf = None
+    comm.Gatherv([table.view(np.uint8), MPI.BYTE], recvbuf, root=root)
+    return out
+
+def gather_rows(comm, table, mask, root=0):
+    """
+    Merge into table on rank root the rows filled on each proc, for a table of all objects of which each proc fills its own rows (flagged by mask). Only the flagged rows and their positions are sent (see gather_table()). Rows of later ranks overwrite earlier ones. Must be called by all procs.
+
+    Input
+    comm  : MPI or local_comm communicator
+    table : Numpy (structured) array, the same length on all procs
+    mask  : Boolean array of the rows filled by this proc
+    root  : Rank receiving the rows
+    """
+
+    rows = gather_table(comm, table[mask], root=root)
+    ind  = gather_table(comm, np.nonzero(mask)[0], root=root)
+    if comm.Get_rank() == root:
+        table[ind] = rows
+
+    return table
+
+class shared_image(object):
+    """
+    Image buffer (e.g., the SCA image) shared by all procs of a node, which then accumulate their objects into it instead of each allocating a full image. Procs lock the tiles (of tile x tile pixels) they add to with fcntl record locks on a node-local file, so adds to different parts of the image proceed concurrently. Only one proc per node (the node leader) takes part in the reduction across nodes. With MPI the buffer is an MPI shared memory window, with the local backend a shared mapping of a file in shm_dir. Since procs add in a nondeterministic order, pixel values can differ from run to run in the last bit.
+    """
+
+    def __init__(self, comm, shape, tile=256):
+        """
+        Must be called by all procs.
+
+        Input
+        comm  : MPI or local_comm communicator
+        shape : Image array shape
+        tile  : Tile size in pixels
+        """
+
+        self.comm  = comm
+        self.shape = shape
+        self.tile  = tile
+        self.ntile = (shape[1]-1)//tile+1
+        self.win   = None
+        nbytes     = int(np.prod(shape))*8
+
+        if isinstance(comm,local_comm):
+            # All local procs are on one node
+            self.node    = comm
+            self.leaders = None
+        else:
+            from mpi4py import MPI
+            self.node    = comm.Split_type(MPI.COMM_TYPE_SHARED, key=comm.Get_rank())
+            self.leaders = comm.Split(0 if self.node.Get_rank()==0 else MPI.UNDEFINED, comm.Get_rank())
+            if self.leaders == MPI.COMM_NULL:
+                self.leaders = None
+
+        # The node leader creates the (lock) file
+        if self.node.Get_rank() == 0:
+            fd,path = tempfile.mkstemp(prefix='roman_imsim_'+str(os.getpid())+'_sca_',dir=shm_dir)
+            if self.leaders is None:
+                # Local backend: the file also holds the image
+                os.ftruncate(fd,nbytes)
+            os.close(fd)
+        else:
+            path = None
+        path = self.node.bcast(path, root=0)
+        self.fd = os.open(path, os.O_RDWR)
+
+        if isinstance(comm,local_comm):
+            self.mm    = mmap.mmap(self.fd, nbytes)
+            self.array = np.frombuffer(self.mm, dtype=np.float64).reshape(shape)
+        else:
+            self.win   = MPI.Win.Allocate_shared(nbytes if self.node.Get_rank()==0 else 0, 8, comm=self.node)
+            buf,itemsize = self.win.Shared_query(0)
+            self.array = np.ndarray(buffer=buf, dtype=np.float64, shape=shape)
+            if self.node.Get_rank() == 0:
+                self.array[:,:] = 0.
+
+        # All procs have opened the file
+        self.node.Barrier()
+        if self.node.Get_rank() == 0:
+            os.remove(path)
+
+    def lock(self, b):
+        """
+        Lock the tiles overlapping galsim bounds b (1-indexed) and return them. Tiles are locked in increasing order, so procs can't deadlock.
+
+        Input
+        b : Galsim bounds
+        """
+
+        t     = self.tile
+        tiles = [i*self.ntile+j for i in range((b.ymin-1)//t,(b.ymax-1)//t+1) for j in range((b.xmin-1)//t,(b.xmax-1)//t+1)]
+        for k in tiles:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, k)
+        return tiles
+
+    def unlock(self, tiles):
+
+        for k in tiles:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, k)
+
+    def add(self, im, stamp, b):
+        """
+        Add the part of stamp within bounds b to galsim image im (which wraps self.array).
+
+        Input
+        im    : Galsim image wrapping self.array
+        stamp : Galsim image
+        b     : Bounds of the overlap of stamp and im
+        """
+
+        tiles = self.lock(b)
+        try:
+            im[b] += stamp[b]
+        finally:
+            self.unlock(tiles)
+
+    def reduce(self, touched=None):
+        """
+        Sum the node images on rank 0 (see reduce_image()). Must be called by all procs after they have finished adding to the image.
+
+        Input
+        touched : Boolean mask of the tiles drawn into by this proc
+        """
+
+        if touched is not None:
+            # Tiles drawn into by any proc of the node
+            touched = np.any(self.node.allgather(touched),axis=0)
+        self.node.Barrier()
+        if self.leaders is not None:
+            reduce_image(self.leaders, self.array, root=0, touched=touched, tile=self.tile)
+
+    def free(self):
+        """
+        Release the buffer. Must be called by all procs.
+        """
+
+        self.node.Barrier()
+        self.array = None
+        if self.win is not None:
+            self.win.Free()
+            self.win = None
+        os.close(self.fd)
+
+def overlap(a, b):
+    """
+    Overlap of two (xmin, xmax, ymin, ymax) pixel bounds, or None.
+    """
+
+    o = (max(a[0],b[0]),min(a[1],b[1]),max(a[2],b[2]),min(a[3],b[3]))
+    if (o[0]>o[1]) or (o[2]>o[3]):
+        return None
+    return o
+
+class sca_domains(object):
+    """
+    Spatial decomposition of an (SCA) image over procs, as an alternative to striding the objects over procs. Each proc owns a rectangular domain of a grid of procs, draws the objects centred in it, and holds an image of its domain plus a halo. Parts of stamps that reach beyond the halo are kept aside (spilled), so any stamp size gives the same image, and the halo only sets how much is exchanged as whole halos rather than as spilled pieces. At the end, halos and spilled pieces are sent once to the owners of the pixels (reduce()), and the finished domains are assembled on the root. Bounds are (xmin, xmax, ymin, ymax) in 1-indexed pixels.
+    """
+
+    def __init__(self, comm, nx, ny, halo):
+        """
+        Input
+        comm : MPI or local_comm communicator
+        nx   : Image size in x
+        ny   : Image size in y
+        halo : Width of the halo in pixels
+        """
+
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        self.size = comm.Get_size()
+        self.nx   = nx
+        self.ny   = ny
+
+        # Grid of procs as close to square as possible
+        py = int(np.sqrt(self.size))
+        while self.size%py!=0:
+            py -= 1
+        px = self.size//py
+        self.px = px
+        self.py = py
+        self.edges_x = [1+(nx*i)//px for i in range(px+1)]
+        self.edges_y = [1+(ny*j)//py for j in range(py+1)]
+        self.domains = [(self.edges_x[i],self.edges_x[i+1]-1,self.edges_y[j],self.edges_y[j+1]-1) for j in range(py) for i in range(px)]
+
+        self.bounds = self.domains[self.rank]
+        self.halo_bounds = (max(1,self.bounds[0]-halo),
+                            min(nx,self.bounds[1]+halo),
+                            max(1,self.bounds[2]-halo),
+                            min(ny,self.bounds[3]+halo))
+
+    def owner(self, x, y):
+        """
+        Rank owning the pixels containing image positions x, y (arrays). Positions off the image go to the nearest domain.
+
+        Input
+        x : Image x positions
+        y : Image y positions
+        """
+
+        xi = np.floor(np.asarray(x)+0.5)
+        yi = np.floor(np.asarray(y)+0.5)
+        i  = np.clip(np.searchsorted(self.edges_x[1:-1], xi, side='right'), 0, self.px-1)
+        j  = np.clip(np.searchsorted(self.edges_y[1:-1], yi, side='right'), 0, self.py-1)
+        return j*self.px+i
+
+    def mine(self, x, y):
+        """
+        Mask of the positions x, y owned by this proc.
+        """
+
+        return self.owner(x,y)==self.rank
+
+    def reduce(self, array, spill, root=0):
+        """
+        Send the halo of this proc's image and its spilled pieces to the owners of those pixels, add the pieces received from other procs to this proc's domain, and assemble the domains on root. Must be called by all procs.
+
+        Input
+        array : Image array of this proc (covering self.halo_bounds)
+        spill : List of (xmin, ymin, array) pieces of stamps outside self.halo_bounds
+        root  : Rank receiving the full image
+
+        Returns the full (ny, nx) image array on root, None elsewhere.
+        """
+
+        hb = self.halo_bounds
+        db = self.bounds
+        out = [[] for i in range(self.size)]
+        for j,d in enumerate(self.domains):
+            o = overlap(hb,d)
+            if (j!=self.rank) and (o is not None):
+                out[j].append((o[0],o[2],np.ascontiguousarray(array[o[2]-hb[2]:o[3]-hb[2]+1,o[0]-hb[0]:o[1]-hb[0]+1])))
+            for x0,y0,a in spill:
+                o = overlap((x0,x0+a.shape[1]-1,y0,y0+a.shape[0]-1),d)
+                if o is not None:
+                    out[j].append((o[0],o[2],np.ascontiguousarray(a[o[2]-y0:o[3]-y0+1,o[0]-x0:o[1]-x0+1])))
+
+        # Pieces are added in rank order, so the result does not depend on message timing
+        dom = array[db[2]-hb[2]:db[3]-hb[2]+1,db[0]-hb[0]:db[1]-hb[0]+1]
+        for pieces in self.comm.alltoall(out):
+            for x0,y0,a in pieces:
+                dom[y0-db[2]:y0-db[2]+a.shape[0],x0-db[0]:x0-db[0]+a.shape[1]] += a
+
+        doms = self.comm.gather(np.ascontiguousarray(dom), root=root)
+        if self.rank != root:
+            return None
+        full = np.zeros((self.ny,self.nx))
+        for d,a in zip(self.domains,doms):
+            full[d[2]-1:d[3],d[0]-1:d[1]] = a
+        return full
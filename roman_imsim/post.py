@@ -50,6 +50,8 @@ from .misc import hsm
 from .misc import get_filename
 from .misc import get_filenames
 from .misc import write_fits
+from .compress import gzip_file
+from .compress import gunzip_file
 
 # Converts galsim Roman filter names to indices in Chris' dither file.
 filter_dither_dict = {
@@ -364,7 +366,7 @@ class postprocessing(roman_sim):
             fits_.append( fits.ImageHDU(data=psf_stamp.array,header=hdr, name=str(sca)) )
         new_fits_file = fits.HDUList(fits_)
         new_fits_file.writeto(psf_filename,overwrite=True)
-        os.system('gzip '+psf_filename)
+        gzip_file(psf_filename,threads=self.params.get('compress_threads',4))
 
     def near_coadd(self,ra,dec):
         x = np.cos(dec) * np.cos(ra)
@@ -508,6 +510,8 @@ class postprocessing(roman_sim):
         tilename  = coaddlist['tilename']
         filter_ = filter_dither_dict_[f+1]
         print(filter_)
+        # Temporary directory unique to this job (the process id when not running under slurm)
+        tmp_coadd = 'tmp_coadd'+os.getenv('SLURM_ARRAY_JOB_ID',str(os.getpid()))+'_'+os.getenv('SLURM_ARRAY_TASK_ID','0')
 
 
         filename = get_filename(self.params['out_path'],
@@ -519,14 +523,14 @@ class postprocessing(roman_sim):
         if os.path.exists(filename):
             return
         filename_ = get_filename(self.params['tmpdir'],
-                                'tmp_coadd'+os.getenv('SLURM_ARRAY_JOB_ID')+'_'+os.getenv('SLURM_ARRAY_TASK_ID'),
+                                tmp_coadd,
                                 self.params['output_meds'],
                                 var=filter_+'_'+tilename,
                                 ftype='fits',
                                 overwrite=True)
 
         filename_noise = get_filename(self.params['tmpdir'],
-                                'tmp_coadd'+os.getenv('SLURM_ARRAY_JOB_ID')+'_'+os.getenv('SLURM_ARRAY_TASK_ID'),
+                                tmp_coadd,
                                 self.params['output_meds'],
                                 var=filter_+'_'+tilename+'_noise',
                                 ftype='fits',
@@ -550,7 +554,7 @@ class postprocessing(roman_sim):
                 overwrite=False)
             if os.path.exists(tmp_filename):
                 tmp_filename_ = get_filename(self.params['tmpdir'],
-                    'tmp_coadd'+os.getenv('SLURM_ARRAY_JOB_ID')+'_'+os.getenv('SLURM_ARRAY_TASK_ID'),
+                    tmp_coadd,
                     self.params['output_meds'],
                     var=filter_+'_'+str(int(d))+'_'+str(int(sca)),
                     ftype='fits',
@@ -558,8 +562,7 @@ class postprocessing(roman_sim):
 
                 #if not os.path.exists(filename_[:-5] + '_flt.fits'):
                 if not os.path.exists(tmp_filename_):
-                    shutil.copy(tmp_filename,tmp_filename_+'.gz')
-                    os.system('gunzip '+tmp_filename_+'.gz')
+                    gunzip_file(tmp_filename,out=tmp_filename_,remove=False)
 
                 input_list.append(tmp_filename_)
             else:
@@ -621,7 +624,7 @@ class postprocessing(roman_sim):
                     overwrite=False)
                 if os.path.exists(tmp_filename):
                     tmp_filename_ = get_filename(self.params['tmpdir'],
-                        'tmp_coadd'+os.getenv('SLURM_ARRAY_JOB_ID')+'_'+os.getenv('SLURM_ARRAY_TASK_ID'),
+                        tmp_coadd,
                         self.params['output_meds'],
                         var=filter_+'_'+str(int(d))+'_'+str(int(sca)),
                         ftype='fits',
@@ -637,7 +640,7 @@ class postprocessing(roman_sim):
                 #sky_mean = np.mean(sky.array[:,:])
                 sky.array[:,:] -= sky_mean
                 tmp_filename_noise = get_filename(self.params['tmpdir'],
-                    'tmp_coadd'+os.getenv('SLURM_ARRAY_JOB_ID')+'_'+os.getenv('SLURM_ARRAY_TASK_ID'),
+                    tmp_coadd,
                     self.params['output_meds'],
                     var=filter_+'_'+str(int(d))+'_'+str(int(sca))+'_noise',
                     ftype='fits',
@@ -676,11 +679,9 @@ class postprocessing(roman_sim):
 
         # self.get_coadd_psf(filename_,filter_+'_'+tilename,d_list,sca_list)
 
-        os.system('gzip '+filename_)
-        shutil.copy(filename_+'.gz',filename)
-        os.remove(filename_+'.gz')
+        gzip_file(filename_,out=filename,threads=self.params.get('compress_threads',4))
         os.remove(filename_noise)
-        shutil.rmtree(os.path.join(self.params['tmpdir'],'tmp_coadd'+os.getenv('SLURM_ARRAY_JOB_ID')+'_'+os.getenv('SLURM_ARRAY_TASK_ID')))
+        shutil.rmtree(os.path.join(self.params['tmpdir'],tmp_coadd))
 
     def get_coadd_psf(self,filename_,filetag,d_list,sca_list):
 
@@ -757,9 +758,7 @@ class postprocessing(roman_sim):
             fits_.append( fits.ImageHDU(data=psf_stamp.array,header=hdr, name=str(c)) )
         new_fits_file = fits.HDUList(fits_)
         new_fits_file.writeto(psf_filename_,overwrite=True)
-        os.system('gzip '+psf_filename_)
-        shutil.copy(psf_filename_+'.gz',psf_filename)
-        os.remove(psf_filename_+'.gz')
+        gzip_file(psf_filename_,out=psf_filename,threads=self.params.get('compress_threads',4))
 
 
     def get_coadd_psf_stamp(self,coadd_file,coadd_psf_file,x,y,stamp_size,oversample_factor=1):
@@ -897,8 +896,7 @@ class postprocessing(roman_sim):
                             ftype='fits',
                             overwrite=False)
                 coadd_filelist.append(coaddfilename_)
-                shutil.copy(coaddfilename,coaddfilename_+'.gz')
-                os.system('gunzip '+coaddfilename_+'.gz')
+                gunzip_file(coaddfilename,out=coaddfilename_,remove=False)
                 coadd_imgs.append( fio.FITS(coaddfilename_)['SCI'].read() )
                 err_imgs.append( fio.FITS(coaddfilename_)['ERR'].read() )
                 if f==0:
@@ -1146,9 +1144,7 @@ class postprocessing(roman_sim):
                     ftype='fits',
                     overwrite=False)
         os.system('/hpc/group/cosmology/bin/bin/sex  '+detcoaddfilename_+'[1],'+detcoaddfilename_+'[1]  -c  /hpc/group/cosmology/repos/sextractor-2.25.0/default.config -DETECT_THRESH 2.5 -ANALYSIS_THRESH 2.5 -DEBLEND_MINCONT 0.05 -CATALOG_NAME '+filename_+' -CHECKIMAGE_NAME '+segfilename_)
-        os.system('gzip '+segfilename_)
-        shutil.copy(segfilename_+'.gz',segfilename)
-        os.remove(segfilename_+'.gz')
+        gzip_file(segfilename_,out=segfilename,threads=self.params.get('compress_threads',4))
         tmp = fio.FITS(filename_)[-1].read()
         os.remove(filename_)
         names = np.array(tmp.dtype.names)
@@ -1313,4 +1309,4 @@ class postprocessing(roman_sim):
                                 overwrite=True)
         print(filename,gal)
         fio.write(filename,gal,clobber=True)
-        os.system('gzip '+filename)
+        gzip_file(filename,threads=self.params.get('compress_threads',4))
@@ -0,0 +1,460 @@
+import numpy as np
+import sys, os, io
+import math
+import time
+import threading
+import collections
+import galsim as galsim
+import galsim.roman as roman
+import fitsio as fio
+
+from .misc import ParamError
+from .misc import get_filename
+
+
+class bright_star_psf(object):
+    """
+    Rendering engine for very bright stars. Instead of convolving each bright star with a pupil_bin=2/1 optical PSF in an FFT stamp of up to 8176 pixels, a unit-flux PSF image covering both the core and the wings is drawn once per (SCA, filter, pupil_bin, stamp size) at the SCA center, and cached on disk. A bright star is then rendered by sub-pixel shifting that image (Fourier phase shift), scaling it to the star's flux and adding Poisson noise.
+
+    Without line of sight motion or time-dependent aberrations, the pixel-frame PSF image does not depend on the position angle or time of the pointing, so the cache is reused across dithers. Otherwise (los_motion is sheared in world coordinates, and may be dropped on random dithers) the cached images are kept per dither. It does ignore the small change of the local WCS across the SCA; bright_star_check/bright_star_tol can be used to compare against the exact FFT path.
+    """
+
+    def __init__(self, params, pointing):
+        """
+        Input
+        params   : parameter dict
+        pointing : Pointing object (with SCA assigned)
+        """
+
+        self.params    = params
+        self.pointing  = pointing
+        self.mag_limit = self.params.get('bright_star_mag',10.)
+        self.n_check   = self.params.get('bright_star_check',1)
+        self.tol       = self.params.get('bright_star_tol',1e-3)
+        self.enabled   = True
+        self.n_checked = 0
+        self.images    = {}
+        self.lock      = threading.Lock()
+
+        # The cached images are drawn with the WCS at the center of the SCA
+        self.center    = galsim.PositionD(roman.n_pix/2.+0.5, roman.n_pix/2.+0.5)
+        self.local_wcs = self.pointing.WCS.local(self.center)
+
+    def get_psf(self, mag):
+        """
+        Return the pupil_bin and PSF (with gsparams) used for a star of this magnitude. Mirrors draw_image.star_model().
+
+        Input
+        mag : Star magnitude
+        """
+
+        if mag<0:
+            pupil_bin = 1
+            psf = self.pointing.load_psf(self.center.round(),pupil_bin=1)
+            psf = psf.withGSParams(galsim.GSParams(folding_threshold=5e-5,maximum_fft_size=16384 ))
+        elif mag<12:
+            pupil_bin = 2
+            psf = self.pointing.load_psf(self.center.round(),pupil_bin=2)
+            psf = psf.withGSParams(galsim.GSParams(folding_threshold=1e-4))
+        else:
+            pupil_bin = 4
+            psf = self.pointing.load_psf(self.center.round(),pupil_bin=4)
+            psf = psf.withGSParams(galsim.GSParams(folding_threshold=1e-3))
+
+        if self.pointing.los_motion is not None:
+            psf = galsim.Convolve(psf, self.pointing.los_motion)
+
+        return pupil_bin,psf
+
+    def get_filename(self, pupil_bin, n):
+
+        name2 = 'bright_'+str(pupil_bin)+'_'+str(n)
+        if (self.pointing.los_motion is not None) or self.params.get('oscillating_aberration',False):
+            name2 += '_'+str(self.pointing.dither)
+        return get_filename(self.params['out_path'],
+                            'psf',
+                            self.params['output_meds'],
+                            var=self.pointing.filter+'_'+str(self.pointing.sca),
+                            name2=name2,
+                            ftype='fits',
+                            overwrite=False)
+
+    def get_image(self, mag, n):
+        """
+        Return the Fourier transform of the cached unit-flux PSF image of size nxn for a star of this magnitude. Loaded from disk if it exists, otherwise drawn and saved.
+
+        Input
+        mag : Star magnitude
+        n   : Stamp size in pixels
+        """
+
+        pupil_bin,psf = self.get_psf(mag)
+        key = (pupil_bin,n)
+        with self.lock:
+            if key not in self.images:
+                filename = self.get_filename(pupil_bin,n)
+                if os.path.exists(filename):
+                    img = fio.FITS(filename)[-1].read()
+                else:
+                    t0 = time.time()
+                    img = psf.drawImage(nx=n, ny=n, wcs=self.local_wcs).array
+                    img /= np.sum(img)
+                    hdr = {'SCA' : self.pointing.sca, 'FILTER' : self.pointing.filter, 'PUPILBIN' : pupil_bin}
+                    # Other procs may be reading or writing the same file, so it is replaced atomically
+                    tmp = filename+'.'+str(os.getpid())+'.tmp'
+                    fio.write(tmp, img, header=hdr, clobber=True)
+                    os.replace(tmp, filename)
+                    print('Built bright star PSF image',pupil_bin,n,time.time()-t0)
+                self.images[key] = np.fft.rfft2(img)
+
+        return self.images[key]
+
+    def draw_noiseless(self, mag, flux, offset, b):
+        """
+        Render a noiseless star image by shifting and scaling the cached PSF image.
+
+        Input
+        mag    : Star magnitude
+        flux   : Star flux in photons
+        offset : Offset of star from the true center of the stamp (PositionD)
+        b      : Stamp bounds
+        """
+
+        n = b.xmax-b.xmin+1
+        if n != b.ymax-b.ymin+1:
+            raise ParamError('Bright star stamps must be square.')
+
+        ft = self.get_image(mag,n)
+
+        # Separable Fourier phase ramp for the sub-pixel shift
+        ky = np.exp(-2j*np.pi*np.fft.fftfreq(n)*offset.y)
+        kx = np.exp(-2j*np.pi*np.fft.rfftfreq(n)*offset.x)
+        arr = np.fft.irfft2(ft*ky[:,None]*kx[None,:], s=(n,n))
+        arr *= flux
+        arr.clip(0.,out=arr)
+
+        return galsim.Image(arr, xmin=b.xmin, ymin=b.ymin, wcs=self.pointing.WCS)
+
+    def draw(self, st_model, mag, xy, b, rng, bpass):
+        """
+        Draw a bright star with Poisson noise. Returns None if the engine has been disabled by a failed accuracy check, in which case the caller should use the exact FFT path.
+
+        Input
+        st_model : Galsim star model (convolved with the PSF), used for the flux and accuracy checks
+        mag      : Star magnitude
+        xy       : Image position of star
+        b        : Stamp bounds
+        rng      : Galsim random number generator for this star
+        bpass    : Bandpass
+        """
+
+        if not self.enabled:
+            return None
+
+        flux   = st_model.calculateFlux(bpass)
+        offset = xy-b.true_center
+        stamp  = self.draw_noiseless(mag,flux,offset,b)
+
+        # Compare against the exact FFT path for the first few stars on this SCA
+        if self.n_checked < self.n_check:
+            self.n_checked += 1
+            exact = galsim.Image(b, wcs=self.pointing.WCS)
+            st_model.drawImage(bpass,image=exact,offset=offset)
+            resid = np.sum(np.abs(exact.array-stamp.array))/flux
+            print('Bright star engine check',mag,resid)
+            if resid > self.tol:
+                print('Bright star engine residual above tolerance, falling back to exact drawing for SCA '+str(self.pointing.sca))
+                self.enabled = False
+                return None
+
+        stamp.addNoise(galsim.PoissonNoise(rng))
+
+        return stamp
+
+
+class point_source_bank(object):
+    """
+    Bank of pixelated PSF images for faint point sources. For each (SCA, filter, SED color bin) the PSF of a unit-flux point source is drawn once on a grid of n_phase x n_phase sub-pixel phases. Faint stars are then drawn by picking the nearest phase, scaling to the star's flux and adding Poisson noise, instead of building and photon-shooting a chromatic DeltaFunction * SED model per star.
+
+    Positions, fluxes, phases and color bins for all stars on the SCA are computed in one vectorized batch by prepare(). The color of an SED is its magnitude difference between the blue and red halves of the bandpass, and each color bin is represented by the first SED (in catalog order) that falls in it.
+
+    The bank images only cover psf_bank_stamp pixels, while the photon-shooting path draws the PSF wings out to 800 pixels. Each bank image is normalised to unit flux, so the total flux of a star is kept and the flux of the wings beyond the stamp (reported when the images are drawn) is put into the stamp. The first psf_bank_check stars on each proc are compared against an exact drawing of the same stamp, and the bank is disabled (falling back to the exact path) if the residual is above psf_bank_tol.
+
+    Stars are drawn in chunks of psf_bank_chunk stars of the proc's star list: the images of all bank stars in a chunk are scaled to their fluxes and Poisson noised in one vectorized pass, from a random stream of the chunk. The noise of bank stars therefore depends on the assignment of stars to procs, unlike the per-star random streams of the other paths.
+    """
+
+    def __init__(self, params, pointing, rank=0):
+        """
+        Input
+        params   : parameter dict
+        pointing : Pointing object (with SCA assigned)
+        rank     : Rank of the proc, for the random streams of the chunks
+        """
+
+        self.params      = params
+        self.pointing    = pointing
+        self.mag_limit   = self.params.get('psf_bank_mag',15.)
+        self.n_check     = self.params.get('psf_bank_check',1)
+        self.tol         = self.params.get('psf_bank_tol',0.1)
+        self.chunk       = self.params.get('psf_bank_chunk',256)
+        self.seed        = np.random.SeedSequence([self.params['random_seed'], self.pointing.dither, self.pointing.sca, rank])
+        self.enabled     = True
+        self.n_checked   = 0
+        self.chunks      = collections.OrderedDict()
+        self.n_phase     = self.params.get('psf_bank_phases',4)
+        self.n           = 2*(self.params.get('psf_bank_stamp',64)//2)+1 # Odd, so the stamp is centered on a pixel
+        self.color_edges = np.array(self.params.get('psf_bank_color_edges',[-0.3,-0.2,-0.1,0.,0.1,0.2,0.3]))
+        self.images      = {}
+        self.seds        = {}
+        self.prepared    = False
+        self.lock        = threading.Lock()
+
+        self.center      = galsim.PositionD(roman.n_pix/2.+0.5, roman.n_pix/2.+0.5)
+        self.local_wcs   = self.pointing.WCS.local(self.center)
+
+        wave             = self.pointing.bpass.effective_wavelength
+        self.blue        = self.pointing.bpass.truncate(red_limit=wave).withZeropoint('AB')
+        self.red         = self.pointing.bpass.truncate(blue_limit=wave).withZeropoint('AB')
+
+    def get_color_bin(self, sed):
+        """
+        Return the color bin of an SED.
+
+        Input
+        sed : Galsim SED
+        """
+
+        color = sed.calculateMagnitude(self.blue)-sed.calculateMagnitude(self.red)
+
+        return int(np.digitize(color, self.color_edges))
+
+    def prepare(self, ra, dec, mag, sed_keys, seds):
+        """
+        Vectorized setup for all point sources on the SCA.
+
+        Input
+        ra       : Right ascension array of objects [radians]
+        dec      : Declination array of objects [radians]
+        mag      : Magnitude array of objects in this filter
+        sed_keys : Array of keys into seds for each object
+        seds     : Dict of Galsim SEDs
+        """
+
+        x,y = self.pointing.WCS.toImage(np.asarray(ra), np.asarray(dec), units=galsim.radians)
+        self.xi   = np.floor(x+0.5).astype(int)
+        self.yi   = np.floor(y+0.5).astype(int)
+        self.px   = np.clip(np.floor((x-self.xi+0.5)*self.n_phase), 0, self.n_phase-1).astype(int)
+        self.py   = np.clip(np.floor((y-self.yi+0.5)*self.n_phase), 0, self.n_phase-1).astype(int)
+        self.mag  = np.asarray(mag)
+        self.flux = 10**(-0.4*(self.mag-self.pointing.bpass.zeropoint))*roman.collecting_area*roman.exptime
+        self.use  = self.mag>self.mag_limit
+
+        # Color bin per SED, with the first SED in each bin as its representative
+        key_bin = {}
+        for key in sed_keys:
+            if key not in key_bin:
+                key_bin[key] = self.get_color_bin(seds[key])
+                if key_bin[key] not in self.seds:
+                    self.seds[key_bin[key]] = seds[key]
+        self.cbin = np.array([key_bin[key] for key in sed_keys],dtype=int)
+
+        self.prepared = True
+        print('PSF bank prepared for '+str(np.sum(self.use))+' faint point sources in '+str(len(self.seds))+' color bins.')
+
+    def get_images(self, cbin):
+        """
+        Return the (n_phase, n_phase, n, n) array of unit-flux PSF images for a color bin, drawing it if needed.
+
+        Input
+        cbin : Color bin
+        """
+
+        with self.lock:
+            if cbin not in self.images:
+                sed   = self.seds[cbin].withFlux(1.,self.pointing.bpass)
+                model = galsim.Convolve(galsim.DeltaFunction()*sed, self.pointing.load_psf(self.center.round()))
+                if self.pointing.los_motion is not None:
+                    model = galsim.Convolve(model, self.pointing.los_motion)
+                images = np.zeros((self.n_phase,self.n_phase,self.n,self.n))
+                for j in range(self.n_phase):
+                    for i in range(self.n_phase):
+                        offset = galsim.PositionD((i+0.5)/self.n_phase-0.5,(j+0.5)/self.n_phase-0.5)
+                        images[j,i] = model.drawImage(self.pointing.bpass,nx=self.n,ny=self.n,wcs=self.local_wcs,offset=offset).array
+                # Keep the total flux of the star, which includes the wings beyond the stamp
+                enclosed = np.sum(images,axis=(2,3))
+                images  /= enclosed[:,:,None,None]
+                print('PSF bank color bin '+str(cbin)+': stamp of '+str(self.n)+' pixels holds '+str(np.mean(enclosed))+' of the flux, normalised to 1')
+                self.images[cbin] = images
+
+        return self.images[cbin]
+
+    def get_chunk(self, c):
+        """
+        Return the (chunk, n, n) array of Poisson noised images of chunk c of the point sources (objects c*chunk to (c+1)*chunk-1 of the arrays passed to prepare()), drawing it if needed. The images of all bank sources in the chunk are scaled to their fluxes and noised in one vectorized pass; the images of other sources are left empty. The last few chunks are kept, and a chunk that is drawn again gets the same noise.
+
+        Input
+        c : Chunk number
+        """
+
+        with self.lock:
+            if c in self.chunks:
+                self.chunks.move_to_end(c)
+                return self.chunks[c]
+
+        k0  = c*self.chunk
+        k   = np.arange(k0,min(k0+self.chunk,len(self.flux)))
+        k   = k[self.use[k]]
+        lam = np.zeros((self.chunk,self.n,self.n))
+        for cbin in np.unique(self.cbin[k]):
+            kb = k[self.cbin[k]==cbin]
+            lam[kb-k0] = self.get_images(cbin)[self.py[kb],self.px[kb]]*self.flux[kb,None,None]
+        rng   = np.random.default_rng(np.random.SeedSequence(self.seed.entropy, spawn_key=self.seed.spawn_key+(c,)))
+        chunk = rng.poisson(lam).astype(float)
+
+        with self.lock:
+            self.chunks[c] = chunk
+            if len(self.chunks)>4:
+                self.chunks.popitem(last=False)
+
+        return chunk
+
+    def draw(self, k):
+        """
+        Return point source k (index into the arrays passed to prepare()) with Poisson noise, from its chunk.
+
+        Input
+        k : Object index
+        """
+
+        c   = k//self.chunk
+        img = self.get_chunk(c)[k-c*self.chunk]
+        return galsim.Image(img,
+                            xmin=self.xi[k]-self.n//2,
+                            ymin=self.yi[k]-self.n//2,
+                            wcs=self.pointing.WCS)
+
+    def needs_check(self):
+        """
+        Return True for the first n_check calls, for the point sources that are also drawn exactly by the caller and passed to check().
+        """
+
+        with self.lock:
+            if self.n_checked >= self.n_check:
+                return False
+            self.n_checked += 1
+            return True
+
+    def check(self, k, exact):
+        """
+        Compare the noiseless bank image of point source k with its exact drawing on the same pixels, and disable the bank if the residual is above tol. Returns whether the bank is still enabled.
+
+        Input
+        k     : Object index
+        exact : Noiseless n x n image array of the exact model
+        """
+
+        img   = self.flux[k]*self.get_images(self.cbin[k])[self.py[k],self.px[k]]
+        resid = np.sum(np.abs(exact-img))/self.flux[k]
+        print('PSF bank check',self.mag[k],resid)
+        if resid > self.tol:
+            print('PSF bank residual above tolerance, falling back to exact drawing for SCA '+str(self.pointing.sca))
+            self.enabled = False
+
+        return self.enabled
+
+
+class true_psf_cache(object):
+    """
+    Cache of the oversampled true PSF stamps drawn for galaxies when draw_true_psf is set. The PSF model is constant across the SCA and is drawn centered on the stamp, so the stamp only depends on the local WCS. Stamps are keyed on the local Jacobian quantized to true_psf_jac_quantum (arcsec/pixel); the first galaxy in each bin sets the stamp. Each unique stamp gets an integer ID that the galaxy stamps reference, and is written once by write(). Each proc numbers its own stamps from 0; gather() collects them on one proc and gives the shift of each proc's IDs.
+    """
+
+    def __init__(self, params):
+        """
+        Input
+        params : parameter dict
+        """
+
+        self.params  = params
+        self.quantum = self.params.get('true_psf_jac_quantum',1e-5)
+        self.ids     = {}
+        self.stamps  = []
+        self.lock    = threading.Lock()
+
+    def get_key(self, local_wcs):
+
+        jac = np.array([local_wcs.dudx,local_wcs.dudy,local_wcs.dvdx,local_wcs.dvdy])
+
+        return tuple(np.round(jac/self.quantum).astype(int))
+
+    def get(self, local_wcs, xyI, make_psf):
+        """
+        Return the ID and true PSF stamp for an object at integer position xyI with this local WCS. The stamp shares its pixel array with the cached one, with bounds moved to xyI.
+
+        Input
+        local_wcs : Local WCS at the object position
+        xyI       : Integer image position of the object
+        make_psf  : Function that draws the PSF stamp at the current object on a cache miss
+        """
+
+        key = self.get_key(local_wcs)
+        with self.lock:
+            psf_id = self.ids.get(key)
+        if psf_id is None:
+            psf = make_psf()
+            with self.lock:
+                if key not in self.ids:
+                    self.ids[key] = len(self.stamps)
+                    self.stamps.append((psf, xyI))
+                psf_id = self.ids[key]
+
+        psf,xyI0 = self.stamps[psf_id]
+
+        return psf_id,galsim.Image(psf.array,
+                                   xmin=psf.bounds.xmin+xyI.x-xyI0.x,
+                                   ymin=psf.bounds.ymin+xyI.y-xyI0.y,
+                                   wcs=psf.wcs)
+
+    def gather(self, comm, root=0):
+        """
+        Collect the stamps of all procs on rank root, in rank order, so that write() there writes a single file for the SCA. A stamp with psf_id i on proc r becomes psf_id i+offsets[r]. Must be called by all procs, after drawing.
+
+        Input
+        comm : MPI or local_comm communicator
+        root : Rank receiving the stamps
+
+        Returns the offsets on root, and None on other ranks.
+        """
+
+        stamps = comm.gather(self.stamps, root=root)
+        if comm.Get_rank() != root:
+            return None
+        offsets     = np.append(0,np.cumsum([len(s) for s in stamps]))
+        self.stamps = [stamp for s in stamps for stamp in s]
+        self.ids    = {}
+
+        return offsets
+
+    def write(self, filename):
+        """
+        Write each unique PSF stamp once, as an (n_psf, N, N) image cube, plus a table of the oversampled Jacobian of each stamp. Row i of both corresponds to psf_id i.
+
+        Input
+        filename : Fits filename
+        """
+
+        if len(self.stamps)==0:
+            return
+
+        cube = np.stack([psf.array for psf,xyI0 in self.stamps])
+        jac  = np.zeros(len(self.stamps),dtype=[('psf_id','i8'), ('dudx',float), ('dudy',float), ('dvdx',float), ('dvdy',float)])
+        for i,(psf,xyI0) in enumerate(self.stamps):
+            jac['psf_id'][i] = i
+            jac['dudx'][i]   = psf.wcs.dudx
+            jac['dudy'][i]   = psf.wcs.dudy
+            jac['dvdx'][i]   = psf.wcs.dvdx
+            jac['dvdy'][i]   = psf.wcs.dvdy
+
+        fits = fio.FITS(filename,'rw',clobber=True)
+        fits.write(cube,extname='psf_cutouts')
+        fits.write(jac,extname='psf_info')
+        fits.close()
@@ -56,6 +56,17 @@ from .misc import hsm
 from .misc import get_filename
 from .misc import get_filenames
 from .misc import write_fits
+from .stamps import stamp_pipeline
+from .stamps import stamp_index
+from .stamps import fits_stamp_writer
+from .stamps import container_stamp_writer
+from .stamps import stamp_container
+from .checkpoint import sca_checkpoint
+from .compress import gzip_file
+from .compress import gunzip_file
+from .parallel import fork_local_comm
+from .parallel import reduce_image
+from .parallel import gather_table
 
 # Converts galsim Roman filter names to indices in Chris' dither file.
 filter_dither_dict = {
@@ -108,6 +119,12 @@ class roman_sim(object):
             self.rank = self.comm.Get_rank()
             self.size = self.comm.Get_size()
             print('doing mpi')
+        elif self.params.get('local_procs',1)>1:
+            # Fork into local_procs processes on this node, which run the same code paths as MPI ranks
+            self.comm = fork_local_comm(self.params['local_procs'])
+            self.rank = self.comm.Get_rank()
+            self.size = self.comm.Get_size()
+            print('doing local processes')
         else:
             self.comm = None
             self.rank = 0
@@ -119,6 +136,9 @@ class roman_sim(object):
         logging.basicConfig(format="%(message)s", level=logging.INFO, stream=sys.stdout)
         self.logger = logging.getLogger('roman_sim')
 
+        # Truth catalog links and SEDs kept between setup() calls (see iterate_batch())
+        self.cat_cache = {}
+
         return
 
     def setup(self,filter_,dither,sca=1,setup=False,load_cats=True):
@@ -159,7 +179,7 @@ class roman_sim(object):
         self.gal_rng = galsim.UniformDeviate(self.params['random_seed'])
         # This checks whether a truth galaxy/star catalog exist. If it doesn't exist, it is created based on specifications in the yaml file. It then sets up links to the truth catalogs on disk.
         if load_cats:
-            self.cats     = init_catalogs(self.params, self.pointing, self.gal_rng, self.rank, self.size, comm=self.comm, setup=setup)
+            self.cats     = init_catalogs(self.params, self.pointing, self.gal_rng, self.rank, self.size, comm=self.comm, setup=setup, cache=self.cat_cache)
 
         print('Done with init_catalogs')
 
@@ -211,11 +231,88 @@ class roman_sim(object):
             mask_sca_supernova = self.pointing.in_sca(self.cats.supernovae['ra'][:],self.cats.supernovae['dec'][:])
         self.cats.add_mask(mask_sca,star_mask=mask_sca_star,supernova_mask=mask_sca_supernova)
 
+    def iterate_batch(self,filter_,tasks,verify_output=False):
+        """
+        Simulate a list of (dither, SCA) tasks in this process (or MPI communicator). Truth catalog links, the SED library, the bandpasses and the survey file stay loaded between tasks instead of being reloaded for each one, and every task writes the same outputs as a separate run.
+
+        Input
+        filter_       : A filter name. 'None' to determine by dither.
+        tasks         : List of (dither, sca) pairs
+        verify_output : Skip tasks whose output already exists
+        """
+
+        for dither,sca in tasks:
+            dither = int(dither)
+            sca    = int(sca)
+            t0     = time.time()
+            if verify_output:
+                if self.check_file(sca,dither,filter_):
+                    print('exists',dither,sca)
+                    continue
+            skip = self.setup(filter_,dither,sca=sca)
+            if self.comm is not None:
+                # Objects are split over procs, so the task is only skipped if no proc has any
+                skip = all(self.comm.allgather(skip))
+            if skip:
+                self.cats.close()
+                print('Skipping task',dither,sca)
+                continue
+            if self.comm is not None:
+                self.comm.Barrier()
+            # This sets up the object that will simulate various roman detector effects, noise, etc.
+            self.modify_image = modify_image(self.params,self.pointing)
+            if self.comm is not None:
+                self.comm.Barrier()
+            self.iterate_image()
+            if self.comm is not None:
+                self.comm.Barrier()
+            # Free this task's object lists, leaving the cached catalogs for the next task
+            self.cats.close()
+            self.draw_image = None
+            print('Done with task',dither,sca,time.time()-t0)
+
     def iterate_image(self):
         """
         This is the main simulation. It instantiates the draw_image object, then iterates over all galaxies and stars. The output is then accumulated from other processes (if mpi is enabled), and saved to disk.
         """
 
+        # Galaxy, star and supernova stamps are written either to a flat fits file (gzipped afterwards) or to a chunked, compressed stamp container
+        use_container = self.params.get('stamp_container',False)
+        if use_container:
+            stamp_ftype = 'stamps'
+        else:
+            stamp_ftype = 'fits'
+
+        # Checkpoints of the drawing are kept next to the stamp files, so a restarted job resumes from the last one as long as that directory survives
+        self.checkpoint       = None
+        self.checkpoint_state = None
+        self.index_tables     = {}
+        if self.params.get('checkpoint_interval',None) is not None:
+            if self.params.get('shared_sca',False) and (self.comm is not None):
+                raise ParamError('Checkpoints are not supported with shared_sca, as each proc only saves its own part of the SCA image.')
+            if 'tmpdir' in self.params:
+                checkpoint_filename = get_filename(self.params['tmpdir'],
+                                                   '',
+                                                   self.params['output_meds'],
+                                                   var=self.pointing.filter+'_'+str(self.pointing.dither),
+                                                   name2=str(self.pointing.sca)+'_'+str(self.rank),
+                                                   ftype='ckpt',
+                                                   overwrite=False)
+            else:
+                checkpoint_filename = get_filename(self.params['out_path'],
+                                                   'stamps',
+                                                   self.params['output_meds'],
+                                                   var=self.pointing.filter+'_'+str(self.pointing.dither),
+                                                   name2=str(self.pointing.sca)+'_'+str(self.rank),
+                                                   ftype='ckpt',
+                                                   overwrite=False)
+            self.checkpoint       = sca_checkpoint(checkpoint_filename,self.params['checkpoint_interval'])
+            self.checkpoint_state = self.checkpoint.load()
+            if self.checkpoint_state is not None:
+                self.index_tables = self.checkpoint_state['tables']
+        # Don't remove the partial stamp files of a checkpoint
+        overwrite = self.checkpoint_state is None
+
         # Build file name path for stampe dictionary pickle
         if 'tmpdir' in self.params:
             filename = get_filename(self.params['tmpdir'],
@@ -223,51 +320,51 @@ class roman_sim(object):
                                     self.params['output_meds'],
                                     var=self.pointing.filter+'_'+str(self.pointing.dither),
                                     name2=str(self.pointing.sca)+'_'+str(self.rank),
-                                    ftype='fits',
-                                    overwrite=True)
+                                    ftype=stamp_ftype,
+                                    overwrite=overwrite)
             filename_ = get_filename(self.params['out_path'],
                                     'stamps',
                                     self.params['output_meds'],
                                     var=self.pointing.filter+'_'+str(self.pointing.dither),
                                     name2=str(self.pointing.sca)+'_'+str(self.rank),
-                                    ftype='fits',
-                                    overwrite=True)
+                                    ftype=stamp_ftype,
+                                    overwrite=overwrite)
             supernova_filename = get_filename(self.params['tmpdir'],
                                           '',
                                           self.params['output_meds'],
                                           var=self.pointing.filter+'_'+str(self.pointing.dither),
                                           name2=str(self.pointing.sca)+'_'+str(self.rank)+'_supernova',
-                                          ftype='cPickle',
-                                          overwrite=True)
+                                          ftype=stamp_ftype,
+                                          overwrite=overwrite)
             supernova_filename_ = get_filename(self.params['out_path'],
                                           'stamps',
                                           self.params['output_meds'],
                                           var=self.pointing.filter+'_'+str(self.pointing.dither),
                                           name2=str(self.pointing.sca)+'_'+str(self.rank)+'_supernova',
-                                          ftype='cPickle',
-                                          overwrite=True)
+                                          ftype=stamp_ftype,
+                                          overwrite=overwrite)
             star_filename = get_filename(self.params['tmpdir'],
                                           '',
                                           self.params['output_meds'],
                                           var=self.pointing.filter+'_'+str(self.pointing.dither),
                                           name2=str(self.pointing.sca)+'_'+str(self.rank)+'_star',
-                                          ftype='fits',
-                                          overwrite=True)
+                                          ftype=stamp_ftype,
+                                          overwrite=overwrite)
             star_filename_ = get_filename(self.params['out_path'],
                                           'stamps',
                                           self.params['output_meds'],
                                           var=self.pointing.filter+'_'+str(self.pointing.dither),
                                           name2=str(self.pointing.sca)+'_'+str(self.rank)+'_star',
-                                          ftype='fits',
-                                          overwrite=True)
+                                          ftype=stamp_ftype,
+                                          overwrite=overwrite)
         else:
             filename = get_filename(self.params['out_path'],
                                     'stamps',
                                     self.params['output_meds'],
                                     var=self.pointing.filter+'_'+str(self.pointing.dither),
                                     name2=str(self.pointing.sca)+'_'+str(self.rank),
-                                    ftype='fits',
-                                    overwrite=True)
+                                    ftype=stamp_ftype,
+                                    overwrite=overwrite)
             filename_ = None
 
             supernova_filename = get_filename(self.params['out_path'],
@@ -275,8 +372,8 @@ class roman_sim(object):
                                           self.params['output_meds'],
                                           var=self.pointing.filter+'_'+str(self.pointing.dither),
                                           name2=str(self.pointing.sca)+'_'+str(self.rank)+'_supernova',
-                                          ftype='cPickle',
-                                          overwrite=True)
+                                          ftype=stamp_ftype,
+                                          overwrite=overwrite)
             supernova_filename_ = None
             
             star_filename = get_filename(self.params['out_path'],
@@ -284,193 +381,109 @@ class roman_sim(object):
                                           self.params['output_meds'],
                                           var=self.pointing.filter+'_'+str(self.pointing.dither),
                                           name2=str(self.pointing.sca)+'_'+str(self.rank)+'_star',
-                                          ftype='fits',
-                                          overwrite=True)
+                                          ftype=stamp_ftype,
+                                          overwrite=overwrite)
             star_filename_ = None
 
         # Instantiate draw_image object. The input parameters, pointing object, modify_image object, truth catalog object, random number generator, logger, and galaxy & star indices are passed.
         # Instantiation defines some parameters, iterables, and image bounds, and creates an empty SCA image.
         self.draw_image = draw_image(self.params, self.pointing, self.modify_image, self.cats,  self.logger, rank=self.rank, comm=self.comm)
 
+        # Restore the partial SCA image (and true PSF stamps) of the checkpoint. Objects types finished before the checkpoint are not redrawn, and after a 'done' checkpoint only the outputs are written.
+        order = ['gal','star','supernova','done']
+        if self.checkpoint_state is not None:
+            self.draw_image.im.array[:,:] = self.checkpoint_state['im']
+            self.draw_image.touched[:,:]  = self.checkpoint_state.get('touched',True)
+            self.draw_image.spill         = self.checkpoint_state.get('spill',[])
+            if self.draw_image.true_psf is not None:
+                self.draw_image.true_psf.ids,self.draw_image.true_psf.stamps = self.checkpoint_state['true_psf']
+            if (self.draw_image.bright_star is not None) and (self.checkpoint_state.get('bright_star',None) is not None):
+                # Stars already compared against the exact FFT path are not checked again, and a disabled engine stays disabled
+                self.draw_image.bright_star.n_checked,self.draw_image.bright_star.enabled = self.checkpoint_state['bright_star']
+            if (self.draw_image.star_bank is not None) and (self.checkpoint_state.get('star_bank',None) is not None):
+                self.draw_image.star_bank.n_checked,self.draw_image.star_bank.enabled = self.checkpoint_state['star_bank']
+            done = order[:order.index(self.checkpoint_state['phase'])]
+        else:
+            done = []
+
         t0 = time.time()
-        t1 = time.time()
-        fits_length = 200000000
         index_table = None
         if self.cats.get_gal_length()!=0:#&(self.cats.get_star_length()==0):
             tmp,tmp_ = self.cats.get_gal_list()
             if len(tmp)!=0:
-                # Build indexing table for MEDS making later
-                index_table = np.zeros(50000,dtype=[('ind',int), ('sca','i8'), ('dither','i8'), ('x',float), ('y',float), ('ra',float), ('dec',float), ('mag',float), ('stamp','i8'), ('xmin','i8'), ('xmax','i8'), ('ymin','i8'), ('ymax','i8'), ('dudx',float), ('dudy',float), ('dvdx',float), ('dvdy',float), ('start_row',int)])
-                index_table['ind']=-999
-                # Objects to simulate
-                fits = fio.FITS(filename,'rw',clobber=True)
-                fits.write(np.zeros(100),extname='image_cutouts')
-                fits.write(np.zeros(100),extname='weight_cutouts')
-                fits['image_cutouts'].write(np.zeros(1),start=[fits_length])
-                fits['weight_cutouts'].write(np.zeros(1),start=[fits_length])
-                i=0
-                start_row = 0
-                # gals = {}
-                # Empty storage dictionary for postage stamp information
-                print('Attempting to simulate '+str(len(tmp))+' galaxies for SCA '+str(self.pointing.sca)+' and dither '+str(self.pointing.dither)+'.')
                 gal_list = tmp
-                while True:
+                if 'gal' in done:
+                    index_table = self.index_tables['gal']
+                else:
+                    print('Attempting to simulate '+str(len(tmp))+' galaxies for SCA '+str(self.pointing.sca)+' and dither '+str(self.pointing.dither)+'.')
                     # Loop over all galaxies near pointing and attempt to simulate them.
-                    g_ = None
-                    self.draw_image.iterate_gal()
-                    # print('sim',self.draw_image.ind,self.draw_image.gal_stamp_too_large)
-                    if self.draw_image.gal_done:
-                        break
-                    # Store postage stamp output in dictionary
-                    g_ = self.draw_image.retrieve_stamp()
-                    #print(g_)
-                    if g_ is not None:
-                        # gals[self.draw_image.ind] = g_
-                        #print(type(self.params['skip_stamps']),self.params['skip_stamps'])
-                        index_table['ind'][i]    = g_['ind']
-                        index_table['x'][i]      = g_['x']
-                        index_table['y'][i]      = g_['y']
-                        index_table['ra'][i]     = g_['ra']
-                        index_table['dec'][i]    = g_['dec']
-                        index_table['mag'][i]    = g_['mag']
-                        index_table['sca'][i]    = self.pointing.sca
-                        index_table['dither'][i] = self.pointing.dither
-                        if g_['gal'] is not None:
-                            # print('.....yes',g_['ind'])
-                            index_table['stamp'][i]  = g_['stamp']
-                            index_table['start_row'][i]  = start_row
-                            index_table['xmin'][i]   = g_['gal'].bounds.xmin
-                            index_table['xmax'][i]   = g_['gal'].bounds.xmax
-                            index_table['ymin'][i]   = g_['gal'].bounds.ymin
-                            index_table['ymax'][i]   = g_['gal'].bounds.ymax
-                            jac = g_['gal'].wcs.jacobian(galsim.PositionD(g_['x'],g_['y']))
-                            index_table['dudx'][i]   = jac.dudx
-                            index_table['dvdx'][i]   = jac.dvdx
-                            index_table['dudy'][i]   = jac.dudy
-                            index_table['dvdy'][i]   = jac.dvdy
-                            if fits_length-start_row<256**2*2:
-                                fits['image_cutouts'].write(np.zeros(1),start=[fits_length+256**2*100])
-                                fits['weight_cutouts'].write(np.zeros(1),start=[fits_length+256**2*100])
-                                fits_length+=256**2*100
-                            fits['image_cutouts'].write(g_['gal'].array.flatten(),start=[start_row])
-                            fits['weight_cutouts'].write(g_['weight'].flatten(),start=[start_row])
-                            start_row += g_['stamp']**2
-                        
-                        i+=1
-                        # if i%1000==0:
-                        #     print('time',time.time()-t1)
-                        #     t1 = time.time()
-                        # g_.clear()
-
-                index_table = index_table[:i]
-                if 'skip_stamps' in self.params:
-                    if self.params['skip_stamps']:
-                        os.remove(filename)
-                fits.close()
+                    # Build indexing table for MEDS making later
+                    index_table = self.draw_objects('gal',
+                                                    self.draw_image.draw_galaxies(),
+                                                    [('ind',int), ('sca','i8'), ('dither','i8'), ('x',float), ('y',float), ('ra',float), ('dec',float), ('mag',float), ('stamp','i8'), ('xmin','i8'), ('xmax','i8'), ('ymin','i8'), ('ymax','i8'), ('dudx',float), ('dudy',float), ('dvdx',float), ('dvdy',float), ('start_row',int), ('rank','i8'), ('psf_id','i8')],
+                                                    filename,
+                                                    200000000)
+
+                    if 'skip_stamps' in self.params:
+                        if self.params['skip_stamps']:
+                            os.remove(filename)
         print('galaxy time', time.time()-t0)
-        # pickle.dump_session('/hpc/group/cosmology/session.pkl')
-
 
         t1 = time.time()
         index_table_star = None
         tmp,tmp_ = self.cats.get_star_list()
-        if len(tmp)!=0:
-            index_table_star = np.zeros(500,dtype=[('ind',int), ('sca','i8'), ('dither','i8'), ('x',float), ('y',float), ('ra',float), ('dec',float), ('mag',float), ('stamp','i8'), ('xmin','i8'), ('xmax','i8'), ('ymin','i8'), ('ymax','i8'), ('dudx',float), ('dudy',float), ('dvdx',float), ('dvdy',float), ('start_row',int)])
-            index_table_star['ind']=-999
-            fits = fio.FITS(star_filename,'rw',clobber=True)
-            fits.write(np.zeros(100),extname='image_cutouts')
-            fits.write(np.zeros(100),extname='weight_cutouts')
-            fits['image_cutouts'].write(np.zeros(1),start=[6553600])
-            fits['weight_cutouts'].write(np.zeros(1),start=[6553600])
+        if (len(tmp)!=0) and ('star' in done):
+            index_table_star = self.index_tables['star']
+        elif len(tmp)!=0:
             print('Attempting to simulate '+str(len(tmp))+' stars for SCA '+str(self.pointing.sca)+' and dither '+str(self.pointing.dither)+'.')
-            i=0
-            start_row = 0
-            while True:
-                # Loop over all stars near pointing and attempt to simulate them. Stars aren't saved in postage stamp form.
-                self.draw_image.iterate_star()
-                if self.draw_image.star_done:
-                    break
-                s_ = self.draw_image.retrieve_star_stamp()
-                if s_ is not None:
-                    index_table_star['ind'][i]    = s_['ind']
-                    index_table_star['x'][i]      = s_['x']
-                    index_table_star['y'][i]      = s_['y']
-                    index_table_star['ra'][i]     = s_['ra']
-                    index_table_star['dec'][i]    = s_['dec']
-                    index_table_star['mag'][i]    = s_['mag']
-                    index_table_star['sca'][i]    = self.pointing.sca
-                    index_table_star['dither'][i] = self.pointing.dither
-                    if s_['star'] is not None:
-                        # print('.....yes',s_['ind'])
-                        index_table_star['stamp'][i]  = s_['stamp']
-                        index_table_star['start_row'][i]  = start_row
-                        index_table_star['xmin'][i]   = s_['star'].bounds.xmin
-                        index_table_star['xmax'][i]   = s_['star'].bounds.xmax
-                        index_table_star['ymin'][i]   = s_['star'].bounds.ymin
-                        index_table_star['ymax'][i]   = s_['star'].bounds.ymax
-                        jac = s_['star'].wcs.jacobian(galsim.PositionD(s_['x'],s_['y']))
-                        index_table_star['dudx'][i]   = jac.dudx
-                        index_table_star['dvdx'][i]   = jac.dvdx
-                        index_table_star['dudy'][i]   = jac.dudy
-                        index_table_star['dvdy'][i]   = jac.dvdy
-                        fits['image_cutouts'].write(s_['star'].array.flatten(),start=[start_row])
-                        fits['weight_cutouts'].write(s_['weight'].flatten(),start=[start_row])
-                        start_row += s_['stamp']**2
-                    i+=1
-            index_table_star = index_table_star[:i]
-            fits.close()
+            # Loop over all stars near pointing and attempt to simulate them.
+            index_table_star = self.draw_objects('star',
+                                                 self.draw_image.draw_stars(),
+                                                 [('ind',int), ('sca','i8'), ('dither','i8'), ('x',float), ('y',float), ('ra',float), ('dec',float), ('mag',float), ('stamp','i8'), ('xmin','i8'), ('xmax','i8'), ('ymin','i8'), ('ymax','i8'), ('dudx',float), ('dudy',float), ('dvdx',float), ('dvdy',float), ('start_row',int), ('rank','i8')],
+                                                 star_filename,
+                                                 6553600)
         print('star time', time.time()-t1)
 
         index_table_sn = None
         if self.cats.supernovae is not None:
             tmp,tmp_ = self.cats.get_supernova_list()
-            if tmp is not None:
+            if (tmp is not None) and ('supernova' in done):
+                index_table_sn = self.index_tables.get('supernova',None)
+            elif tmp is not None:
                 if len(tmp)!=0:
-                    with io.open(supernova_filename, 'wb') as f :
-                        pickler = pickle.Pickler(f)
-                        index_table_sn = np.empty(int(self.cats.get_supernova_length()),dtype=[('ind',int), ('sca',int), ('dither',int), ('x',float), ('y',float), ('ra',float), ('dec',float), ('mag',float), ('hostid',int)])
-                        index_table_sn['ind']=-999
-                        print('Attempting to simulate '+str(len(tmp))+' supernovae for SCA '+str(self.pointing.sca)+' and dither '+str(self.pointing.dither)+'.')
-                        i=0
-                        while True:
-                            # Loop over all supernovae near pointing and attempt to simulate them.
-                            self.draw_image.iterate_supernova()
-                            if self.draw_image.supernova_done:
-                                break
-                            s_ = self.draw_image.retrieve_supernova_stamp()
-                            if s_ is not None:
-                                pickler.dump(s_)
-                                index_table_sn['ind'][i]    = s_['ind']
-                                index_table_sn['x'][i]      = s_['x']
-                                index_table_sn['y'][i]      = s_['y']
-                                index_table_sn['ra'][i]     = s_['ra']
-                                index_table_sn['dec'][i]    = s_['dec']
-                                index_table_sn['mag'][i]    = s_['mag']
-                                index_table_sn['sca'][i]    = self.pointing.sca
-                                index_table_sn['dither'][i] = self.pointing.dither
-                                index_table_sn['hostid'][i] = s_['hostid']
-                                i+=1
-                                s_.clear()
-                        index_table_sn = index_table_sn[:i]
+                    print('Attempting to simulate '+str(len(tmp))+' supernovae for SCA '+str(self.pointing.sca)+' and dither '+str(self.pointing.dither)+'.')
+                    # Loop over all supernovae near pointing and attempt to simulate them.
+                    index_table_sn = self.draw_objects('supernova',
+                                                       self.draw_image.draw_supernovae(),
+                                                       [('ind',int), ('sca',int), ('dither',int), ('x',float), ('y',float), ('ra',float), ('dec',float), ('mag',float), ('hostid',int), ('stamp','i8'), ('xmin','i8'), ('xmax','i8'), ('ymin','i8'), ('ymax','i8'), ('dudx',float), ('dudy',float), ('dvdx',float), ('dvdy',float), ('start_row',int), ('rank','i8')],
+                                                       supernova_filename,
+                                                       6553600)
+
+        # Drawing is done. The checkpoint is kept until the outputs are written, so a failure while writing them doesn't redraw the SCA.
+        if (self.checkpoint is not None) and ('supernova' not in done):
+            self.checkpoint.save(self.get_checkpoint_state('done'))
 
         if self.comm is not None:
             self.comm.Barrier()
 
-        if os.path.exists(filename):
-            os.system('gzip '+filename)
-            if filename_ is not None:
-                shutil.copy(filename+'.gz',filename_+'.gz')
-                os.remove(filename+'.gz')
-        if os.path.exists(star_filename):
-            os.system('gzip '+star_filename)
-            if star_filename_ is not None:
-                shutil.copy(star_filename+'.gz',star_filename_+'.gz')
-                os.remove(star_filename+'.gz')
-        if os.path.exists(supernova_filename):
-            os.system('gzip '+supernova_filename)
-            if supernova_filename_ is not None:
-                shutil.copy(supernova_filename+'.gz',supernova_filename_+'.gz')
-                os.remove(supernova_filename+'.gz')
+        # Stamp files are compressed in the background (straight to the output directory) while the SCA image and index tables are collected
+        compress_jobs = []
+        threads = self.params.get('compress_threads',4)
+        if use_container:
+            # Stamp containers are already compressed
+            for f,f_ in [(filename,filename_),(star_filename,star_filename_),(supernova_filename,supernova_filename_)]:
+                if os.path.exists(f) and (f_ is not None):
+                    shutil.copy(f,f_)
+                    os.remove(f)
+            compress_list = []
+        else:
+            compress_list = [(filename,filename_),(star_filename,star_filename_),(supernova_filename,supernova_filename_)]
+        for f,f_ in compress_list:
+            if os.path.exists(f):
+                if f_ is None:
+                    compress_jobs.append(gzip_file(f,threads=threads,wait=False))
+                else:
+                    compress_jobs.append(gzip_file(f,out=f_+'.gz',threads=threads,wait=False))
         if self.rank == 0:
             # Build file name path for SCA image
             filename = get_filename(self.params['out_path'],
@@ -484,6 +497,10 @@ class roman_sim(object):
         if self.comm is None:
 
             if (self.cats.get_gal_length()==0) and (len(gal_list)==0):
+                for job in compress_jobs:
+                    job.result()
+                if self.checkpoint is not None:
+                    self.checkpoint.remove()
                 return
 
             # No mpi, so just finalize the drawing of the SCA image and write it to a fits file.
@@ -496,19 +513,36 @@ class roman_sim(object):
             self.comm.Barrier()
             print(self.rank,self.comm,flush=True)
 
-            # Send/receive all versions of SCA images across procs and sum them, then finalize and write to fits file.
+            # Sum the SCA images of all procs on rank 0 (a tree reduction of the raw image buffers, or of only the tiles each proc drew into), then write to fits file.
+            if self.params.get('reduce_touched_tiles',False):
+                touched = self.draw_image.touched
+            else:
+                touched = None
+            if self.draw_image.domains is not None:
+                # Each proc drew its domain of the SCA, so only halos and spilled stamp pieces are exchanged before assembling the domains
+                spilled = self.comm.allgather(sum(a.size for x0,y0,a in self.draw_image.spill))
+                if self.rank == 0:
+                    print('Pixels of stamps spilled beyond the domain halos',sum(spilled))
+                im = self.draw_image.domains.reduce(self.draw_image.im.array,self.draw_image.spill,root=0)
+                if self.rank == 0:
+                    self.draw_image.im = galsim.Image(im, xmin=1, ymin=1, wcs=self.pointing.WCS)
+            elif self.draw_image.shared_sca is not None:
+                # Procs of each node drew into one image, so only node leaders take part in the reduction
+                self.draw_image.shared_sca.reduce(touched=touched)
+            else:
+                reduce_image(self.comm,self.draw_image.im.array,root=0,touched=touched,tile=self.draw_image.sca_tile)
+            # Write the image if any proc drew galaxies (with domain_decomposition, rank 0 only holds those of its own domain)
+            any_gals = any(self.comm.allgather(index_table is not None))
             if self.rank == 0:
-                for i in range(1,self.size):
-                    self.draw_image.im = self.draw_image.im + self.comm.recv(source=i)
 
-                if index_table is not None:
+                if any_gals:
                     print('Saving SCA image to '+filename)
                     # self.draw_image.im.write(filename+'_raw.fits.gz')
                     write_fits(filename,self.draw_image.im,None,None,self.pointing.sca,self.params['output_meds'])
 
-            else:
-
-                self.comm.send(self.draw_image.im, dest=0)
+            if self.draw_image.shared_sca is not None:
+                self.draw_image.im = None
+                self.draw_image.shared_sca.free()
 
             # Send/receive all parts of postage stamp dictionary across procs and merge them.
             # if self.rank == 0:
@@ -534,6 +568,18 @@ class roman_sim(object):
 
             #     self.comm.send(gals, dest=0)
 
+        if self.comm is not None:
+            # Collect the index tables of all procs on rank 0
+            index_table      = gather_table(self.comm,index_table)
+            index_table_star = gather_table(self.comm,index_table_star)
+            index_table_sn   = gather_table(self.comm,index_table_sn)
+            if self.draw_image.true_psf is not None:
+                # Number the true PSF stamps of all procs consecutively, in rank order
+                offsets = self.draw_image.true_psf.gather(self.comm,root=0)
+                if (self.rank == 0) and (index_table is not None):
+                    mask = index_table['psf_id']>=0
+                    index_table['psf_id'][mask] += offsets[index_table['rank'][mask]]
+
         if self.rank == 0:
 
             filename = get_filename(self.params['out_path'],
@@ -558,19 +604,15 @@ class roman_sim(object):
                                     ftype='fits',
                                     overwrite=True)  
 
-            print('before index')
-            for i in range(1,self.size):
-                tmp = self.comm.recv(source=i)
-                if tmp is not None:
-                    index_table = np.append(index_table,tmp)
-            for i in range(1,self.size):
-                tmp = self.comm.recv(source=i)
-                if tmp is not None:
-                    index_table_star = np.append(index_table_star,tmp)
-            for i in range(1,self.size):
-                tmp = self.comm.recv(source=i)
-                if tmp is not None:
-                    index_table_sn = np.append(index_table_sn,tmp)
+            if self.draw_image.true_psf is not None:
+                # Each unique true PSF stamp is written once per SCA; galaxies reference it through psf_id
+                self.draw_image.true_psf.write(get_filename(self.params['out_path'],
+                                                            'psf',
+                                                            self.params['output_meds'],
+                                                            var=self.pointing.filter+'_'+str(self.pointing.dither),
+                                                            name2=str(self.pointing.sca)+'_truepsf',
+                                                            ftype='fits',
+                                                            overwrite=True))
 
             if index_table is not None:
                 print('Saving index to '+filename)
@@ -581,10 +623,93 @@ class roman_sim(object):
                 fio.write(filename_star,index_table_star)
             if index_table_sn is not None:
                 fio.write(filename_sn,index_table_sn)
+
+        # Wait for the background compression of the stamp files
+        for job in compress_jobs:
+            job.result()
+
+        # All outputs of the SCA are written, so the checkpoints are no longer needed
+        if self.checkpoint is not None:
+            if self.comm is not None:
+                self.comm.Barrier()
+            self.checkpoint.remove()
+
+    def get_checkpoint_state(self, phase):
+        """
+        Return the checkpoint state common to all phases: the partial SCA image, the index tables of finished object types, and the true PSF, bright star engine and PSF bank state.
+
+        Input
+        phase : Object type being drawn, or 'done'
+        """
+
+        if self.draw_image.true_psf is not None:
+            true_psf = (self.draw_image.true_psf.ids,self.draw_image.true_psf.stamps)
+        else:
+            true_psf = None
+        if self.draw_image.bright_star is not None:
+            bright_star = (self.draw_image.bright_star.n_checked,self.draw_image.bright_star.enabled)
+        else:
+            bright_star = None
+        if self.draw_image.star_bank is not None:
+            star_bank = (self.draw_image.star_bank.n_checked,self.draw_image.star_bank.enabled)
         else:
-            self.comm.send(index_table, dest=0)            
-            self.comm.send(index_table_star, dest=0)            
-            self.comm.send(index_table_sn, dest=0)            
+            star_bank = None
+
+        return {'phase'       : phase,
+                'im'          : self.draw_image.im.array,
+                'touched'     : self.draw_image.touched,
+                'spill'       : self.draw_image.spill,
+                'tables'      : self.index_tables,
+                'true_psf'    : true_psf,
+                'bright_star' : bright_star,
+                'star_bank'   : star_bank}
+
+    def draw_objects(self, obj_type, records, dtype, filename, length):
+        """
+        Draw all objects of one type through the stamp pipeline, with the stamps written to filename, and return their index table. If checkpoints are enabled, the drawing is resumed from the checkpoint when it was saved for this type, and a checkpoint is saved every checkpoint_interval seconds.
+
+        Input
+        obj_type : One of 'gal', 'star', 'supernova'
+        records  : draw_image stamp record generator for this type
+        dtype    : Numpy dtype of index table
+        filename : Stamp filename
+        length   : Initial length of the cutout extensions (fits stamp files)
+        """
+
+        # Drawing, index building and stamp writing are overlapped through a pipeline of bounded queues
+        maxsize = self.params.get('pipeline_queue',64)
+        # Stamps are written to disk in the background in blocks of stamp_write_buffer MB
+        buffer_size = int(self.params.get('stamp_write_buffer',64)*1024**2)
+
+        index = stamp_index(dtype, self.pointing.sca, self.pointing.dither, rank=self.rank)
+        state = None
+        if (self.checkpoint_state is not None) and (self.checkpoint_state['phase']==obj_type):
+            state = self.checkpoint_state
+            index.set_state(state['index'])
+            self.draw_image.resume(obj_type,state['iter'])
+            print('Proc '+str(self.rank)+' resuming '+obj_type+' from checkpoint at object '+str(state['iter'])+'.')
+            state = state['writer']
+        if self.params.get('stamp_container',False):
+            writer = container_stamp_writer(filename,buffer_size=buffer_size,state=state)
+        else:
+            writer = fits_stamp_writer(filename,length=length,buffer_size=buffer_size,state=state)
+
+        def save_checkpoint():
+            # Called by the pipeline when all records drawn so far are indexed and written
+            state = self.get_checkpoint_state(obj_type)
+            state['iter']   = getattr(self.draw_image,obj_type+'_iter')
+            state['index']  = index.get_state()
+            state['writer'] = writer.get_state()
+            self.checkpoint.save(state)
+
+        if self.checkpoint is not None:
+            pipeline = stamp_pipeline([index,writer],maxsize=maxsize,checkpoint=save_checkpoint,checkpoint_interval=self.checkpoint.interval)
+        else:
+            pipeline = stamp_pipeline([index,writer],maxsize=maxsize)
+        pipeline.run(records)
+        self.index_tables[obj_type] = index.table
+
+        return index.table
 
     def iterate_detector_image(self):
         """
@@ -645,26 +770,35 @@ class roman_sim(object):
                                 name2=self.pointing.filter+'_'+str(self.pointing.dither)+'_'+str(self.pointing.sca)+obj_str,
                                 ftype='fits',
                                 overwrite=False)
+        use_container = self.params.get('stamp_container',False)
+        if use_container:
+            stamp_ftype = 'stamps'
+        else:
+            stamp_ftype = 'fits'
         filename = get_filename(self.params['tmpdir'],
                                 '',
                                 self.params['output_meds'],
                                 var=self.pointing.filter+'_'+str(self.pointing.dither),
                                 name2=str(self.pointing.sca)+'_'+str(self.rank)+obj_str,
-                                ftype='fits',
+                                ftype=stamp_ftype,
                                 overwrite=True)
         filename_ = get_filename(self.params['out_path'],
                                 'stamps',
                                 self.params['output_meds'],
                                 var=self.pointing.filter+'_'+str(self.pointing.dither),
                                 name2=str(self.pointing.sca)+'_'+str(self.rank)+obj_str,
-                                ftype='fits',
+                                ftype=stamp_ftype,
                                 overwrite=False)
 
-        if os.path.exists(filename_+'.gz'):
-            shutil.copy(filename_+'.gz',filename+'.gz')
+        if use_container:
+            if os.path.exists(filename_):
+                shutil.copy(filename_,filename)
+            else:
+                raise ParamError('Could not find stamp file.')
+        elif os.path.exists(filename_+'.gz'):
             if os.path.exists(filename):
                 os.remove(filename)
-            os.system('gunzip '+filename+'.gz')
+            gunzip_file(filename_+'.gz',out=filename,remove=False)
         else:
             raise ParamError('Could not find stamp file.')
 
@@ -674,25 +808,70 @@ class roman_sim(object):
             raise ParamError('Could not find index file.')
 
         self.fits_index = fio.FITS(filename_index)[-1]
-        self.fits       = fio.FITS(filename,'rw')
+        if use_container:
+            # Stamps are updated in place, in groups of stamp_write_buffer MB per new compressed chunk
+            self.stamps = stamp_container(filename,'a')
+            buffer_size = int(self.params.get('stamp_write_buffer',64)*1024**2)
+            rows   = []
+            arrays = {'image' : [], 'weight' : [], 'dq' : []}
+            nbytes = 0
+        else:
+            self.stamps = None
+            self.fits   = fio.FITS(filename,'rw')
 
-        self.fits.write(np.zeros(100),extname='dq_cutouts')
-        self.fits['dq_cutouts'].write(np.zeros(1),start=[self.fits['image_cutouts'].read_header()['NAXIS1']-1])
+            self.fits.write(np.zeros(100),extname='dq_cutouts')
+            self.fits['dq_cutouts'].write(np.zeros(1),start=[self.fits['image_cutouts'].read_header()['NAXIS1']-1])
 
+        index_rank = self.fits_index.read(columns=['rank'])['rank'] if 'rank' in self.fits_index.get_colnames() else None
         for i in range(self.fits_index.read_header()['NAXIS2']):
+            # Only the stamps of this proc are in its stamp file
+            if (index_rank is not None) and (index_rank[i]!=self.rank):
+                continue
             im,err = self.read_stamp(i)
             if im is None:
                 continue
 
             img,err,dq,sky_mean = self.draw_image.finalize_stamp(self.fits_index[i]['ind'],self.fits_index[i]['dither'],im,err)
             start_row = self.fits_index[i]['start_row']
-            self.fits['image_cutouts'].write(im.array.flatten()-sky_mean,start=[start_row])
-            self.fits['weight_cutouts'].write(err.flatten(),start=[start_row])
-            self.fits['dq_cutouts'].write(dq.flatten(),start=[start_row])
-
-        os.system('gzip '+filename+'.gz')
-        shutil.copy(filename+'.gz',filename_.replace('stamps','stamps/'+self.modify_image.get_path_name())+'.gz')
-        os.remove(filename+'.gz')
+            if use_container:
+                rows.append(start_row)
+                arrays['image'].append(im.array.flatten()-sky_mean)
+                arrays['weight'].append(err.flatten())
+                arrays['dq'].append(dq.flatten())
+                nbytes += arrays['image'][-1].nbytes+arrays['weight'][-1].nbytes+arrays['dq'][-1].nbytes
+                if nbytes>=buffer_size:
+                    self.stamps.append(rows,arrays)
+                    rows   = []
+                    arrays = {'image' : [], 'weight' : [], 'dq' : []}
+                    nbytes = 0
+            else:
+                self.fits['image_cutouts'].write(im.array.flatten()-sky_mean,start=[start_row])
+                self.fits['weight_cutouts'].write(err.flatten(),start=[start_row])
+                self.fits['dq_cutouts'].write(dq.flatten(),start=[start_row])
+
+        if use_container:
+            if len(rows)>0:
+                self.stamps.append(rows,arrays)
+            self.stamps.close()
+            shutil.copy(filename,get_filename(self.params['out_path'],
+                                            'stamps/'+self.modify_image.get_path_name(),
+                                            self.params['output_meds'],
+                                            var=self.pointing.filter+'_'+str(self.pointing.dither),
+                                            name2=str(self.pointing.sca)+'_'+str(self.rank)+obj_str,
+                                            ftype=stamp_ftype,
+                                            overwrite=True))
+            os.remove(filename)
+        else:
+            self.fits.close()
+            gzip_file(filename,
+                      out=get_filename(self.params['out_path'],
+                                        'stamps/'+self.modify_image.get_path_name(),
+                                        self.params['output_meds'],
+                                        var=self.pointing.filter+'_'+str(self.pointing.dither),
+                                        name2=str(self.pointing.sca)+'_'+str(self.rank)+obj_str,
+                                        ftype='fits.gz',
+                                        overwrite=True),
+                      threads=self.params.get('compress_threads',4))
         os.remove(filename_index)
 
     def check_file(self,sca,dither,filter_):
@@ -713,7 +892,14 @@ class roman_sim(object):
         if self.fits_index[i]['stamp']>0:
             start = self.fits_index[i]['start_row']
             stamp = self.fits_index[i]['stamp']
-            im = galsim.Image(  self.fits['image_cutouts'][start:start+stamp**2].reshape((stamp,stamp)),
+            if self.stamps is not None:
+                # Only the chunk holding this stamp is decompressed
+                im_ = self.stamps.read(start,'image')
+                wt_ = self.stamps.read(start,'weight')
+            else:
+                im_ = self.fits['image_cutouts'][start:start+stamp**2]
+                wt_ = self.fits['weight_cutouts'][start:start+stamp**2]
+            im = galsim.Image(  im_.reshape((stamp,stamp)),
                                 xmin=self.fits_index[i]['xmin'],
                                 ymin=self.fits_index[i]['ymin'],
                                 wcs=galsim.JacobianWCS( self.fits_index[i]['dudx'], 
@@ -721,7 +907,7 @@ class roman_sim(object):
                                                         self.fits_index[i]['dvdx'], 
                                                         self.fits_index[i]['dvdy'])
                                 )
-            err = galsim.Image(  self.fits['weight_cutouts'][start:start+stamp**2].reshape((stamp,stamp)),
+            err = galsim.Image(  wt_.reshape((stamp,stamp)),
                                 xmin=self.fits_index[i]['xmin'],
                                 ymin=self.fits_index[i]['ymin'],
                                 wcs=galsim.JacobianWCS( self.fits_index[i]['dudx'], 
@@ -1,28 +1,23 @@
 import astropy
-import pickle
 import io
 from matplotlib import pyplot as plt 
 import fitsio
 
+from roman_imsim.stamps import stamp_reader
 
-filename='../debug/fiducial_H158_22531_1_3.cPickle'
-#filename1='../debug/fiducial_H158_22531_1_1.cPickle'
 
+# Stamps of each proc are in their own file, {rank} is replaced by the rank in the index table
+filename='../debug/fiducial_H158_22531_1_{rank}_supernova.fits.gz'
+index_filename='../debug/fiducial_index_H158_22531_1_sn.fits'
+#filename1='../debug/fiducial_H158_22531_1_1_supernova.fits.gz'
 
-with io.open(filename, 'rb') as p :
-    unpickler = pickle.Unpickler(p)
-    while p.peek(1) :
-        gal1 = unpickler.load()
-        if gal1['ind']==810849:
-            gal_stamp1=gal1
+
+stamps = stamp_reader(filename,index_filename)
+gal_stamp1 = stamps.read(stamps.find(ind=810849)[0])
 """        
-with io.open(filename1, 'rb') as p2 :
-    unpickler = pickle.Unpickler(p2)
-    while p2.peek(1) :
-        gal2 = unpickler.load()
-        if gal2['ind']==810849:
-            gal_stamp2=gal2
+stamps2 = stamp_reader(filename1,index_filename,rank=1)
+gal_stamp2 = stamps2.read(stamps2.find(ind=810849)[0])
 
-gal_stamp1['gal'].write('old_stamp.fits')
+gal_stamp1.write('old_stamp.fits')
 """
-gal_stamp1['gal'].write('new_stamp.fits')
\ No newline at end of file
+gal_stamp1.write('new_stamp.fits')
\ No newline at end of file
@@ -0,0 +1,801 @@
+import numpy as np
+import sys, os, io
+import time
+import threading
+import queue
+import collections
+import zlib
+import galsim as galsim
+import galsim.roman as roman
+import fitsio as fio
+
+from .misc import ParamError
+
+# Largest galaxy postage stamp saved (pixels). Galaxies needing a larger stamp are only drawn into the SCA image.
+max_stamp_size = 256
+
+# Compact record yielded by the draw_image.draw_*() generators for each drawn object. image/weight are None if no postage stamp is saved for the object.
+stamp_record = collections.namedtuple('stamp_record',
+                                      ['ind',    # truth index
+                                       'ra',     # ra of object
+                                       'dec',    # dec of object
+                                       'x',      # SCA x position of object
+                                       'y',      # SCA y position of object
+                                       'mag',    # Calculated magnitude
+                                       'stamp',  # Stamp size in pixels
+                                       'b',      # Stamp bounds object
+                                       'jac',    # Local Jacobian at (x,y)
+                                       'psf_id', # ID of the cached true PSF stamp (-1 if not cached)
+                                       'hostid', # Host galaxy id number (supernovae)
+                                       'image',  # 2d array of stamp
+                                       'weight'])# Array of weight map
+
+
+class stamp_pipeline(object):
+    """
+    Pipeline that overlaps drawing with the handling of the drawn stamps. The record generator (e.g., draw_image.draw_galaxies()) runs on the calling thread, and each record is handed in order to every consumer, each running in its own thread behind a bounded queue. Drawing only blocks if a consumer falls more than maxsize records behind.
+
+    A consumer is any callable taking a stamp_record. If it has a close() method, it is called from the consumer thread after the last record. An exception in a consumer stops the pipeline and is re-raised in the calling thread.
+
+    If checkpoint is given, it is called from the calling thread every checkpoint_interval seconds, at a point where all records drawn so far have been handled by all consumers and the generator is suspended between records.
+    """
+
+    def __init__(self, consumers, maxsize=64, checkpoint=None, checkpoint_interval=None):
+        """
+        Input
+        consumers           : List of consumer callables
+        maxsize             : Maximum number of records waiting per consumer
+        checkpoint          : Function to call periodically
+        checkpoint_interval : Time in seconds between checkpoints
+        """
+
+        self.consumers           = consumers
+        self.maxsize             = maxsize
+        self.checkpoint          = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.error               = None
+
+    def consume(self, consumer, q):
+        """
+        Consumer thread loop. After an error, keep draining the queue so the producer never blocks on it.
+
+        Input
+        consumer : Consumer callable
+        q        : Queue of records for this consumer (None ends the stream)
+        """
+
+        failed = False
+        while True:
+            rec = q.get()
+            if rec is None:
+                q.task_done()
+                break
+            if failed:
+                q.task_done()
+                continue
+            try:
+                consumer(rec)
+            except BaseException as e:
+                self.error = e
+                failed     = True
+            q.task_done()
+        if failed:
+            return
+        try:
+            if hasattr(consumer,'close'):
+                consumer.close()
+        except BaseException as e:
+            self.error = e
+
+    def run(self, records):
+        """
+        Draw all records and pass them through the consumers. Returns the number of records.
+
+        Input
+        records : Iterable of stamp_record objects
+        """
+
+        queues  = [queue.Queue(maxsize=self.maxsize) for c in self.consumers]
+        threads = [threading.Thread(target=self.consume,args=(c,q)) for c,q in zip(self.consumers,queues)]
+        for t in threads:
+            t.start()
+
+        n  = 0
+        t0 = time.time()
+        try:
+            for rec in records:
+                if self.error is not None:
+                    break
+                for q in queues:
+                    q.put(rec)
+                n += 1
+                if (self.checkpoint is not None) and (time.time()-t0>self.checkpoint_interval):
+                    # Wait for the consumers to catch up
+                    for q in queues:
+                        q.join()
+                    if self.error is not None:
+                        break
+                    self.checkpoint()
+                    t0 = time.time()
+        finally:
+            for q in queues:
+                q.put(None)
+            for t in threads:
+                t.join()
+
+        if self.error is not None:
+            raise self.error
+
+        return n
+
+
+class stamp_index(object):
+    """
+    Pipeline consumer that builds the index table of drawn objects used for MEDS making later. The column values of the records (not their pixels) are collected in blocks of block_size and each block is added to growable column arrays at once; the columns double in size when full, so there is no fixed limit on the number of objects. close() builds the final structured array with a single copy. Fields of the record that are not in the table dtype are ignored. start_row tracks the position of each stamp in the flattened stamp file, assuming stamps are written in record order. Each proc writes its own stamp file, so start_row is only meaningful together with the rank column once the tables of all procs are gathered.
+    """
+
+    def __init__(self, dtype, sca, dither, rank=0, size=1024, block_size=1024):
+        """
+        Input
+        dtype      : Numpy dtype of index table
+        sca        : SCA number
+        dither     : Dither index
+        rank       : Rank of the proc writing the stamp file
+        size       : Initial number of rows to allocate
+        block_size : Number of records collected before they are added to the columns
+        """
+
+        self.dtype      = np.dtype(dtype)
+        self.sca        = sca
+        self.dither     = dither
+        self.rank       = rank
+        self.block_size = block_size
+        self.columns    = dict([(name,np.zeros(size,dtype=self.dtype[name])) for name in self.dtype.names])
+        self.size       = size
+        self.i          = 0
+        self.start_row  = 0
+        self.block      = []
+        self.table      = None
+
+    # Record fields copied to the columns of the same name, and stamp fields (only for records with a stamp)
+    fields       = ['ind','x','y','ra','dec','mag','psf_id','hostid']
+    stamp_fields = ['stamp','xmin','xmax','ymin','ymax','dudx','dvdx','dudy','dvdy']
+
+    def __call__(self, rec):
+
+        # Only the column values are kept, not the record, so its pixels can be freed once they are written
+        if rec.image is None:
+            stamp = None
+        else:
+            stamp = (rec.stamp, rec.b.xmin, rec.b.xmax, rec.b.ymin, rec.b.ymax, rec.jac.dudx, rec.jac.dvdx, rec.jac.dudy, rec.jac.dvdy)
+        self.block.append((tuple([getattr(rec,name) for name in self.fields]), stamp))
+        if len(self.block)>=self.block_size:
+            self.add_block()
+
+    def grow(self, n):
+        """
+        Double the column arrays until n rows fit.
+
+        Input
+        n : Number of rows needed
+        """
+
+        size = self.size
+        while size<n:
+            size*=2
+        if size==self.size:
+            return
+        for name in self.columns:
+            col = np.zeros(size,dtype=self.columns[name].dtype)
+            col[:self.i] = self.columns[name][:self.i]
+            self.columns[name] = col
+        self.size = size
+
+    def add_block(self):
+        """
+        Add the collected records to the columns.
+        """
+
+        n = len(self.block)
+        if n==0:
+            return
+        self.grow(self.i+n)
+        c  = self.columns
+        sl = slice(self.i,self.i+n)
+        for j,name in enumerate(self.fields):
+            if name in c:
+                c[name][sl] = [values[j] for values,stamp in self.block]
+        c['sca'][sl]    = self.sca
+        c['dither'][sl] = self.dither
+        if 'rank' in c:
+            c['rank'][sl] = self.rank
+        if 'stamp' in c:
+            mask = np.array([stamp is not None for values,stamp in self.block])
+            if np.any(mask):
+                stamps = [stamp for values,stamp in self.block if stamp is not None]
+                rows   = np.arange(self.i,self.i+n)[mask]
+                for j,name in enumerate(self.stamp_fields):
+                    c[name][rows] = [stamp[j] for stamp in stamps]
+                size   = c['stamp'][rows].astype('i8')
+                c['start_row'][rows] = self.start_row+np.cumsum(size**2)-size**2
+                self.start_row      += int(np.sum(size**2))
+        self.i    += n
+        self.block = []
+
+    def get_state(self):
+        """
+        Return a copy of the rows added so far, for checkpointing.
+        """
+
+        self.add_block()
+        return {'columns'   : dict([(name,self.columns[name][:self.i].copy()) for name in self.columns]),
+                'i'         : self.i,
+                'start_row' : self.start_row}
+
+    def set_state(self, state):
+        """
+        Continue from a state returned by get_state().
+
+        Input
+        state : Index state
+        """
+
+        self.block     = []
+        self.i         = state['i']
+        self.start_row = state['start_row']
+        self.size      = max(self.i,1024)
+        for name in self.columns:
+            self.columns[name] = np.zeros(self.size,dtype=self.dtype[name])
+            self.columns[name][:self.i] = state['columns'][name]
+
+    def close(self):
+
+        self.add_block()
+        self.table = np.empty(self.i,dtype=self.dtype)
+        for name in self.dtype.names:
+            self.table[name] = self.columns[name][:self.i]
+        self.columns = None
+
+
+class stamp_writer(object):
+    """
+    Base class of the pipeline consumers that write the flattened image and weight stamps to disk, in record order.
+
+    Writes are done by a background thread. Stamps are collected in memory until buffer_size bytes are pending, then handed to the writer thread as one block (at most n_chunks blocks in flight), so the caller only blocks if the filesystem falls behind by that much. flush() waits until everything received so far is on disk, and close() flushes and closes the file. An error in the writer thread is re-raised by the next call, flush() or close(). Subclasses provide write_block(rows, images, weights), called from the writer thread with the start rows and flattened image and weight stamps of a block, and close_file().
+    """
+
+    def __init__(self, buffer_size=64*1024**2, n_chunks=4):
+        """
+        Input
+        buffer_size : Number of bytes of stamps to collect before a write
+        n_chunks    : Maximum number of collected blocks waiting to be written
+        """
+
+        self.start_row   = 0
+        self.buffer_size = buffer_size
+        self.rows        = []
+        self.images      = []
+        self.weights     = []
+        self.nbytes      = 0
+        self.error       = None
+        self.closed      = False
+
+        self.queue  = queue.Queue(maxsize=n_chunks)
+        self.thread = threading.Thread(target=self.write_chunks)
+        self.thread.start()
+
+    def write_chunks(self):
+        """
+        Writer thread loop. Writes blocks until it receives None. After an error, keeps draining the queue so callers never block on it.
+        """
+
+        while True:
+            chunk = self.queue.get()
+            try:
+                if chunk is None:
+                    return
+                if self.error is not None:
+                    continue
+                self.write_block(*chunk)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def get_state(self):
+        """
+        Flush and return the state needed to continue writing to the file, for checkpointing.
+        """
+
+        self.flush()
+        return {'start_row' : self.start_row}
+
+    def check(self):
+
+        if self.error is not None:
+            raise self.error
+
+    def __call__(self, rec):
+
+        self.check()
+        if rec.image is None:
+            return
+        self.rows.append(self.start_row)
+        self.images.append(rec.image.flatten())
+        self.weights.append(rec.weight.flatten())
+        self.nbytes    += self.images[-1].nbytes+self.weights[-1].nbytes
+        self.start_row += rec.stamp**2
+        if self.nbytes>=self.buffer_size:
+            self.send()
+
+    def send(self):
+        """
+        Hand the collected stamps to the writer thread as one block.
+        """
+
+        if len(self.images)==0:
+            return
+        self.queue.put((self.rows,self.images,self.weights))
+        self.rows    = []
+        self.images  = []
+        self.weights = []
+        self.nbytes  = 0
+
+    def flush(self):
+        """
+        Write all stamps received so far and wait for them to be on disk.
+        """
+
+        self.check()
+        self.send()
+        self.queue.join()
+        self.check()
+
+    def close(self):
+
+        if self.closed:
+            return
+        try:
+            self.send()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            self.close_file()
+            self.closed = True
+        self.check()
+
+
+class fits_stamp_writer(stamp_writer):
+    """
+    Background stamp writer to the image_cutouts/weight_cutouts extensions of a fits file. Each block is written as one contiguous write per extension, and the extensions are grown by doubling.
+    """
+
+    def __init__(self, filename, length=200000000, buffer_size=64*1024**2, n_chunks=4, state=None):
+        """
+        Input
+        filename    : Output fits filename
+        length      : Initial length of the cutout extensions
+        buffer_size : Number of bytes of stamps to collect before a write
+        n_chunks    : Maximum number of collected blocks waiting to be written
+        state       : State from get_state() to continue writing an existing file
+        """
+
+        if state is None:
+            self.fits = fio.FITS(filename,'rw',clobber=True)
+            self.fits.write(np.zeros(100),extname='image_cutouts')
+            self.fits.write(np.zeros(100),extname='weight_cutouts')
+            self.fits['image_cutouts'].write(np.zeros(1),start=[length])
+            self.fits['weight_cutouts'].write(np.zeros(1),start=[length])
+            self.length = length
+        else:
+            self.fits   = fio.FITS(filename,'rw')
+            self.length = state['length']
+        super().__init__(buffer_size=buffer_size, n_chunks=n_chunks)
+        if state is not None:
+            self.start_row = state['start_row']
+
+    def write_block(self, rows, images, weights):
+
+        image   = np.concatenate(images)
+        weight  = np.concatenate(weights)
+        end_row = rows[0]+len(image)
+        if end_row>self.length:
+            while end_row>self.length:
+                self.length*=2
+            self.fits['image_cutouts'].write(np.zeros(1),start=[self.length])
+            self.fits['weight_cutouts'].write(np.zeros(1),start=[self.length])
+        self.fits['image_cutouts'].write(image,start=[rows[0]])
+        self.fits['weight_cutouts'].write(weight,start=[rows[0]])
+
+    def get_state(self):
+
+        state = super().get_state()
+        # Make sure cfitsio's buffers are on disk
+        self.fits.reopen()
+        state['length'] = self.length
+        return state
+
+    def close_file(self):
+
+        self.fits.close()
+
+
+class container_stamp_writer(stamp_writer):
+    """
+    Background stamp writer to a stamp_container. Each block becomes one compressed chunk. Stamps are keyed by their start_row in the index table.
+    """
+
+    def __init__(self, filename, buffer_size=64*1024**2, n_chunks=4, level=6, state=None):
+        """
+        Input
+        filename    : Output stamp container filename
+        buffer_size : Number of bytes of stamps to collect per chunk
+        n_chunks    : Maximum number of collected chunks waiting to be written
+        level       : zlib compression level
+        state       : State from get_state() to continue writing an existing file
+        """
+
+        if state is None:
+            self.container = stamp_container(filename,'w',level=level)
+        else:
+            self.container = stamp_container(filename,'a',level=level,state=state['container'])
+        super().__init__(buffer_size=buffer_size, n_chunks=n_chunks)
+        if state is not None:
+            self.start_row = state['start_row']
+
+    def write_block(self, rows, images, weights):
+
+        self.container.append(rows, {'image' : images, 'weight' : weights})
+
+    def get_state(self):
+
+        state = super().get_state()
+        state['container'] = self.container.get_state()
+        return state
+
+    def close_file(self):
+
+        self.container.close()
+
+
+class stamp_container(object):
+    """
+    Chunked, compressed random-access container of postage stamps. Stamps are stored as one or more named flat arrays (e.g., image, weight, dq) under an integer key (the start_row of the index table). Groups of stamps are concatenated and zlib-compressed into chunks that are appended to the file, and an offset index of all chunks and stamp arrays is kept at the end of the file:
+
+        magic | chunk 0 | chunk 1 | ... | index (entries, chunks, names as .npy) | index offset | magic
+
+    A single stamp is read by decompressing only its chunk (the last few chunks are cached). Opening with mode 'a' appends to an existing container. update() is copy-on-write: the new arrays are appended as a new chunk and the index is repointed, so existing chunks are never rewritten; dead chunks are dropped by compact(), which close() calls when they make up most of the file.
+    """
+
+    magic       = b'RSTAMPS1'
+    entry_dtype = [('key','i8'),('name','i2'),('chunk','i8'),('offset','i8'),('nbytes','i8'),('dtype','S8')]
+    chunk_dtype = [('offset','i8'),('nbytes','i8'),('raw_nbytes','i8')]
+
+    def __init__(self, filename, mode='r', level=6, cache_chunks=4, state=None):
+        """
+        Input
+        filename     : Container filename
+        mode         : 'r' (read), 'a' (read/update/append to existing) or 'w' (create)
+        level        : zlib compression level of new chunks
+        cache_chunks : Number of decompressed chunks to keep in memory
+        state        : Index state from get_state() to use instead of the index in the file (mode 'a'), e.g. for a container that was not closed
+        """
+
+        if mode not in ['r','a','w']:
+            raise ParamError('Invalid stamp container mode: '+str(mode))
+
+        self.filename     = filename
+        self.mode         = mode
+        self.level        = level
+        self.cache_chunks = cache_chunks
+        self.cache        = collections.OrderedDict()
+        self.lock         = threading.RLock()
+        self.modified     = False
+
+        if mode=='w':
+            self.f = io.open(filename,'w+b')
+            self.f.write(self.magic)
+            self.end      = len(self.magic)
+            self.names    = []
+            self.entries  = {}
+            self.chunks   = []
+            self.modified = True
+        elif state is not None:
+            self.f = io.open(filename,'r+b')
+            self.end     = state['end']
+            self.names   = list(state['names'])
+            self.entries = dict(state['entries'])
+            self.chunks  = list(state['chunks'])
+            self.f.truncate(self.end)
+            self.modified = True
+        else:
+            self.f = io.open(filename,'rb' if mode=='r' else 'r+b')
+            self.read_index()
+
+    def get_state(self):
+        """
+        Return a copy of the index, which together with the file up to end describes the container.
+        """
+
+        with self.lock:
+            self.f.flush()
+            return {'end'     : self.end,
+                    'names'   : list(self.names),
+                    'entries' : dict(self.entries),
+                    'chunks'  : list(self.chunks)}
+
+    def read_index(self):
+        """
+        Load the offset index from the end of the file.
+        """
+
+        self.f.seek(0)
+        if self.f.read(len(self.magic))!=self.magic:
+            raise ParamError('Not a stamp container: '+self.filename)
+        self.f.seek(-8-len(self.magic),os.SEEK_END)
+        self.end = int(np.frombuffer(self.f.read(8),dtype='<i8')[0])
+        if self.f.read(len(self.magic))!=self.magic:
+            raise ParamError('Stamp container was not closed: '+self.filename)
+        self.f.seek(self.end)
+        entries    = np.load(self.f)
+        chunks     = np.load(self.f)
+        self.names = [n.decode() for n in np.load(self.f)]
+        self.chunks  = [tuple(c) for c in chunks]
+        self.entries = {}
+        for e in entries:
+            self.entries[(int(e['key']),int(e['name']))] = (int(e['chunk']),int(e['offset']),int(e['nbytes']),e['dtype'].decode())
+
+    def write_index(self):
+        """
+        Write the offset index after the last chunk.
+        """
+
+        entries = np.zeros(len(self.entries),dtype=self.entry_dtype)
+        for i,(k,v) in enumerate(self.entries.items()):
+            entries[i] = (k[0],k[1],v[0],v[1],v[2],v[3])
+        self.f.seek(self.end)
+        np.save(self.f,entries)
+        np.save(self.f,np.array(self.chunks,dtype=self.chunk_dtype))
+        np.save(self.f,np.array(self.names,dtype='S32'))
+        self.f.write(np.array([self.end],dtype='<i8').tobytes())
+        self.f.write(self.magic)
+        self.f.truncate()
+
+    def keys(self):
+
+        return sorted(set([k[0] for k in self.entries]))
+
+    def __contains__(self, key):
+
+        return any([(int(key),n) in self.entries for n in range(len(self.names))])
+
+    def get_name(self, name):
+
+        if name not in self.names:
+            self.names.append(name)
+        return self.names.index(name)
+
+    def append(self, keys, arrays):
+        """
+        Compress a group of stamps into a new chunk at the end of the file. Existing stamps with the same key and name are replaced.
+
+        Input
+        keys   : List of stamp keys
+        arrays : Dict of name : list of flat arrays (one per key, None to skip)
+        """
+
+        if self.mode=='r':
+            raise ParamError('Stamp container opened read-only.')
+
+        raw     = []
+        entries = {}
+        offset  = 0
+        with self.lock:
+            chunk = len(self.chunks)
+            for name in arrays:
+                n = self.get_name(name)
+                for key,arr in zip(keys,arrays[name]):
+                    if arr is None:
+                        continue
+                    arr = np.ascontiguousarray(arr)
+                    entries[(int(key),n)] = (chunk,offset,arr.nbytes,arr.dtype.str)
+                    raw.append(arr.tobytes())
+                    offset += arr.nbytes
+        data = zlib.compress(b''.join(raw),self.level)
+
+        with self.lock:
+            self.f.seek(self.end)
+            self.f.write(data)
+            self.chunks.append((self.end,len(data),offset))
+            self.end += len(data)
+            self.entries.update(entries)
+            self.modified = True
+
+    def update(self, key, **arrays):
+        """
+        Replace (or add) the named arrays of a single stamp. For many stamps, append() them in groups instead.
+
+        Input
+        key    : Stamp key
+        arrays : name=flat array
+        """
+
+        self.append([key],dict([(name,[arrays[name]]) for name in arrays]))
+
+    def read_chunk(self, chunk):
+
+        with self.lock:
+            if chunk in self.cache:
+                self.cache.move_to_end(chunk)
+                return self.cache[chunk]
+            offset,nbytes,raw_nbytes = self.chunks[chunk]
+            self.f.seek(offset)
+            data = zlib.decompress(self.f.read(nbytes))
+            self.cache[chunk] = data
+            if len(self.cache)>self.cache_chunks:
+                self.cache.popitem(last=False)
+            return data
+
+    def read(self, key, name='image'):
+        """
+        Read one array of a stamp. Returns None if it isn't in the container.
+
+        Input
+        key  : Stamp key
+        name : Array name
+        """
+
+        if name not in self.names:
+            return None
+        entry = self.entries.get((int(key),self.names.index(name)))
+        if entry is None:
+            return None
+        chunk,offset,nbytes,dtype = entry
+        data = self.read_chunk(chunk)
+        return np.frombuffer(data,dtype=dtype,count=nbytes//np.dtype(dtype).itemsize,offset=offset).copy()
+
+    def dead_fraction(self):
+        """
+        Fraction of the compressed chunk bytes that are no longer referenced by the index.
+        """
+
+        used  = set([v[0] for v in self.entries.values()])
+        total = np.sum([c[1] for c in self.chunks])
+        if total==0:
+            return 0.
+        return 1.-np.sum([self.chunks[c][1] for c in used])/total
+
+    def compact(self):
+        """
+        Rewrite the container without unreferenced chunks, keeping stamps in key order.
+        """
+
+        tmp = stamp_container(self.filename+'.tmp','w',level=self.level)
+        keys = self.keys()
+        group = []
+        nbytes = 0
+        for key in keys:
+            group.append(key)
+            nbytes += np.sum([self.entries[(key,n)][2] for n in range(len(self.names)) if (key,n) in self.entries])
+            if (nbytes>64*1024**2) or (key==keys[-1]):
+                arrays = {}
+                for name in self.names:
+                    arrays[name] = [self.read(k,name) for k in group]
+                tmp.append(group,arrays)
+                group  = []
+                nbytes = 0
+        tmp.close()
+        self.f.close()
+        os.replace(self.filename+'.tmp',self.filename)
+        self.f = io.open(self.filename,'r+b')
+        self.cache.clear()
+        self.read_index()
+        self.modified = False
+
+    def close(self):
+
+        if self.f.closed:
+            return
+        if self.modified:
+            self.write_index()
+            if self.dead_fraction()>0.5:
+                self.compact()
+        self.f.close()
+
+
+class stamp_reader(object):
+    """
+    Random access to the postage stamps of a stamp file (flat fits or stamp_container) through its index table. A stamp is found by row, truth index or host id, and only its pixels are read, without deserializing any Python objects.
+
+    Each proc writes its own stamp file, and the start_row of a gathered index table points into the file of the proc in its rank column. Either give the stamp filename as a pattern with {rank} in place of the rank (the file of each stamp is then opened as needed), or give the file of one proc and its rank, in which case only that proc's rows of the index table are used.
+    """
+
+    def __init__(self, filename, index, rank=None):
+        """
+        Input
+        filename : Stamp filename (.fits, .fits.gz or .stamps), or a pattern with {rank} in place of the rank of the proc that wrote it
+        index    : Index table (structured array) or index table filename
+        rank     : Rank of the proc that wrote filename (not needed for a pattern or an index table of a single proc)
+        """
+
+        if isinstance(index,str):
+            index = fio.read(index)
+        if ('{rank}' not in filename) and ('rank' in index.dtype.names):
+            if rank is not None:
+                index = index[index['rank']==rank]
+            elif len(np.unique(index['rank']))>1:
+                raise ParamError('Index table holds stamps of several procs; give the rank of '+filename+' or a {rank} filename pattern.')
+        self.index    = index
+        self.filename = filename
+        self.files    = {}
+
+    def open(self, rank):
+        """
+        Return the open stamp file of a proc.
+
+        Input
+        rank : Rank of the proc (ignored if filename is not a pattern)
+        """
+
+        if '{rank}' in self.filename:
+            filename = self.filename.format(rank=rank)
+        else:
+            filename = self.filename
+            rank     = None
+        if rank not in self.files:
+            if filename.endswith('.stamps'):
+                self.files[rank] = stamp_container(filename)
+            else:
+                self.files[rank] = fio.FITS(filename)
+        return self.files[rank]
+
+    def find(self, ind=None, hostid=None):
+        """
+        Return the index table rows of the objects with this truth index and/or host id.
+
+        Input
+        ind    : Truth index
+        hostid : Host galaxy id number
+        """
+
+        mask = np.ones(len(self.index),dtype=bool)
+        if ind is not None:
+            mask &= self.index['ind']==ind
+        if hostid is not None:
+            mask &= self.index['hostid']==hostid
+        return np.where(mask)[0]
+
+    def read(self, i, name='image'):
+        """
+        Return the stamp of index table row i as a Galsim image with its bounds and local WCS, or None if no stamp was saved.
+
+        Input
+        i    : Index table row
+        name : Stamp array (image, weight or dq)
+        """
+
+        row   = self.index[i]
+        stamp = row['stamp']
+        if stamp<=0:
+            return None
+        start = row['start_row']
+        if 'rank' in self.index.dtype.names:
+            f = self.open(row['rank'])
+        else:
+            f = self.open(0)
+        if isinstance(f,stamp_container):
+            arr = f.read(start,name)
+        else:
+            arr = f[name+'_cutouts'][start:start+stamp**2]
+        if arr is None:
+            return None
+        return galsim.Image(arr.reshape((stamp,stamp)),
+                            xmin=row['xmin'],
+                            ymin=row['ymin'],
+                            wcs=galsim.JacobianWCS(row['dudx'],row['dudy'],row['dvdx'],row['dvdy']))
+
+    def close(self):
+
+        for f in self.files.values():
+            f.close()
+        self.files = {}
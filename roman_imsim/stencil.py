@@ -0,0 +1,96 @@
+import numpy as np
+import sys, os, io
+from concurrent.futures import ThreadPoolExecutor
+
+
+def row_bands(n, band):
+    """
+    Split n rows into bands of at most band rows. Returns a list of (first row, last row + 1).
+
+    Input
+    n    : Number of rows
+    band : Number of rows per band
+    """
+
+    return [(y0,min(y0+band,n)) for y0 in range(0,n,band)]
+
+def run_bands(func, bands, threads=1):
+    """
+    Call func(y0, y1) for each row band, in a pool of threads if threads>1. The bands must write disjoint rows; numpy releases the GIL in the array arithmetic, so the bands run concurrently.
+
+    Input
+    func    : Function of (y0, y1)
+    bands   : List of (y0, y1), see row_bands()
+    threads : Number of threads
+    """
+
+    if threads<=1:
+        for y0,y1 in bands:
+            func(y0,y1)
+        return
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for job in [pool.submit(func,y0,y1) for y0,y1 in bands]:
+            job.result()
+
+def block_expand(coeff, row_index, col_index):
+    """
+    Expand a low resolution coefficient map to pixels: coeff[row_index[y], col_index[x]] for the requested rows and columns.
+
+    Input
+    coeff     : 2d coefficient map (e.g., one value per block of pixels)
+    row_index : Row of coeff for each output row
+    col_index : Column of coeff for each output column
+    """
+
+    return np.take(np.take(coeff, row_index, axis=0), col_index, axis=1)
+
+def block_index(n, block, d=0, grid=None):
+    """
+    Index into a per-block coefficient map for each of n pixels, evaluated at the pixel shifted by -d (the source pixel of a stencil offset d). With grid, the shifted position is clipped to the grid-sized sub-grid of the pixel, which is how the detector effects historically padded their coefficient maps.
+
+    Input
+    n     : Number of pixels
+    block : Number of pixels per coefficient
+    d     : Stencil offset
+    grid  : Sub-grid size (None for the whole axis)
+    """
+
+    i = np.arange(n)
+    if grid is None:
+        return np.clip(i-d,0,n-1)//block
+    return (i//grid*grid+np.clip(i%grid-d,0,grid-1))//block
+
+def symmetric_index(i, n):
+    """
+    Map indices into an axis of length n padded with np.pad(mode='symmetric') (i<0 and i>=n in the padding) to indices into the axis itself.
+
+    Input
+    i : Index array relative to the start of the unpadded axis
+    n : Length of the axis
+    """
+
+    i = np.where(i<0, -i-1, i)
+    return np.where(i>=n, 2*n-i-1, i)
+
+def block_stencil(src, coeffs, row_index, col_index, offsets, y0, y1, out, src0=0):
+    """
+    Apply a stencil whose coefficients vary across the image in blocks, to rows y0 to y1 of the output, without expanding the coefficients beyond those rows:
+
+        out[y-y0, x] += sum_k coeffs[k][row_index[k][y], col_index[k][x]] * src[y+oy_k, x+ox_k]
+
+    with the terms added in order of k. src is the (padded) input image and (oy_k, ox_k) the position of output pixel (0, 0) in it for term k. src may hold only some rows of the input image, starting at row src0.
+
+    Input
+    coeffs    : List of 2d coefficient maps
+    row_index : List of coefficient row index arrays for each output row (see block_index())
+    col_index : List of coefficient column index arrays for each output column
+    offsets   : List of (oy, ox) offsets into src
+    y0, y1    : Output rows
+    out       : Output array of y1-y0 rows
+    src0      : Row of the input image in the first row of src
+    """
+
+    nx = out.shape[1]
+    for c,ri,ci,(oy,ox) in zip(coeffs,row_index,col_index,offsets):
+        out += block_expand(c, ri[y0:y1], ci) * src[y0+oy-src0:y1+oy-src0, ox:ox+nx]
+    return out
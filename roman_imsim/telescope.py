@@ -91,6 +91,10 @@ sca_center = np.array([
     [110.46, 0.24],
     [111.56, -49.15]])
 
+# Bandpasses and open survey (dither) files are the same for every pointing in a process, so they are loaded once and shared between pointing instances (e.g., when looping over many (dither, SCA) tasks in batch mode).
+bpass_cache  = {}
+dither_cache = {}
+
 class pointing(object):
     """
     Class to manage and hold informaiton about a roman pointing, including WCS and PSF.
@@ -154,7 +158,9 @@ class pointing(object):
         """
 
         self.filter = filter_
-        self.bpass  = roman.getBandpasses(AB_zeropoint=True)[self.filter]
+        if len(bpass_cache)==0:
+            bpass_cache.update(roman.getBandpasses(AB_zeropoint=True))
+        self.bpass  = bpass_cache[self.filter]
 
     def update_dither(self,dither,force_filter=False):
         """
@@ -167,7 +173,9 @@ class pointing(object):
 
         self.dither = dither
 
-        d = fio.FITS(self.ditherfile)[-1][self.dither]
+        if self.ditherfile not in dither_cache:
+            dither_cache[self.ditherfile] = fio.FITS(self.ditherfile)[-1]
+        d = dither_cache[self.ditherfile][self.dither]
 
         # Check that nothing went wrong with the filter specification.
         # if filter_dither_dict[self.filter] != d['filter']:
@@ -48,6 +48,8 @@ from .misc import hsm
 from .misc import get_filename
 from .misc import get_filenames
 from .misc import write_fits
+from .parallel import sca_domains
+from .stamps import max_stamp_size
 
 filter_flux_dict = {
     'J129' : 'j_Roman',
@@ -74,113 +76,8 @@ class init_catalogs(object):
     """
     Build truth catalogs if they don't exist from input galaxy and star catalogs.
     """
-    """
-    def __init__(self, params, pointing, gal_rng, rank, size, comm=None, setup=False):
-        
-        #Initiate the catalogs
-        #Input
-        #params   : Parameter dictionary
-        #pointing : Pointing object
-        #gal_rng  : Random generator [0,1]
-        #rank     : Process rank
-        #comm     : MPI comm object
-        
-        self.pointing = pointing
-        self.rank = rank
-        if rank == 0:
-            # Set up file path. Check if output truth file path exists or if explicitly remaking galaxy properties
-            filename = get_filename(params['out_path'],
-                                    'truth',
-                                    params['output_truth'],
-                                    name2='truth_gal',
-                                    overwrite=params['overwrite'])
-            # Link to galaxy truth catalog on disk
-            self.gals  = self.init_galaxy(filename,params,pointing,gal_rng,setup)
-            # Link to star truth catalog on disk
-            self.stars = self.init_star(params)
-            # Link to supernova truth catalog on disk
-            self.supernovae,self.lightcurves = self.init_supernova(params)
-            if setup:
-                comm.Barrier()
-                return
-            self.get_near_sca()
-            self.init_sed(params)
-            # print 'gal check',len(self.gals['ra'][:]),len(self.stars['ra'][:]),np.degrees(self.gals['ra'][:].min()),np.degrees(self.gals['ra'][:].max()),np.degrees(self.gals['dec'][:].min()),np.degrees(self.gals['dec'][:].max())
-            if comm is not None:
-                # Pass gal_ind to other procs
-                # print 'gal check',len(self.gals['ra'][:]),len(self.stars['ra'][:]),np.degrees(self.gals['ra'][:].min()),np.degrees(self.gals['ra'][:].max()),np.degrees(self.gals['dec'][:].min()),np.degrees(self.gals['dec'][:].max())
-                save_obj(self.gal_ind, params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_galind.pkl')
-                save_obj(self.gals, params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_gals.pkl')
-                save_obj(self.star_ind, params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_starind.pkl')
-                save_obj(self.stars, params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_stars.pkl')
-                save_obj(self.seds, params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_seds.pkl')
-                save_obj(self.supernova_ind, params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_snind.pkl')
-                save_obj(self.supernovae, params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_sn.pkl')
-                save_obj(self.lightcurves, params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_lc.pkl')
-
-                #save_obj(self.gal_ind, params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_galind.pkl')
-                #save_obj(self.gals, params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_gals.pkl')
-                #save_obj(self.star_ind, params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_starind.pkl')
-                #save_obj(self.stars, params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_stars.pkl')
-                #save_obj(self.seds, params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_seds.pkl')
-                #save_obj(self.supernova_ind, params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_snind.pkl')
-                #save_obj(self.supernovae, params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_sn.pkl')
-                #save_obj(self.lightcurves, params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_lc.pkl')
-                comm.Barrier()
-            print('rank0 has saved object info to the disk.')
-        else:
-            if setup:
-                comm.Barrier()
-                return
-            comm.Barrier()
-            print('other ranks are reading the info from the disk.', rank)
-            # Get gals
-            self.gal_ind = load_obj(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_galind.pkl')
-            self.gals = load_obj(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_gals.pkl')
-            # Get stars
-            self.star_ind = load_obj(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_starind.pkl')
-            self.stars = load_obj(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_stars.pkl')
-            # Get seds
-            self.seds = load_obj(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_seds.pkl')
-            # Get sne
-            self.supernova_ind = load_obj(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_snind.pkl')
-            self.supernovae = load_obj(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_sn.pkl')
-            self.lightcurves = load_obj(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_lc.pkl')
-        self.gal_ind  = self.gal_ind[rank::size]
-        self.gals     = self.gals[rank::size]
-        if rank>=params['starproc']:
-            self.star_ind=[]
-            self.stars=[]
-        else:
-            self.star_ind = self.star_ind[rank::params['starproc']]
-            self.stars    = self.stars[rank::params['starproc']]
-        if self.supernovae is not None:
-            self.supernova_ind = self.supernova_ind[rank::size]
-            self.supernovae = self.supernovae[rank::size]
-        comm.Barrier()
-        if rank == 0:
-            os.remove(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_galind.pkl')
-            os.remove(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_gals.pkl')
-            os.remove(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_starind.pkl')
-            os.remove(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_stars.pkl')
-            os.remove(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_seds.pkl')
-            os.remove(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_snind.pkl')
-            os.remove(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_sn.pkl')
-            os.remove(params['tmpdir']+str(os.environ['SLURM_JOB_ID'])+'_tmp_lc.pkl')
-            print('removed object info from the disk', rank)
-
-        #os.remove(params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_galind.pkl')
-        #os.remove(params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_gals.pkl')
-        #os.remove(params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_starind.pkl')
-        #os.remove(params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_stars.pkl')
-        #os.remove(params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_seds.pkl')
-        #os.remove(params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_snind.pkl')
-        #os.remove(params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_sn.pkl')
-        #os.remove(params['tmpdir']+'/'+str(os.environ['SLURM_JOB_ID'])+'/tmp_lc.pkl')
 
-    """
-
-    def __init__(self, params, pointing, gal_rng, rank, size, comm=None, setup=False):
+    def __init__(self, params, pointing, gal_rng, rank, size, comm=None, setup=False, cache=None):
         
         #Initiate the catalogs
 
@@ -190,23 +87,39 @@ class init_catalogs(object):
         #gal_rng  : Random generator [0,1]
         #rank     : Process rank
         #comm     : MPI comm object
+        #cache    : Dictionary holding truth catalog links and SEDs between instances (batch mode)
 
         self.pointing = pointing
         self.rank = rank
+        if cache is None:
+            cache = {}
+        self.cache = cache
         if rank == 0:
-            # Set up file path. Check if output truth file path exists or if explicitly remaking galaxy properties
-            filename = get_filename(params['out_path'],
-                                    'truth',
-                                    params['output_truth'],
-                                    name2='truth_gal',
-                                    overwrite=params['overwrite'])
+            if 'gals' in cache:
+                # Truth catalogs were already built and linked for a previous task
+                self.gals        = cache['gals']
+                self.stars       = cache['stars']
+                self.supernovae  = cache['supernovae']
+                self.lightcurves = cache['lightcurves']
+            else:
+                # Set up file path. Check if output truth file path exists or if explicitly remaking galaxy properties
+                filename = get_filename(params['out_path'],
+                                        'truth',
+                                        params['output_truth'],
+                                        name2='truth_gal',
+                                        overwrite=params['overwrite'])
 
-            # Link to galaxy truth catalog on disk
-            self.gals  = self.init_galaxy(filename,params,pointing,gal_rng,setup)
-            # Link to star truth catalog on disk
-            self.stars = self.init_star(params)
-            # Link to supernova truth catalog on disk
-            self.supernovae,self.lightcurves = self.init_supernova(params)
+                # Link to galaxy truth catalog on disk
+                self.gals  = self.init_galaxy(filename,params,pointing,gal_rng,setup)
+                # Link to star truth catalog on disk
+                self.stars = self.init_star(params)
+                # Link to supernova truth catalog on disk
+                self.supernovae,self.lightcurves = self.init_supernova(params)
+                if not setup:
+                    cache['gals']        = self.gals
+                    cache['stars']       = self.stars
+                    cache['supernovae']  = self.supernovae
+                    cache['lightcurves'] = self.lightcurves
             if setup:
                 comm.Barrier()
                 return
@@ -215,44 +128,48 @@ class init_catalogs(object):
             # print 'gal check',len(self.gals['ra'][:]),len(self.stars['ra'][:]),np.degrees(self.gals['ra'][:].min()),np.degrees(self.gals['ra'][:].max()),np.degrees(self.gals['dec'][:].min()),np.degrees(self.gals['dec'][:].max())
 
             if comm is not None:
-                # Pass gal_ind to other procs
+                # Broadcast catalogs to other procs (with the local backend, they are shared in memory rather than copied)
                 # print 'gal check',len(self.gals['ra'][:]),len(self.stars['ra'][:]),np.degrees(self.gals['ra'][:].min()),np.degrees(self.gals['ra'][:].max()),np.degrees(self.gals['dec'][:].min()),np.degrees(self.gals['dec'][:].max())
-                for i in range(1,size):
-                    comm.send(self.gal_ind,  dest=i)
-                    comm.send(self.gals,  dest=i)
-                # Pass star_ind to other procs
-                for i in range(1,size):
-                    comm.send(self.star_ind,  dest=i)
-                    comm.send(self.stars,  dest=i)
-                # Pass seds to other procs
-                for i in range(1,size):
-                    comm.send(self.seds,  dest=i)
-
-                # Pass sne to other procs
-                for i in range(1,size):
-                    comm.send(self.supernova_ind, dest=i)
-                    comm.send(self.supernovae, dest=i)
-                    comm.send(self.lightcurves, dest=i)
+                comm.bcast(self.gal_ind, root=0)
+                comm.bcast(self.gals, root=0)
+                comm.bcast(self.star_ind, root=0)
+                comm.bcast(self.stars, root=0)
+                comm.bcast(self.seds, root=0)
+                comm.bcast(self.supernova_ind, root=0)
+                comm.bcast(self.supernovae, root=0)
+                comm.bcast(self.lightcurves, root=0)
         else:
             if setup:
                 comm.Barrier()
                 return
 
             # Get gals
-            self.gal_ind = comm.recv(source=0)
-            self.gals = comm.recv(source=0)
+            self.gal_ind = comm.bcast(None, root=0)
+            self.gals = comm.bcast(None, root=0)
 
             # Get stars
-            self.star_ind = comm.recv(source=0)
-            self.stars = comm.recv(source=0)
+            self.star_ind = comm.bcast(None, root=0)
+            self.stars = comm.bcast(None, root=0)
 
             # Get seds
-            self.seds = comm.recv(source=0)
+            self.seds = comm.bcast(None, root=0)
 
             # Get sne
-            self.supernova_ind = comm.recv(source=0)
-            self.supernovae = comm.recv(source=0)
-            self.lightcurves = comm.recv(source=0)
+            self.supernova_ind = comm.bcast(None, root=0)
+            self.supernovae = comm.bcast(None, root=0)
+            self.lightcurves = comm.bcast(None, root=0)
+
+        self.domains = None
+        if params.get('domain_decomposition',False) and (comm is not None):
+            # Each proc draws the objects centred in its own part of the SCA. Stars follow the domains like all other objects, so starproc does not apply. The default halo holds the largest saved galaxy stamp of an object at the edge of the domain; larger stamps (bright galaxies, stars) spill.
+            if (rank==0) and (params['starproc']<size):
+                print('domain_decomposition: stars are drawn by all '+str(size)+' procs, starproc is ignored')
+            self.domains = sca_domains(comm, roman.n_pix, roman.n_pix, params.get('domain_halo',max_stamp_size//2))
+            self.gal_ind,self.gals = self.select_domain(self.gal_ind,self.gals)
+            self.star_ind,self.stars = self.select_domain(self.star_ind,self.stars)
+            if self.supernovae is not None:
+                self.supernova_ind,self.supernovae = self.select_domain(self.supernova_ind,self.supernovae)
+            return
 
         self.gal_ind  = self.gal_ind[rank::size]
         self.gals     = self.gals[rank::size]
@@ -266,6 +183,21 @@ class init_catalogs(object):
             self.supernova_ind = self.supernova_ind[rank::size]
             self.supernovae = self.supernovae[rank::size]
 
+    def select_domain(self,ind,objs):
+        """
+        Select the objects whose image position is in this proc's domain of the SCA.
+
+        Input
+        ind  : Truth catalog indices
+        objs : Truth catalog rows
+        """
+
+        if len(ind)==0:
+            return ind,objs
+        x,y  = self.pointing.WCS.toImage(objs['ra'][:], objs['dec'][:], units=galsim.radians)
+        mask = self.domains.mine(x,y)
+        return ind[mask],objs[mask]
+
 
     def close(self):
 
@@ -687,37 +619,46 @@ class init_catalogs(object):
         if not params['dc2']:
             return None
 
-        filename = get_filename(params['out_path'],
-                                'truth',
-                                params['output_truth'],
-                                name2='truth_sed',
-                                overwrite=False, ftype='h5')
+        # SEDs already read for a previous task are reused and only new ones are read from disk
+        if 'sedfile' not in self.cache:
+            filename = get_filename(params['out_path'],
+                                    'truth',
+                                    params['output_truth'],
+                                    name2='truth_sed',
+                                    overwrite=False, ftype='h5')
 
-        if 'tmpdir' in params:
-            filename2 = get_filename(params['tmpdir'],
-                                '',
-                                params['output_truth'],
-                                name2='truth_sed',
-                                overwrite=False, ftype='h5')
-            if not params['overwrite']:
-                if not os.path.exists(filename2):
+            if 'tmpdir' in params:
+                filename2 = get_filename(params['tmpdir'],
+                                    '',
+                                    params['output_truth'],
+                                    name2='truth_sed',
+                                    overwrite=False, ftype='h5')
+                if not params['overwrite']:
+                    if not os.path.exists(filename2):
+                        shutil.copy(filename,filename2, follow_symlinks=True)
+                else:
                     shutil.copy(filename,filename2, follow_symlinks=True)
             else:
-                shutil.copy(filename,filename2, follow_symlinks=True)
-        else:
-            filename2 = filename
+                filename2 = filename
 
-        sedfile = h5py.File(filename2,mode='r')
+            self.cache['sedfile'] = h5py.File(filename2,mode='r')
+            self.cache['seds']    = {}
+        sedfile = self.cache['sedfile']
+        seds    = self.cache['seds']
 
         for s in np.unique(self.gals['sed']):
             if s=='':
                 continue
-            self.seds[s] = sedfile[s.lstrip().rstrip()][:]
+            if s not in seds:
+                seds[s] = sedfile[s.lstrip().rstrip()][:]
+            self.seds[s] = seds[s]
 
         for s in np.unique(self.stars['sed']):
             if s=='':
                 continue
-            self.seds[s] = sedfile[s.lstrip().rstrip()][:]
+            if s not in seds:
+                seds[s] = sedfile[s.lstrip().rstrip()][:]
+            self.seds[s] = seds[s]
 
         return self.seds
 